@@ -1,12 +1,23 @@
 from django.contrib import admin
-from .models import Change
+from .models import Change, Optout
 
 
 class ChangeAdmin(admin.ModelAdmin):
     list_display = [
-        "id", "action", "mother_id", "validated", "source",
-        "created_at", "updated_at", "created_by", "updated_by"]
-    list_filter = ["source", "validated", "created_at"]
+        "id", "action", "mother_id", "validated", "source", "state",
+        "attempts", "scheduled_at", "queued_at", "processed_at", "created_at",
+        "updated_at", "created_by", "updated_by"]
+    list_filter = ["source", "validated", "state", "created_at"]
     search_fields = ["mother_id", "to_addr"]
 
+
+class OptoutAdmin(admin.ModelAdmin):
+    list_display = [
+        "id", "optout_id", "identity", "reason", "source", "msg_type",
+        "msg_receiver", "processed_at", "created_at"]
+    list_filter = ["reason", "source", "msg_type", "msg_receiver",
+                   "created_at"]
+    search_fields = ["identity"]
+
 admin.site.register(Change, ChangeAdmin)
+admin.site.register(Optout, OptoutAdmin)
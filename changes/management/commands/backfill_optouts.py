@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from changes.models import Optout
+from hellomama_registration import utils
+
+
+class Command(BaseCommand):
+    help = ("This command will loop all the optouts in the Identity Store "
+            "and record the ones that aren't in the local optout ledger yet, "
+            "so that the optout totals are counted from the full history.")
+
+    def handle(self, *args, **kwargs):
+        existing = set(Optout.objects.filter(
+            optout_id__isnull=False).values_list('optout_id', flat=True))
+
+        optouts = []
+        for optout in utils.search_optouts():
+            optout_id = str(optout['id'])
+            if optout_id in existing:
+                continue
+            existing.add(optout_id)
+
+            # The metrics for these have already been fired
+            record = Optout(
+                optout_id=optout_id, identity=optout['identity'],
+                reason=optout['optout_reason'],
+                source=optout['optout_source'], processed_at=timezone.now())
+            record.set_registration(
+                Optout.get_registration(optout['identity']))
+            optouts.append(record)
+
+        Optout.objects.bulk_create(optouts, batch_size=1000)
+
+        self.success('Recorded %d optouts.' % (len(optouts),))
+
+    def log(self, level, msg):
+        self.stdout.write(level(msg))
+
+    def success(self, msg):
+        self.log(self.style.SUCCESS, msg)
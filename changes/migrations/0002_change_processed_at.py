@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 16:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_existing_processed(apps, schema_editor):
+    # Every change so far was applied as it was created
+    Change = apps.get_model('changes', 'Change')
+    Change.objects.update(processed_at=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(
+            mark_existing_processed, migrations.RunPython.noop),
+    ]
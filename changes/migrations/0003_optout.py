@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 17:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0002_change_processed_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Optout',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('optout_id', models.CharField(blank=True, max_length=36, null=True, unique=True)),
+                ('identity', models.CharField(db_index=True, max_length=36)),
+                ('reason', models.CharField(max_length=255)),
+                ('source', models.CharField(max_length=255)),
+                ('msg_type', models.CharField(blank=True, max_length=255, null=True)),
+                ('msg_receiver', models.CharField(blank=True, max_length=255, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
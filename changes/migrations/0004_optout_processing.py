@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 17:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_existing_processed(apps, schema_editor):
+    # The metrics for every optout so far were fired as it was received
+    Optout = apps.get_model('changes', 'Optout')
+    Optout.objects.update(processed_at=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0003_optout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='optout',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(
+            mark_existing_processed, migrations.RunPython.noop),
+    ]
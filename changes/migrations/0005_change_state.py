@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 19:10
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+def mark_processed_applied(apps, schema_editor):
+    Change = apps.get_model('changes', 'Change')
+    Change.objects.filter(processed_at__isnull=False).update(state='applied')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0004_optout_processing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('applying', 'Applying'), ('applied', 'Applied'), ('failed', 'Failed')], default='pending', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='steps',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(
+            mark_processed_applied, migrations.RunPython.noop),
+    ]
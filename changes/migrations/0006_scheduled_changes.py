@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 19:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0005_change_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='scheduled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ServiceSlot',
+            fields=[
+                ('service', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('next_slot', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -1,5 +1,6 @@
 import uuid
 
+from django.conf import settings
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -7,7 +8,8 @@ from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 from django.utils.encoding import python_2_unicode_compatible
 
-from registrations.models import Source, get_or_incr_cache
+from registrations.models import (
+    Source, RegistrationParticipant, get_or_incr_cache)
 
 
 @python_2_unicode_compatible
@@ -19,7 +21,27 @@ class Change(models.Model):
         action (str): What type of change to implement
         data (json): Change info in json format
         source (object): Auto-completed field based on the Api key
+        state (str): Whether the action is pending, being applied, applied
+            or failed
+        steps (json): The results of the steps of the action that have
+            been completed, by step name, so that a retry can skip them
+        attempts (int): How many times applying the action was started
+        scheduled_at (datetime): When an administrative change was
+            scheduled to be applied, if it isn't applied straight away
+        queued_at (datetime): When the change was last queued by
+            requeue_changes or queue_scheduled_changes
+        processed_at (datetime): When the action was applied
     """
+    PENDING = 'pending'
+    APPLYING = 'applying'
+    APPLIED = 'applied'
+    FAILED = 'failed'
+    STATE_CHOICES = (
+        (PENDING, "Pending"),
+        (APPLYING, "Applying"),
+        (APPLIED, "Applied"),
+        (FAILED, "Failed"),
+    )
 
     ACTION_CHOICES = (
         ('change_messaging', "Change messaging type and/or reception times"),
@@ -38,6 +60,13 @@ class Change(models.Model):
     validated = models.BooleanField(default=False)
     source = models.ForeignKey(Source, related_name='changes',
                                null=False)
+    state = models.CharField(max_length=8, choices=STATE_CHOICES,
+                             default=PENDING)
+    steps = JSONField(default=dict, blank=True)
+    attempts = models.IntegerField(default=0)
+    scheduled_at = models.DateTimeField(null=True, blank=True)
+    queued_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(User, related_name='changes_created',
@@ -50,88 +79,134 @@ class Change(models.Model):
         return str(self.id)
 
 
+@python_2_unicode_compatible
+class Optout(models.Model):
+    """ A local record of an optout received from the Identity Store, with
+    the message type and receiver of the registration it applied to, so
+    that optout totals can be counted without searching the Identity Store.
+
+    Args:
+        optout_id (str): The id of the optout in the Identity Store
+        identity (str): UUID of the identity that opted out
+        reason (str): The optout reason
+        source (str): The optout source
+        msg_type (str): The msg_type of the identity's registration
+        msg_receiver (str): The msg_receiver of the identity's registration
+        processed_at (datetime): When the optout's metrics were fired
+    """
+    optout_id = models.CharField(max_length=36, null=True, blank=True,
+                                 unique=True)
+    identity = models.CharField(max_length=36, db_index=True)
+    reason = models.CharField(max_length=255)
+    source = models.CharField(max_length=255)
+    msg_type = models.CharField(max_length=255, null=True, blank=True)
+    msg_receiver = models.CharField(max_length=255, null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def get_registration(identity):
+        """
+        Returns the latest registration the identity opted out of, where
+        registrations for the identity as the mother take precedence
+        """
+        registration = RegistrationParticipant.get_latest_registration(
+            identity, roles=[RegistrationParticipant.MOTHER])
+        if registration is None:
+            registration = RegistrationParticipant.get_latest_registration(
+                identity, roles=[RegistrationParticipant.RECEIVER])
+        return registration
+
+    def set_registration(self, registration):
+        """
+        Records the registration's msg_type and msg_receiver, if there is a
+        registration
+        """
+        data = registration.data if registration is not None else {}
+        self.msg_type = data.get('msg_type')
+        self.msg_receiver = data.get('msg_receiver')
+
+    def __str__(self):
+        return "%s %s" % (self.identity, self.reason)
+
+
+@python_2_unicode_compatible
+class ServiceSlot(models.Model):
+    """ The next time a scheduled change can call an external service
+    without going over the service's ADMIN_CHANGE_RATES rate limit.
+
+    Args:
+        service (str): The name of the external service
+        next_slot (datetime): The earliest time the next change can run
+    """
+    service = models.CharField(max_length=32, primary_key=True)
+    next_slot = models.DateTimeField()
+
+    def __str__(self):
+        return "%s: %s" % (self.service, self.next_slot)
+
+
 @receiver(post_save, sender=Change)
 def change_post_save(sender, instance, created, **kwargs):
-    """ Post save hook to fire Change validation task
+    """ Post save hook to fire Change validation task. Changes for the
+    actions in CHANGE_BATCH_ACTIONS are left for implement_change_batch,
+    and scheduled changes for queue_scheduled_changes.
     """
-    if created:
+    if (created and instance.action not in settings.CHANGE_BATCH_ACTIONS and
+            instance.scheduled_at is None):
         from .tasks import implement_action
         implement_action.apply_async(
             kwargs={"change_id": str(instance.id)})
-        pass
+
+
+# The metrics fired for new changes, by action
+CHANGE_METRICS = {
+    'change_language': 'registrations.change.language',
+    'change_baby': 'registrations.change.pregnant_to_baby',
+    'change_loss': 'registrations.change.pregnant_to_loss',
+    'change_messaging': 'registrations.change.messaging',
+}
+
+
+def fire_change_metrics(action, count=1):
+    """ Fires the sum and total metrics for `count` new changes for the
+    action
+    """
+    from registrations.tasks import fire_metric
+    metric = CHANGE_METRICS[action]
+    fire_metric.apply_async(kwargs={
+        "metric_name": '%s.sum' % metric,
+        "metric_value": float(count),
+    })
+
+    total_key = '%s.total.last' % metric
+    total = get_or_incr_cache(
+        total_key, Change.objects.filter(action=action).count, count)
+    fire_metric.apply_async(kwargs={
+        'metric_name': total_key,
+        'metric_value': total,
+    })
 
 
 @receiver(post_save, sender=Change)
 def fire_language_change_metric(sender, instance, created, **kwargs):
-    from registrations.tasks import fire_metric
     if created and instance.action == 'change_language':
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.change.language.sum',
-            "metric_value": 1.0
-        })
-
-        total_key = 'registrations.change.language.total.last'
-        total = get_or_incr_cache(
-            total_key,
-            Change.objects.filter(action='change_language').count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+        fire_change_metrics(instance.action)
 
 
 @receiver(post_save, sender=Change)
 def fire_baby_change_metric(sender, instance, created, **kwargs):
-    from registrations.tasks import fire_metric
     if created and instance.action == 'change_baby':
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.change.pregnant_to_baby.sum',
-            "metric_value": 1.0
-        })
-
-        total_key = 'registrations.change.pregnant_to_baby.total.last'
-        total = get_or_incr_cache(
-            total_key,
-            Change.objects.filter(action='change_baby').count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+        fire_change_metrics(instance.action)
 
 
 @receiver(post_save, sender=Change)
 def fire_loss_change_metric(sender, instance, created, **kwargs):
-    from registrations.tasks import fire_metric
     if created and instance.action == 'change_loss':
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.change.pregnant_to_loss.sum',
-            "metric_value": 1.0
-        })
-
-        total_key = 'registrations.change.pregnant_to_loss.total.last'
-        total = get_or_incr_cache(
-            total_key,
-            Change.objects.filter(action='change_loss').count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+        fire_change_metrics(instance.action)
 
 
 @receiver(post_save, sender=Change)
 def fire_message_change_metric(sender, instance, created, **kwargs):
-    from registrations.tasks import fire_metric
     if created and instance.action == 'change_messaging':
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'registrations.change.messaging.sum',
-            "metric_value": 1.0
-        })
-
-        total_key = 'registrations.change.messaging.total.last'
-        total = get_or_incr_cache(
-            total_key,
-            Change.objects.filter(action='change_messaging').count)
-        fire_metric.apply_async(kwargs={
-            'metric_name': total_key,
-            'metric_value': total,
-        })
+        fire_change_metrics(instance.action)
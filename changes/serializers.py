@@ -1,8 +1,5 @@
 from .models import Change
 from rest_framework import serializers
-from seed_services_client.stage_based_messaging \
-    import StageBasedMessagingApiClient
-from django.conf import settings
 from hellomama_registration import utils
 
 
@@ -36,17 +33,11 @@ class LanguageValidator:
             if data.get('language'):
                 new_lang = data['language']
 
-                sbmApi = StageBasedMessagingApiClient(
-                    api_url=settings.STAGE_BASED_MESSAGING_URL,
-                    auth_token=settings.STAGE_BASED_MESSAGING_TOKEN
-                )
-
                 messagesets = []
-                languages = sbmApi.get_messageset_languages()
+                languages = utils.get_messageset_languages()
                 if data.get('messageset'):
-                    short_name = data['messageset']
-                    messagesets.append(str(utils.get_messageset_by_shortname(
-                        short_name)['id']))
+                    messagesets.append(str(utils.get_messageset_id(
+                        data['messageset'])))
                 else:
                     subscriptions = utils.get_subscriptions(data['mother_id'])
                     for subscription in subscriptions:
@@ -1,21 +1,79 @@
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
 from celery.task import Task
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_save
+from django.utils import timezone
 
 from hellomama_registration import utils
-from registrations.models import Registration, SubscriptionRequest
-from .models import Change
+from registrations.models import (
+    Registration, SubscriptionRequest, get_or_incr_cache)
+from .models import Change, Optout, ServiceSlot
+
+logger = get_task_logger(__name__)
 
 
 class ImplementAction(Task):
     """ Task to apply a Change action.
+
+    Each step of an action that has a side effect is checkpointed on the
+    change, so that a task that is delivered again after a worker died
+    skips the steps that were already done.
     """
     name = "hellomama_registration.changes.tasks.implement_action"
+    acks_late = True
+
+    def step(self, change, name, func, atomic=False):
+        """ Runs a step of the change's action, unless a previous attempt
+        completed it, and records its result. Recording the step also
+        renews the claim on the change.
+
+        With `atomic` the step is recorded in the same transaction it runs
+        in, which is only for steps that just write to the database. Steps
+        that call other services run outside of a transaction, so that a
+        slow service doesn't keep one open, and must be safe to run again
+        in case the worker dies before the step is recorded.
+        """
+        if name in change.steps:
+            return change.steps[name]
+        if not atomic:
+            result = func()
+            self.record_step(change, name, result)
+            return result
+        with transaction.atomic():
+            result = func()
+            self.record_step(change, name, result)
+        return result
+
+    def record_step(self, change, name, result):
+        """ Records that a step of the change's action was completed, which
+        also renews the claim on the change
+        """
+        change.steps[name] = result
+        Change.objects.filter(id=change.id).update(
+            steps=change.steps, updated_at=timezone.now())
+
+    def deactivate(self, change, name, identity):
+        """ Deactivates the identity's active subscriptions, as a step
+        """
+        def deactivate():
+            utils.deactivate_subscriptions(utils.get_subscriptions(identity))
+        self.step(change, name, deactivate)
+
+    def subscribe(self, change, name, subscription):
+        """ Creates a SubscriptionRequest, as a step
+        """
+        def subscribe():
+            return str(SubscriptionRequest.objects.create(**subscription).id)
+        self.step(change, name, subscribe, atomic=True)
 
     def change_baby(self, change):
-        # Get mother's current subscriptions
-        subscriptions = utils.get_subscriptions(change.mother_id)
-        # Deactivate subscriptions
-        for subscription in subscriptions:
-            utils.deactivate_subscription(subscription)
+        # Deactivate mother's current subscriptions
+        self.deactivate(change, 'deactivate_mother', change.mother_id)
         # Get mother's identity
         mother = utils.get_identity(change.mother_id)
         # Get mother's registration
@@ -43,7 +101,7 @@ class ImplementAction(Task):
             "lang": mother["details"]["preferred_language"],
             "schedule": mother_msgset_schedule
         }
-        SubscriptionRequest.objects.create(**mother_sub)
+        self.subscribe(change, 'subscribe_mother', mother_sub)
 
         # Make household subscription if required
         for registration in registrations:
@@ -61,17 +119,14 @@ class ImplementAction(Task):
                     "lang": mother["details"]["preferred_language"],
                     "schedule": household_msgset_schedule
                 }
-                SubscriptionRequest.objects.create(**household_sub)
+                self.subscribe(change, 'subscribe_household', household_sub)
             break
 
         return "Change baby completed"
 
     def change_loss(self, change):
-        # Get mother's current subscriptions
-        subscriptions = utils.get_subscriptions(change.mother_id)
-        # Deactivate subscriptions
-        for subscription in subscriptions:
-            utils.deactivate_subscription(subscription)
+        # Deactivate mother's current subscriptions
+        self.deactivate(change, 'deactivate_mother', change.mother_id)
         # Get mother's identity
         mother = utils.get_identity(change.mother_id)
 
@@ -95,7 +150,7 @@ class ImplementAction(Task):
             "lang": mother["details"]["preferred_language"],
             "schedule": mother_msgset_schedule
         }
-        SubscriptionRequest.objects.create(**mother_sub)
+        self.subscribe(change, 'subscribe_mother', mother_sub)
 
         # Get mother's registration
         registrations = Registration.objects.\
@@ -103,47 +158,44 @@ class ImplementAction(Task):
             order_by('-created_at')
         for registration in registrations:
             if registration.data["msg_receiver"] != 'mother_only':
-                # Get household's current subscriptions
-                subscriptions = utils.get_subscriptions(
-                    mother["details"]["linked_to"])
-                # Deactivate subscriptions
-                for subscription in subscriptions:
-                    utils.deactivate_subscription(subscription)
+                # Deactivate household's current subscriptions
+                self.deactivate(change, 'deactivate_household',
+                                mother["details"]["linked_to"])
             break
 
         return "Change loss completed"
 
-    def change_messaging(self, change):
+    def plan_messaging(self, change):
+        """ Works out the mother's new subscription from her current one,
+        before the current one is deactivated.
+
+        :returns: dict with the subscriptions to deactivate and the new
+            subscription request
+        """
         # Get mother's current subscriptions
-        subscriptions = utils.get_subscriptions(change.mother_id)
-        current_sub = next(subscriptions)  # necessary assumption
+        subscriptions = list(utils.get_subscriptions(change.mother_id))
+        current_sub = subscriptions[0]  # necessary assumption
         current_nsn = current_sub["next_sequence_number"]
 
-        # get current subscription's messageset
-        current_msgset = utils.get_messageset(current_sub["messageset"])
-
-        # get current subscription's schedule
-        current_sched = utils.get_schedule(current_sub["schedule"])
-        current_days = current_sched["day_of_week"]
-        current_rate = len(current_days.split(','))  # msgs per week
+        # get current subscription's messageset and schedule from the local
+        # copies, which are synced from the SBM
+        current_msgset = utils.get_mirrored_messageset(
+            current_sub["messageset"])
+        current_rate = utils.get_mirrored_schedule(
+            current_sub["schedule"]).messages_per_week
 
-        # Deactivate subscriptions
-        utils.deactivate_subscription(current_sub)
-        for subscription in subscriptions:
-            utils.deactivate_subscription(subscription)
-
-        if 'audio' in current_msgset["short_name"]:
+        if 'audio' in current_msgset.short_name:
             from_type = 'audio'
         else:
             from_type = 'text'
 
-        if 'miscarriage' in current_msgset["short_name"]:
+        if 'miscarriage' in current_msgset.short_name:
             stage = 'miscarriage'
             weeks = 1  # just a placeholder to get the messageset_short_name
-        elif 'postbirth' in current_msgset["short_name"]:
+        elif 'postbirth' in current_msgset.short_name:
             stage = 'postbirth'
             # set placeholder weeks for getting the messageset_short_name
-            if '0_12' in current_msgset["short_name"]:
+            if '0_12' in current_msgset.short_name:
                 weeks = 1
             else:
                 weeks = 13
@@ -172,16 +224,17 @@ class ImplementAction(Task):
                 stage, 'mother', to_type,
                 weeks, voice_days, voice_times)
 
-        new_msgset_id, new_msgset_schedule, next_sequence_number =\
-            utils.get_messageset_schedule_sequence(new_short_name, weeks)
+        new_msgset = utils.get_mirrored_messageset(short_name=new_short_name)
+        new_msgset_id = new_msgset.id
+        new_msgset_schedule = new_msgset.default_schedule
 
-        # calc new_nsn rather than using next_sequence_number
+        # calc new_nsn from the current one, keeping the mother at the same
+        # point in the messaging
         if from_type == to_type:
             new_nsn = current_nsn
         else:
-            new_sched = utils.get_schedule(new_msgset_schedule)
-            new_days = new_sched["day_of_week"]
-            new_rate = len(new_days.split(','))  # msgs per week
+            new_rate = utils.get_mirrored_schedule(
+                new_msgset_schedule).messages_per_week
 
             new_nsn = int(current_nsn * new_rate / float(current_rate))
 
@@ -199,62 +252,603 @@ class ImplementAction(Task):
             "lang": change.data.get("new_language", current_sub["lang"]),
             "schedule": new_msgset_schedule
         }
-        SubscriptionRequest.objects.create(**mother_sub)
+        return {"deactivate": subscriptions, "subscription": mother_sub}
+
+    def change_messaging(self, change):
+        plan = self.step(
+            change, 'plan', lambda: self.plan_messaging(change))
+
+        def deactivate():
+            utils.deactivate_subscriptions(plan["deactivate"])
+        self.step(change, 'deactivate_mother', deactivate)
+
+        self.subscribe(change, 'subscribe_mother', plan["subscription"])
 
         return "Change messaging completed"
 
     def change_language(self, change):
-        # Get mother's current subscriptions
-        subscriptions = utils.get_subscriptions(change.mother_id)
-        # Patch subscriptions languages
-        for subscription in subscriptions:
-            utils.patch_subscription(
-                subscription, {"lang": change.data["new_language"]})
-
-        if change.data["household_id"]:
-            # Get household's current subscriptions
-            subscriptions = utils.get_subscriptions(
-                change.data["household_id"])
+        def patch_language():
+            # Get mother's current subscriptions
+            subscriptions = list(utils.get_subscriptions(change.mother_id))
+
+            if change.data["household_id"]:
+                # Get household's current subscriptions
+                subscriptions.extend(utils.get_subscriptions(
+                    change.data["household_id"]))
+
             # Patch subscriptions languages
-            for subscription in subscriptions:
-                utils.patch_subscription(
-                    subscription, {"lang": change.data["new_language"]})
+            utils.patch_subscriptions(
+                subscriptions, {"lang": change.data["new_language"]})
+        self.step(change, 'patch_language', patch_language)
 
         return "Change language completed"
 
     def unsubscribe_household_only(self, change):
-        # Get household's current subscriptions
-        subscriptions = utils.get_subscriptions(
-            change.data["household_id"])
-        # Deactivate subscriptions
-        for subscription in subscriptions:
-            utils.deactivate_subscription(subscription)
+        # Deactivate household's current subscriptions
+        self.deactivate(
+            change, 'deactivate_household', change.data["household_id"])
 
         return "Unsubscribe household completed"
 
     def unsubscribe_mother_only(self, change):
-        # Get mother's current subscriptions
-        subscriptions = utils.get_subscriptions(
-            change.mother_id)
-        # Deactivate subscriptions
-        for subscription in subscriptions:
-            utils.deactivate_subscription(subscription)
+        # Deactivate mother's current subscriptions
+        self.deactivate(change, 'deactivate_mother', change.mother_id)
 
         return "Unsubscribe mother completed"
 
-    def run(self, change_id, **kwargs):
-        """ Implements the appropriate action
-        """
-        change = Change.objects.get(id=change_id)
+    def claim(self, change_id):
+        """ Marks the change as being applied, unless it has already been
+        applied or another worker is applying it. If the worker applying it
+        stops renewing its claim for CHANGE_APPLY_LEASE seconds, it is
+        assumed to have died and the change can be claimed again, which
+        requeue_changes does.
 
-        result = {
+        :returns: whether the change was claimed
+        """
+        now = timezone.now()
+        expired = now - timedelta(seconds=settings.CHANGE_APPLY_LEASE)
+        return Change.objects.filter(
+            Q(state__in=[Change.PENDING, Change.FAILED]) |
+            Q(state=Change.APPLYING, updated_at__lt=expired),
+            id=change_id).update(
+            state=Change.APPLYING, attempts=F('attempts') + 1,
+            updated_at=now) > 0
+
+    def apply_change(self, change):
+        """ Applies a claimed change and records that it has been applied,
+        or that it failed so that it can be retried
+        """
+        action = {
             'change_baby': self.change_baby,
             'change_loss': self.change_loss,
             'change_messaging': self.change_messaging,
             'change_language': self.change_language,
             'unsubscribe_household_only': self.unsubscribe_household_only,
             'unsubscribe_mother_only': self.unsubscribe_mother_only,
-        }.get(change.action, None)(change)
+        }.get(change.action, None)
+        try:
+            result = action(change)
+        except Exception:
+            Change.objects.filter(id=change.id).update(state=Change.FAILED)
+            raise
+        Change.objects.filter(id=change.id).update(
+            state=Change.APPLIED, processed_at=timezone.now())
         return result
 
+    def run(self, change_id, **kwargs):
+        """ Implements the appropriate action
+        """
+        if not self.claim(change_id):
+            return "Change already applied or being applied"
+        change = Change.objects.get(id=change_id)
+        return self.apply_change(change)
+
 implement_action = ImplementAction()
+
+
+class RequeueChanges(Task):
+    """ Queues the changes that won't be applied otherwise: changes whose
+    task was lost, changes whose worker died while applying them, and
+    failed changes that haven't used up their CHANGE_MAX_ATTEMPTS. A change
+    is queued again at most once every CHANGE_RETRY_DELAY, so that a
+    backlog isn't queued again on every run. Scheduled changes go back on
+    the ADMIN_CHANGE_QUEUE queue. Should be run periodically.
+    """
+    name = "hellomama_registration.changes.tasks.requeue_changes"
+
+    def run(self, **kwargs):
+        now = timezone.now()
+        expired = now - timedelta(seconds=settings.CHANGE_APPLY_LEASE)
+        retry = now - timedelta(seconds=settings.CHANGE_RETRY_DELAY)
+        with transaction.atomic():
+            changes = list(Change.objects.select_for_update(
+                skip_locked=True).filter(
+                Q(state=Change.PENDING, scheduled_at__isnull=True,
+                  created_at__lt=retry) |
+                Q(state=Change.PENDING, scheduled_at__lt=retry) |
+                Q(state=Change.APPLYING, updated_at__lt=expired) |
+                Q(state=Change.FAILED, updated_at__lt=retry,
+                  attempts__lt=settings.CHANGE_MAX_ATTEMPTS)).filter(
+                Q(queued_at__isnull=True) | Q(queued_at__lt=retry)).exclude(
+                action__in=settings.CHANGE_BATCH_ACTIONS))
+            Change.objects.filter(
+                id__in=[change.id for change in changes]).update(
+                queued_at=now)
+
+        for change in changes:
+            if change.scheduled_at is not None:
+                implement_action.apply_async(
+                    kwargs={"change_id": str(change.id)},
+                    queue=settings.ADMIN_CHANGE_QUEUE)
+            else:
+                implement_action.apply_async(
+                    kwargs={"change_id": str(change.id)})
+        return "%d change(s) requeued" % len(changes)
+
+requeue_changes = RequeueChanges()
+
+
+class QueueScheduledChanges(Task):
+    """ Queues the scheduled changes that are due within
+    ADMIN_CHANGE_MAX_ETA seconds on the ADMIN_CHANGE_QUEUE queue, to be
+    applied at their scheduled time. They are only queued this close to
+    their time so that the broker doesn't redeliver them while they wait.
+    Should be run at least every ADMIN_CHANGE_MAX_ETA seconds.
+    """
+    name = "hellomama_registration.changes.tasks.queue_scheduled_changes"
+
+    def run(self, **kwargs):
+        now = timezone.now()
+        due = now + timedelta(seconds=settings.ADMIN_CHANGE_MAX_ETA)
+        with transaction.atomic():
+            changes = list(Change.objects.select_for_update(
+                skip_locked=True).filter(
+                state=Change.PENDING, queued_at__isnull=True,
+                scheduled_at__lte=due).order_by('scheduled_at'))
+            Change.objects.filter(
+                id__in=[change.id for change in changes]).update(
+                queued_at=now)
+
+        for change in changes:
+            implement_action.apply_async(
+                kwargs={"change_id": str(change.id)},
+                eta=change.scheduled_at,
+                queue=settings.ADMIN_CHANGE_QUEUE)
+        return "%d scheduled change(s) queued" % len(changes)
+
+queue_scheduled_changes = QueueScheduledChanges()
+
+
+# The external services each action calls, for rate limiting scheduled
+# changes
+ACTION_SERVICES = {
+    'change_baby': ('sbm', 'identity_store'),
+    'change_loss': ('sbm', 'identity_store'),
+    'change_messaging': ('sbm',),
+    'change_language': ('sbm',),
+    'unsubscribe_household_only': ('sbm',),
+    'unsubscribe_mother_only': ('sbm',),
+}
+
+
+def within_admin_change_hours(when):
+    """ Returns the earliest time from `when` that is within
+    ADMIN_CHANGE_HOURS, which can wrap around midnight
+    """
+    if not settings.ADMIN_CHANGE_HOURS:
+        return when
+    start, end = settings.ADMIN_CHANGE_HOURS
+    if start < end:
+        within = start <= when.hour < end
+    else:
+        within = when.hour >= start or when.hour < end
+    if within:
+        return when
+    start_time = when.replace(hour=start, minute=0, second=0, microsecond=0)
+    if start_time < when:
+        start_time += timedelta(days=1)
+    return start_time
+
+
+def reserve_change_slot(action):
+    """ Reserves the earliest time a change for the action can be applied
+    without any of the services it calls going over its ADMIN_CHANGE_RATES
+    rate limit. Services without a positive rate aren't limited.
+
+    :returns: datetime to apply the change at
+    """
+    now = timezone.now()
+    services = [service for service in ACTION_SERVICES.get(action, ())
+                if settings.ADMIN_CHANGE_RATES.get(service, 0) > 0]
+    with transaction.atomic():
+        for service in services:
+            ServiceSlot.objects.get_or_create(
+                service=service, defaults={'next_slot': now})
+        # Locked in a fixed order so that reservations can't deadlock
+        slots = list(ServiceSlot.objects.select_for_update().filter(
+            service__in=services).order_by('service'))
+
+        eta = within_admin_change_hours(
+            max([now] + [slot.next_slot for slot in slots]))
+        for slot in slots:
+            slot.next_slot = eta + timedelta(
+                seconds=1.0 / settings.ADMIN_CHANGE_RATES[slot.service])
+            slot.save(update_fields=['next_slot'])
+    return eta
+
+
+def create_subscription_requests(subscriptions):
+    """ Creates the SubscriptionRequests with a single insert. bulk_create
+    doesn't send post_save, which is what fires the subscriptionrequest.added
+    webhooks, so it is sent for each of them in the same transaction.
+    """
+    requests = [SubscriptionRequest(**subscription)
+                for subscription in subscriptions]
+    with transaction.atomic():
+        SubscriptionRequest.objects.bulk_create(requests)
+        for request in requests:
+            post_save.send(
+                sender=SubscriptionRequest, instance=request, created=True,
+                update_fields=None, raw=False, using='default')
+    return requests
+
+
+class ImplementChangeBatch(Task):
+    """ Applies the pending changes for the actions in CHANGE_BATCH_ACTIONS
+    together, sharing remote lookups between them. Should be run
+    periodically.
+    """
+    name = "hellomama_registration.changes.tasks.implement_change_batch"
+
+    def claim_changes(self, batch_size):
+        """ Claims the next batch of changes, the same way
+        ImplementAction.claim does, so that concurrent batches and
+        implement_action never apply the same change at once.
+        """
+        now = timezone.now()
+        expired = now - timedelta(seconds=settings.CHANGE_APPLY_LEASE)
+        changes = Change.objects.select_for_update(skip_locked=True).filter(
+            Q(state=Change.PENDING) |
+            Q(state=Change.FAILED,
+              attempts__lt=settings.CHANGE_MAX_ATTEMPTS) |
+            Q(state=Change.APPLYING, updated_at__lt=expired),
+            # Scheduled changes wait for their scheduled time
+            Q(scheduled_at__isnull=True) | Q(scheduled_at__lte=now),
+            action__in=settings.CHANGE_BATCH_ACTIONS,
+            processed_at__isnull=True)
+        with transaction.atomic():
+            changes = list(changes.order_by('created_at')[:batch_size])
+            Change.objects.filter(
+                id__in=[change.id for change in changes]).update(
+                state=Change.APPLYING, attempts=F('attempts') + 1,
+                updated_at=now)
+        return changes
+
+    def prefetch_mothers(self, mother_ids):
+        """ Fetches each mother's identity and active subscriptions
+        concurrently.
+
+        :returns: dict of mother id to (identity, subscriptions, error)
+        """
+        def prefetch(mother_id):
+            try:
+                return (utils.get_identity(mother_id),
+                        list(utils.get_subscriptions(mother_id)), None)
+            except Exception as error:
+                return None, None, error
+
+        mother_ids = list(mother_ids)
+        pool = ThreadPool(settings.CHANGE_BATCH_WORKERS)
+        try:
+            return dict(zip(mother_ids, pool.map(prefetch, mother_ids)))
+        finally:
+            pool.close()
+
+    def change_baby_batch(self, changes):
+        """ The batch version of ImplementAction.change_baby. Like it, each
+        step is checkpointed on the changes, so that a batch that is run
+        again skips the steps that were already done.
+
+        :returns: dict of change id to error, for the changes that failed
+        """
+        by_mother = {}
+        for change in changes:
+            if 'subscribe_mother' not in change.steps:
+                by_mother.setdefault(change.mother_id, []).append(change)
+
+        prefetched = self.prefetch_mothers(by_mother)
+
+        failed = {}
+        mothers = {}
+        for mother_id, (identity, subscriptions, error) in prefetched.items():
+            if error is None:
+                mothers[mother_id] = identity
+            else:
+                failed[mother_id] = error
+
+        # Deactivate all the mothers' subscriptions together
+        deactivate = [
+            mother_id for mother_id in mothers
+            if not all('deactivate_mother' in change.steps
+                       for change in by_mother[mother_id])]
+        try:
+            utils.deactivate_subscriptions(
+                subscription
+                for mother_id in deactivate
+                for subscription in prefetched[mother_id][1])
+        except utils.SubscriptionPatchError as error:
+            for subscription, patch_error in error.failures:
+                failed[subscription['identity']] = patch_error
+                mothers.pop(subscription['identity'], None)
+        for mother_id in deactivate:
+            if mother_id in mothers:
+                for change in by_mother[mother_id]:
+                    implement_action.record_step(
+                        change, 'deactivate_mother', None)
+
+        # The latest prebirth registration for each mother
+        registrations = {}
+        for registration in Registration.objects.filter(
+                mother_id__in=list(mothers), stage='prebirth').order_by(
+                'mother_id', '-created_at'):
+            registrations.setdefault(registration.mother_id, registration)
+
+        # Every mother moves to week 0 of postbirth, so each messageset only
+        # has to be resolved once for the whole batch
+        stage = 'postbirth'
+        weeks = 0
+        messagesets = {}
+
+        def get_messageset(short_name):
+            if short_name not in messagesets:
+                messagesets[short_name] = \
+                    utils.get_messageset_schedule_sequence(short_name, weeks)
+            return messagesets[short_name]
+
+        subscriptions = []
+        for mother_id, mother in mothers.items():
+            try:
+                mother_short_name = utils.get_messageset_short_name(
+                    stage, 'mother', mother["details"]["preferred_msg_type"],
+                    weeks, mother["details"].get("preferred_msg_days"),
+                    mother["details"].get("preferred_msg_times"))
+                msgset_id, msgset_schedule, next_sequence_number = \
+                    get_messageset(mother_short_name)
+                mother_subscriptions = [('subscribe_mother', {
+                    "identity": mother_id,
+                    "messageset": msgset_id,
+                    "next_sequence_number": next_sequence_number,
+                    "lang": mother["details"]["preferred_language"],
+                    "schedule": msgset_schedule
+                })]
+
+                registration = registrations.get(mother_id)
+                if registration is not None and \
+                        registration.data["msg_receiver"] != 'mother_only':
+                    household_short_name = utils.get_messageset_short_name(
+                        stage, 'household',
+                        mother["details"]["preferred_msg_type"], weeks,
+                        "fri", "9_11")
+                    msgset_id, msgset_schedule, next_sequence_number = \
+                        get_messageset(household_short_name)
+                    mother_subscriptions.append(('subscribe_household', {
+                        "identity": mother["details"]["linked_to"],
+                        "messageset": msgset_id,
+                        "next_sequence_number": next_sequence_number,
+                        "lang": mother["details"]["preferred_language"],
+                        "schedule": msgset_schedule
+                    }))
+            except Exception as error:
+                failed[mother_id] = error
+                continue
+            subscriptions.extend(
+                (mother_id, step, subscription)
+                for step, subscription in mother_subscriptions)
+
+        # The subscription requests are recorded as steps in the same
+        # transaction as they are created, so they are never created twice
+        with transaction.atomic():
+            requests = create_subscription_requests(
+                subscription for mother_id, step, subscription
+                in subscriptions)
+            for (mother_id, step, subscription), request in zip(
+                    subscriptions, requests):
+                for change in by_mother[mother_id]:
+                    implement_action.record_step(
+                        change, step, str(request.id))
+
+        return dict(
+            (change.id, failed[change.mother_id]) for change in changes
+            if change.mother_id in failed)
+
+    def apply_changes(self, changes):
+        """ Applies claimed changes that have no batch version one by one.
+
+        :returns: dict of change id to error, for the changes that failed
+        """
+        failed = {}
+        for change in changes:
+            try:
+                implement_action.apply_change(change)
+            except Exception as error:
+                failed[change.id] = error
+        return failed
+
+    def run(self, batch_size=None, **kwargs):
+        changes = self.claim_changes(
+            batch_size or settings.CHANGE_BATCH_SIZE)
+
+        by_action = {}
+        for change in changes:
+            by_action.setdefault(change.action, []).append(change)
+
+        failed = {}
+        applied = []
+        for action, action_changes in by_action.items():
+            if action == 'change_baby':
+                action_failed = self.change_baby_batch(action_changes)
+                applied.extend(
+                    change.id for change in action_changes
+                    if change.id not in action_failed)
+                Change.objects.filter(id__in=list(action_failed)).update(
+                    state=Change.FAILED)
+            else:
+                # apply_change records the changes it processed itself
+                action_failed = self.apply_changes(action_changes)
+            failed.update(action_failed)
+
+        Change.objects.filter(id__in=applied).update(
+            state=Change.APPLIED, processed_at=timezone.now())
+
+        for change_id, error in failed.items():
+            logger.warning(
+                "Change %s could not be applied: %s" % (change_id, error))
+
+        return "%d change(s) applied, %d failed" % (
+            len(changes) - len(failed), len(failed))
+
+implement_change_batch = ImplementChangeBatch()
+
+
+def processed_optouts():
+    """ The optouts whose metrics have already been fired. The totals are
+    seeded from these only, so that an optout that is still queued isn't
+    counted both in the seed and when it is processed.
+    """
+    return Optout.objects.filter(processed_at__isnull=False)
+
+
+def fire_optout_reason_metric(reason):
+    from registrations.tasks import fire_metric
+
+    if reason not in settings.OPTOUT_REASONS:
+        reason = 'other'
+
+    fire_metric.apply_async(kwargs={
+        "metric_name": 'optout.reason.%s.sum' % reason,
+        "metric_value": 1.0
+    })
+
+    def count_optouts_reason():
+        if reason == 'other':
+            # Unknown reasons are counted as other
+            return processed_optouts().exclude(
+                reason__in=set(settings.OPTOUT_REASONS) - {'other'}).count()
+        return processed_optouts().filter(reason=reason).count()
+
+    total_key = 'optout.reason.%s.total.last' % reason
+    total = get_or_incr_cache(
+        total_key,
+        count_optouts_reason)
+    fire_metric.apply_async(kwargs={
+        'metric_name': total_key,
+        'metric_value': total,
+    })
+
+
+def fire_optout_source_metric(source):
+    from registrations.tasks import fire_metric
+
+    # remove the _public part
+    source_short = source.split('_')[0]
+
+    fire_metric.apply_async(kwargs={
+        "metric_name": 'optout.source.%s.sum' % source_short,
+        "metric_value": 1.0
+    })
+
+    def count_optouts_source():
+        return processed_optouts().filter(
+            Q(source=source_short) |
+            Q(source__startswith='%s_' % source_short)).count()
+
+    total_key = 'optout.source.%s.total.last' % source_short
+    total = get_or_incr_cache(
+        total_key,
+        count_optouts_source)
+    fire_metric.apply_async(kwargs={
+        'metric_name': total_key,
+        'metric_value': total,
+    })
+
+
+def fire_optout_receiver_type_metric(msg_receiver):
+    from registrations.tasks import fire_metric
+
+    fire_metric.apply_async(kwargs={
+        "metric_name": 'optout.receiver_type.%s.sum' % msg_receiver,
+        "metric_value": 1.0
+    })
+
+    total_key = 'optout.receiver_type.%s.total.last' % msg_receiver
+    total = get_or_incr_cache(
+        total_key,
+        processed_optouts().filter(msg_receiver=msg_receiver).count)
+    fire_metric.apply_async(kwargs={
+        'metric_name': total_key,
+        'metric_value': total,
+    })
+
+
+def fire_optout_message_type_metric(msg_type):
+    from registrations.tasks import fire_metric
+
+    fire_metric.apply_async(kwargs={
+        "metric_name": 'optout.msg_type.%s.sum' % msg_type,
+        "metric_value": 1.0
+    })
+
+    total_key = 'optout.msg_type.%s.total.last' % msg_type
+    total = get_or_incr_cache(
+        total_key,
+        processed_optouts().filter(msg_type=msg_type).count)
+    fire_metric.apply_async(kwargs={
+        'metric_name': total_key,
+        'metric_value': total,
+    })
+
+
+class ProcessOptout(Task):
+    """ Records which registration an optout received from the Identity
+    Store applied to, and fires the optout metrics for it. Each optout is
+    only processed once, however many times the task is delivered, and is
+    only marked processed once its metrics have been fired, so that an
+    optout whose metrics fail is retried.
+    """
+    name = "hellomama_registration.changes.tasks.process_optout"
+    default_retry_delay = 60
+
+    def run(self, optout_id, **kwargs):
+        try:
+            with transaction.atomic():
+                optout = Optout.objects.select_for_update().get(id=optout_id)
+                if optout.processed_at is not None:
+                    return "Optout already processed"
+
+                registration = Optout.get_registration(optout.identity)
+                optout.set_registration(registration)
+                # Marked processed first so that the totals count it, which
+                # is rolled back if firing the metrics fails
+                optout.processed_at = timezone.now()
+                optout.save(update_fields=[
+                    'msg_type', 'msg_receiver', 'processed_at'])
+
+                if registration is not None:
+                    self.fire_metrics(optout)
+        except Exception as error:
+            raise self.retry(exc=error)
+
+        return "Optout processed"
+
+    def fire_metrics(self, optout):
+        if optout.msg_receiver:
+            fire_optout_receiver_type_metric(optout.msg_receiver)
+
+        fire_optout_reason_metric(optout.reason)
+
+        if optout.msg_type:
+            fire_optout_message_type_metric(optout.msg_type)
+
+        fire_optout_source_metric(optout.source)
+
+process_optout = ProcessOptout()
@@ -0,0 +1,67 @@
+import responses
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.core import management
+
+from .models import Optout
+from .tests import AuthenticatedAPITestCase
+
+
+class BackfillOptoutsCommand(AuthenticatedAPITestCase):
+    @responses.activate
+    def test_backfill_optouts(self):
+        """
+        Optouts from the Identity Store that aren't in the ledger yet should
+        be recorded, going by their optout ids
+        """
+        stdout, stderr = StringIO(), StringIO()
+        registration = self.make_registration_mother_only()
+        Optout.objects.create(
+            optout_id="2", identity="mother01-9d89-4aa6-99ff-13c225365b5d",
+            reason="not_useful", source="ussd_public")
+
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/optouts/search/',
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": 1,
+                    "identity": registration.mother_id,
+                    "optout_type": "stop",
+                    "optout_reason": "miscarriage",
+                    "optout_source": "ussd_public",
+                }, {
+                    "id": 2,
+                    "identity": "mother01-9d89-4aa6-99ff-13c225365b5d",
+                    "optout_type": "stop",
+                    "optout_reason": "not_useful",
+                    "optout_source": "ussd_public",
+                }, {
+                    "id": 3,
+                    "identity": "mother01-9d89-4aa6-99ff-13c225365b5d",
+                    "optout_type": "stop",
+                    "optout_reason": "not_useful",
+                    "optout_source": "ussd_public",
+                }]
+            },
+            status=200, content_type='application/json',
+            match_querystring=False
+        )
+
+        management.call_command("backfill_optouts",
+                                stdout=stdout, stderr=stderr)
+
+        self.assertEqual(stderr.getvalue(), '')
+        self.assertEqual(stdout.getvalue().strip(), 'Recorded 2 optouts.')
+        self.assertEqual(
+            sorted(Optout.objects.values_list('optout_id', flat=True)),
+            ["1", "2", "3"])
+        optout = Optout.objects.get(optout_id="1")
+        self.assertEqual(optout.reason, "miscarriage")
+        self.assertEqual(optout.msg_type, "text")
+        self.assertEqual(optout.msg_receiver, "mother_only")
@@ -0,0 +1,258 @@
+"""
+Throughput benchmark for applying changes.
+
+Each action type is applied to a batch of changes against in-process fakes
+of the identity store, the stage based messaging service and the message
+sender. The fakes can be made slow or unreliable, to see how the actions
+behave when the real services are. For each action the number of changes
+applied per second, and the outbound HTTP calls and database queries for
+each change, are recorded.
+
+The benchmark is configured with environment variables:
+
+    CHANGE_BENCHMARK_SIZE: changes applied per action (default 20)
+    CHANGE_BENCHMARK_LATENCY: seconds each fake call takes (default 0)
+    CHANGE_BENCHMARK_FAILURE_RATE: share of fake calls that fail with a 500
+        (default 0)
+    CHANGE_BENCHMARK_REPORT: file path to write the measurements to as
+        JSON, so that they can be compared across commits
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import responses
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from registrations.models import (
+    Source, Registration, MirroredMessageset, MirroredSchedule)
+from .models import Change
+from .tasks import implement_action
+
+
+CHANGE_BENCHMARK_SIZE = int(os.environ.get('CHANGE_BENCHMARK_SIZE', '20'))
+CHANGE_BENCHMARK_LATENCY = float(
+    os.environ.get('CHANGE_BENCHMARK_LATENCY', '0'))
+CHANGE_BENCHMARK_FAILURE_RATE = float(
+    os.environ.get('CHANGE_BENCHMARK_FAILURE_RATE', '0'))
+
+HOUSEHOLD_ID = "4038a518-2940-4b15-9c5c-829385793255"
+
+# The data each action is benchmarked with
+ACTIONS = (
+    ('change_baby', {}),
+    ('change_loss', {"reason": "miscarriage"}),
+    ('change_messaging', {
+        "new_short_name": "prebirth.mother.audio.10_42.tue_thu.9_11"}),
+    ('change_language', {
+        "household_id": HOUSEHOLD_ID, "new_language": "ibo_NG"}),
+    ('unsubscribe_household_only', {
+        "household_id": HOUSEHOLD_ID, "reason": "not_useful"}),
+    ('unsubscribe_mother_only', {"reason": "not_useful"}),
+)
+
+
+class FakeServices(object):
+    """
+    Fakes of the identity store, stage based messaging service and message
+    sender, installed with responses. Every identity has one active
+    subscription, and any messageset short name exists.
+    """
+    def __init__(self, latency=0, failure_rate=0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.messagesets = {'prebirth.mother.text.10_42': 1}
+
+    def install(self, mock):
+        ids = r'http://localhost:8001/api/v1'
+        sbm = r'http://localhost:8005/api/v1'
+        ms = r'http://localhost:8006/api/v1'
+        routes = (
+            ('GET', ids + r'/identities/([^/]+)/$', self.identity),
+            ('GET', sbm + r'/subscriptions/', self.subscriptions),
+            ('PATCH', sbm + r'/subscriptions/([^/]+)/', self.subscription),
+            ('GET', sbm + r'/messageset/(\d+)/', self.messageset),
+            ('GET', sbm + r'/messageset/', self.messageset_search),
+            ('GET', sbm + r'/schedule/(\d+)/', self.schedule),
+            ('POST', ms + r'/outbound/', lambda request: {"id": 1}),
+            ('POST', r'http://metrics-url/metrics/', lambda request: {}),
+        )
+        for method, url, handler in routes:
+            mock.add_callback(
+                method, re.compile(url), callback=self.wrap(handler),
+                content_type='application/json')
+
+    def wrap(self, handler):
+        def callback(request):
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                failed = self.random.random() < self.failure_rate
+            if failed:
+                return (500, {}, json.dumps({"detail": "Fake failure"}))
+            return (200, {}, json.dumps(handler(request)))
+        return callback
+
+    def paginated(self, results):
+        return {"next": None, "previous": None, "results": results}
+
+    def match(self, request, pattern):
+        return re.search(pattern, request.url).group(1)
+
+    def identity(self, request):
+        return {
+            "id": self.match(request, r'/identities/([^/]+)/'),
+            "details": {
+                "preferred_language": "eng_NG",
+                "preferred_msg_type": "text",
+                "linked_to": HOUSEHOLD_ID,
+            },
+        }
+
+    def subscriptions(self, request):
+        identity = self.match(request, r'identity=([^&]+)')
+        return self.paginated([{
+            "id": identity,
+            "identity": identity,
+            "active": True,
+            "lang": "eng_NG",
+            "next_sequence_number": 54,
+            "messageset": 1,
+            "schedule": 1,
+        }])
+
+    def subscription(self, request):
+        subscription = json.loads(request.body)
+        subscription["id"] = self.match(
+            request, r'/subscriptions/([^/]+)/')
+        return subscription
+
+    def messageset(self, request):
+        messageset_id = int(self.match(request, r'/messageset/(\d+)/'))
+        short_name = next(
+            short_name for short_name, known_id in self.messagesets.items()
+            if known_id == messageset_id)
+        return {"id": messageset_id, "short_name": short_name,
+                "default_schedule": 1}
+
+    def messageset_search(self, request):
+        short_name = self.match(request, r'short_name=([^&]+)')
+        with self.lock:
+            messageset_id = self.messagesets.setdefault(
+                short_name, len(self.messagesets) + 1)
+        return self.paginated([{
+            "id": messageset_id, "short_name": short_name,
+            "default_schedule": 1}])
+
+    def schedule(self, request):
+        schedule_id = int(self.match(request, r'/schedule/(\d+)/'))
+        return {"id": schedule_id, "day_of_week": "1,3"}
+
+
+class ChangeThroughputBenchmark(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user(
+            'benchmarkuser', 'benchmarkuser@example.com', 'benchmarkpass')
+        self.source = Source.objects.create(
+            name='benchmark', authority='hw_full', user=user)
+
+    def make_changes(self, action, data, count):
+        """
+        Creates the changes without sending post_save, so that they are
+        only applied when the benchmark applies them. Each mother has a
+        registration with a household receiver.
+        """
+        mother_ids = ["%08d-0000-4000-8000-000000000000" % i
+                      for i in range(count)]
+        Registration.objects.bulk_create(
+            Registration(
+                mother_id=mother_id, stage='prebirth', source=self.source,
+                data={"msg_receiver": "mother_father", "msg_type": "text",
+                      "language": "eng_NG"})
+            for mother_id in mother_ids)
+        changes = [
+            Change(mother_id=mother_id, action=action, data=dict(data),
+                   source=self.source)
+            for mother_id in mother_ids]
+        Change.objects.bulk_create(changes)
+        return changes
+
+    def measure(self, action, data, count, latency, failure_rate):
+        """
+        Applies count changes for the action one after another, as a worker
+        would, starting from empty caches and an empty messageset catalog.
+        """
+        changes = self.make_changes(action, data, count)
+        cache.clear()
+        MirroredMessageset.objects.all().delete()
+        MirroredSchedule.objects.all().delete()
+
+        mock = responses.RequestsMock(assert_all_requests_are_fired=False)
+        FakeServices(latency, failure_rate).install(mock)
+        failed = 0
+        with mock, CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            for change in changes:
+                try:
+                    implement_action(change_id=str(change.id))
+                except Exception:
+                    failed += 1
+            seconds = time.time() - start
+            http_calls = len(mock.calls)
+
+        return {
+            'changes': count,
+            'failed': failed,
+            'seconds': seconds,
+            'changes_per_second': count / seconds if seconds else None,
+            'http_calls_per_change': http_calls / float(count),
+            'queries_per_change': len(queries) / float(count),
+        }
+
+    def test_change_throughput(self):
+        measurements = {}
+        for action, data in ACTIONS:
+            measurements[action] = self.measure(
+                action, data, CHANGE_BENCHMARK_SIZE, CHANGE_BENCHMARK_LATENCY,
+                CHANGE_BENCHMARK_FAILURE_RATE)
+
+        report_path = os.environ.get('CHANGE_BENCHMARK_REPORT')
+        if report_path:
+            with open(report_path, 'w') as report:
+                json.dump({
+                    'size': CHANGE_BENCHMARK_SIZE,
+                    'latency': CHANGE_BENCHMARK_LATENCY,
+                    'failure_rate': CHANGE_BENCHMARK_FAILURE_RATE,
+                    'actions': measurements,
+                }, report, indent=2, sort_keys=True)
+
+        if not CHANGE_BENCHMARK_FAILURE_RATE:
+            self.assertEqual(
+                dict((action, result['failed'])
+                     for action, result in measurements.items()),
+                dict((action, 0) for action, data in ACTIONS))
+            self.assertFalse(
+                Change.objects.filter(processed_at__isnull=True).exists())
+
+    def test_fake_failures(self):
+        """
+        Changes that can't reach the fake services fail, and aren't marked
+        as processed.
+        """
+        result = self.measure(
+            'unsubscribe_mother_only', {"reason": "not_useful"}, 3,
+            latency=0, failure_rate=1)
+
+        self.assertEqual(result['failed'], 3)
+        self.assertEqual(
+            Change.objects.filter(processed_at__isnull=True).count(), 3)
@@ -2,9 +2,16 @@ import datetime
 import json
 import responses
 
-from django.test import TestCase, RequestFactory
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+from django.test import TestCase, RequestFactory, override_settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db.models.signals import post_save
+from django.utils import timezone
 
 from rest_framework import status
 from rest_framework.test import APIClient
@@ -12,16 +19,22 @@ from rest_framework.authtoken.models import Token
 from rest_hooks.models import model_saved
 
 from hellomama_registration import utils
+from registrations.tasks import refresh_messageset_cache
 from registrations.models import (
-    Source, Registration, SubscriptionRequest, registration_post_save,
+    Source, Registration, SubscriptionRequest, MirroredMessageset,
+    MirroredSchedule, registration_post_save,
     fire_created_metric, fire_unique_operator_metric, fire_message_type_metric,
     fire_receiver_type_metric, fire_source_metric, fire_language_metric,
     fire_state_metric, fire_role_metric)
 from .models import (
-    Change, change_post_save, fire_language_change_metric,
+    Change, Optout, ServiceSlot, change_post_save, fire_language_change_metric,
     fire_baby_change_metric, fire_loss_change_metric,
     fire_message_change_metric)
-from .tasks import implement_action
+from .views import changes_created
+from .tasks import (
+    implement_action, implement_change_batch, process_optout,
+    reserve_change_slot, within_admin_change_hours, requeue_changes,
+    queue_scheduled_changes)
 
 
 def override_get_today():
@@ -206,6 +219,7 @@ class AuthenticatedAPITestCase(APITestCase):
 
     def setUp(self):
         super(AuthenticatedAPITestCase, self).setUp()
+        cache.clear()
         self._replace_post_save_hooks_change()
         self._replace_post_save_hooks_registration()
 
@@ -1635,6 +1649,66 @@ class TestChangeMessaging(AuthenticatedAPITestCase):
         self.assertEqual(d.next_sequence_number, 6)
         self.assertEqual(d.schedule, 1)
 
+    @responses.activate
+    def test_change_messaging_from_catalog(self):
+        """
+        If the messagesets and schedules have been synced, the new sequence
+        number is worked out without asking the SBM for them
+        """
+        MirroredMessageset.objects.create(
+            id=1, short_name='prebirth.mother.text.10_42', default_schedule=1)
+        MirroredMessageset.objects.create(
+            id=4, short_name='prebirth.mother.audio.10_42.tue_thu.9_11',
+            default_schedule=6)
+        MirroredSchedule.objects.create(
+            id=1, day_of_week="1,3,5", messages_per_week=3)
+        MirroredSchedule.objects.create(
+            id=6, day_of_week="2,4", messages_per_week=2)
+
+        change = Change.objects.create(
+            mother_id="846877e6-afaa-43de-acb1-09f61ad4de99",
+            action="change_messaging",
+            data={
+                "new_short_name": "prebirth.mother.audio.10_42.tue_thu.9_11"
+            },
+            source=self.make_source_adminuser())
+        subscription_id = "07f4d95c-ad78-4bf1-8779-c47b428e89d0"
+        query_string = '?active=True&identity=%s' % change.mother_id
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/subscriptions/%s' % query_string,
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": subscription_id,
+                    "identity": change.mother_id,
+                    "active": True,
+                    "lang": "eng_NG",
+                    "next_sequence_number": 54,
+                    "messageset": 1,
+                    "schedule": 1
+                }],
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+        responses.add(
+            responses.PATCH,
+            'http://localhost:8005/api/v1/subscriptions/%s/' % subscription_id,
+            json={"active": False},
+            status=200, content_type='application/json',
+        )
+
+        result = implement_action.apply_async(args=[change.id])
+
+        self.assertEqual(result.get(), "Change messaging completed")
+        d = SubscriptionRequest.objects.last()
+        self.assertEqual(d.messageset, 4)
+        self.assertEqual(d.next_sequence_number, 36)
+        self.assertEqual(d.schedule, 6)
+        self.assertEqual(len(responses.calls), 2)
+
 
 class TestChangeBaby(AuthenticatedAPITestCase):
 
@@ -2084,6 +2158,141 @@ class TestChangeBaby(AuthenticatedAPITestCase):
         self.assertEqual(d.schedule, 1)
 
 
+class TestChangeBabyBatch(AuthenticatedAPITestCase):
+
+    def mock_mother(self, mother_id, subscription_id):
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/subscriptions/'
+            '?active=True&identity=%s' % mother_id,
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": subscription_id,
+                    "identity": mother_id,
+                    "active": True,
+                    "lang": "eng_NG"
+                }],
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+        responses.add(
+            responses.PATCH,
+            'http://localhost:8005/api/v1/subscriptions/%s/' % subscription_id,
+            json={"active": False},
+            status=200, content_type='application/json',
+        )
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/%s/' % mother_id,
+            json={
+                "id": mother_id,
+                "version": 1,
+                "details": {
+                    "default_addr_type": "msisdn",
+                    "receiver_role": "mother",
+                    "linked_to": None,
+                    "preferred_msg_type": "audio",
+                    "preferred_msg_days": "mon_wed",
+                    "preferred_msg_times": "9_11",
+                    "preferred_language": "hau_NG"
+                },
+            },
+            status=200, content_type='application/json',
+        )
+
+    @responses.activate
+    @override_settings(CHANGE_BATCH_ACTIONS=['change_baby'])
+    def test_change_baby_batch(self):
+        # Setup
+        self.make_registration_mother_only()
+        source = self.make_source_adminuser()
+        mother_ids = [
+            "846877e6-afaa-43de-acb1-09f61ad4de99",
+            "957988f7-afaa-43de-acb1-09f61ad4de99",
+        ]
+        for i, mother_id in enumerate(mother_ids):
+            Change.objects.create(
+                mother_id=mother_id, action="change_baby", data={},
+                source=source)
+            self.mock_mother(
+                mother_id, "%d7f4d95c-ad78-4bf1-8779-c47b428e89d0" % i)
+        # mock mother messageset lookup
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/messageset/'
+            '?short_name=postbirth.mother.audio.0_12.mon_wed.9_11',
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": 2,
+                    "short_name": 'postbirth.mother.audio.0_12.mon_wed.9_11',
+                    "default_schedule": 4
+                }]
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+        # mock mother schedule lookup
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/schedule/4/',
+            json={"id": 4, "day_of_week": "1,3"},
+            status=200, content_type='application/json',
+        )
+
+        # Execute
+        result = implement_change_batch.apply_async()
+
+        # Check
+        self.assertEqual(result.get(), "2 change(s) applied, 0 failed")
+        # The messageset and schedule are only looked up once
+        self.assertEqual(len(responses.calls), 8)
+        self.assertEqual(
+            sorted(SubscriptionRequest.objects.values_list(
+                'identity', 'messageset', 'next_sequence_number', 'lang',
+                'schedule')),
+            [(mother_id, 2, 1, "hau_NG", 4) for mother_id in mother_ids])
+        self.assertFalse(
+            Change.objects.filter(processed_at__isnull=True).exists())
+
+        # Applied changes aren't picked up again
+        result = implement_change_batch.apply_async()
+        self.assertEqual(result.get(), "0 change(s) applied, 0 failed")
+
+    @responses.activate
+    @override_settings(CHANGE_BATCH_ACTIONS=['change_baby'])
+    def test_change_baby_batch_claims(self):
+        """
+        The batch should skip changes that are being applied elsewhere, and
+        the steps that a batch that died already completed
+        """
+        source = self.make_source_adminuser()
+        Change.objects.create(
+            mother_id="846877e6-afaa-43de-acb1-09f61ad4de99",
+            action="change_baby", data={}, source=source,
+            state=Change.APPLYING)
+        retried = Change.objects.create(
+            mother_id="957988f7-afaa-43de-acb1-09f61ad4de99",
+            action="change_baby", data={}, source=source,
+            state=Change.APPLYING, steps={
+                "deactivate_mother": None,
+                "subscribe_mother": "1b47bab8-1c37-44a2-94e6-85c3ee9a8c8b"})
+        Change.objects.filter(id=retried.id).update(
+            updated_at=timezone.now() - datetime.timedelta(hours=1))
+
+        result = implement_change_batch.apply_async()
+
+        self.assertEqual(result.get(), "1 change(s) applied, 0 failed")
+        self.assertEqual(len(responses.calls), 0)
+        self.assertFalse(SubscriptionRequest.objects.exists())
+        self.assertEqual(
+            Change.objects.filter(state=Change.APPLIED).get().id, retried.id)
+
+
 class TestChangeLanguage(AuthenticatedAPITestCase):
 
     @responses.activate
@@ -2319,6 +2528,62 @@ class TestChangeUnsubscribeMother(AuthenticatedAPITestCase):
         self.assertEqual(result.get(), "Unsubscribe mother completed")
         assert len(responses.calls) == 2
 
+    @responses.activate
+    def test_unsubscribe_mother_partial_failure(self):
+        # Setup
+        change = Change.objects.create(
+            mother_id="846877e6-afaa-43de-acb1-09f61ad4de99",
+            action="unsubscribe_mother_only",
+            data={"reason": "miscarriage"},
+            source=self.make_source_adminuser())
+        subscription_ids = [
+            "07f4d95c-ad78-4bf1-8779-c47b428e89d0",
+            "18f4d95c-ad78-4bf1-8779-c47b428e89d0",
+        ]
+        query_string = '?active=True&identity=%s' % change.mother_id
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/subscriptions/%s' % query_string,
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": subscription_id,
+                    "identity": change.mother_id,
+                    "active": True,
+                    "lang": "eng_NG"
+                } for subscription_id in subscription_ids],
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+        responses.add(
+            responses.PATCH,
+            'http://localhost:8005/api/v1/subscriptions/%s/' %
+            subscription_ids[0],
+            json={"active": False},
+            status=200, content_type='application/json',
+        )
+        responses.add(
+            responses.PATCH,
+            'http://localhost:8005/api/v1/subscriptions/%s/' %
+            subscription_ids[1],
+            json={"detail": "Invalid"},
+            status=400, content_type='application/json',
+        )
+
+        # Execute
+        with self.assertRaises(utils.SubscriptionPatchError) as error:
+            implement_action.unsubscribe_mother_only(change)
+
+        # Check
+        # Both subscriptions are attempted, and only the failure is reported
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(
+            [subscription['id'] for subscription, _ in
+             error.exception.failures],
+            [subscription_ids[1]])
+
 
 class TestChangeLoss(AuthenticatedAPITestCase):
 
@@ -2761,6 +3026,287 @@ class TestChangeLoss(AuthenticatedAPITestCase):
         self.assertEqual(d.schedule, 1)
 
 
+class TestChangeRetries(AuthenticatedAPITestCase):
+
+    def make_change_loss(self):
+        self.make_registration_mother_only()
+        return Change.objects.create(
+            mother_id="846877e6-afaa-43de-acb1-09f61ad4de99",
+            action="change_loss", data={"reason": "miscarriage"},
+            source=self.make_source_adminuser())
+
+    @responses.activate
+    def test_retry_skips_completed_steps(self):
+        """
+        If applying a change fails part of the way through, retrying it
+        should only do the steps that weren't completed
+        """
+        change = self.make_change_loss()
+        subscription_id = "07f4d95c-ad78-4bf1-8779-c47b428e89d0"
+        query_string = '?active=True&identity=%s' % change.mother_id
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/subscriptions/%s' % query_string,
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": subscription_id,
+                    "identity": change.mother_id,
+                    "active": True,
+                    "lang": "eng_NG"
+                }],
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+        responses.add(
+            responses.PATCH,
+            'http://localhost:8005/api/v1/subscriptions/%s/' % subscription_id,
+            json={"active": False},
+            status=200, content_type='application/json',
+        )
+
+        # The identity store is down for the first attempt
+        identity_calls = []
+
+        def identity_callback(request):
+            identity_calls.append(request)
+            if len(identity_calls) == 1:
+                return (500, {}, json.dumps({"detail": "Unavailable"}))
+            return (200, {}, json.dumps({
+                "id": change.mother_id,
+                "details": {
+                    "linked_to": None,
+                    "preferred_msg_type": "text",
+                    "preferred_language": "hau_NG"
+                },
+            }))
+        responses.add_callback(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/%s/' % change.mother_id,
+            callback=identity_callback, content_type='application/json')
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/messageset/'
+            '?short_name=miscarriage.mother.text.0_2',
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": 18,
+                    "short_name": 'miscarriage.mother.text.0_2',
+                    "default_schedule": 1
+                }]
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/schedule/1/',
+            json={"id": 1, "day_of_week": "1,3,5"},
+            status=200, content_type='application/json',
+        )
+
+        with self.assertRaises(Exception):
+            implement_action(change_id=str(change.id))
+
+        change.refresh_from_db()
+        self.assertEqual(change.state, Change.FAILED)
+        self.assertEqual(list(change.steps), ['deactivate_mother'])
+
+        self.assertEqual(
+            implement_action(change_id=str(change.id)),
+            "Change loss completed")
+
+        change.refresh_from_db()
+        self.assertEqual(change.state, Change.APPLIED)
+        self.assertIsNotNone(change.processed_at)
+        self.assertEqual(
+            sorted(change.steps), ['deactivate_mother', 'subscribe_mother'])
+        self.assertEqual(SubscriptionRequest.objects.count(), 1)
+        # The subscriptions were only looked up and deactivated once
+        self.assertEqual(
+            [call.request.method for call in responses.calls
+             if 'subscriptions' in call.request.url], ['GET', 'PATCH'])
+
+    def test_applied_change_is_skipped(self):
+        """
+        A change that has already been applied shouldn't be applied again
+        when its task is delivered again
+        """
+        change = self.make_change_loss()
+        Change.objects.filter(id=change.id).update(state=Change.APPLIED)
+
+        self.assertEqual(
+            implement_action(change_id=str(change.id)),
+            "Change already applied or being applied")
+
+    def test_claim_expires(self):
+        """
+        A change that is being applied can only be claimed by another worker
+        once the claim hasn't been renewed for CHANGE_APPLY_LEASE seconds
+        """
+        change = self.make_change_loss()
+
+        self.assertTrue(implement_action.claim(change.id))
+        self.assertFalse(implement_action.claim(change.id))
+
+        Change.objects.filter(id=change.id).update(
+            updated_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertTrue(implement_action.claim(change.id))
+        change.refresh_from_db()
+        self.assertEqual(change.attempts, 2)
+
+    @override_settings(CHANGE_APPLY_LEASE=600, CHANGE_RETRY_DELAY=300,
+                       CHANGE_MAX_ATTEMPTS=3)
+    def test_requeue_changes(self):
+        """
+        Changes that were lost, abandoned or failed should be queued again,
+        once every CHANGE_RETRY_DELAY, until they run out of attempts
+        """
+        source = self.make_source_adminuser()
+        hour_ago = timezone.now() - datetime.timedelta(hours=1)
+
+        def make_change(**kwargs):
+            change = Change.objects.create(
+                mother_id="846877e6-afaa-43de-acb1-09f61ad4de99",
+                action="unsubscribe_mother_only", data={}, source=source,
+                **kwargs)
+            Change.objects.filter(id=change.id).update(
+                created_at=hour_ago, updated_at=hour_ago)
+            return change
+
+        lost = make_change()
+        abandoned = make_change(state=Change.APPLYING)
+        failed = make_change(state=Change.FAILED, attempts=1)
+        make_change(state=Change.FAILED, attempts=3)
+        make_change(state=Change.APPLIED)
+        make_change(scheduled_at=timezone.now() + datetime.timedelta(hours=1))
+        Change.objects.create(
+            mother_id="846877e6-afaa-43de-acb1-09f61ad4de99",
+            action="unsubscribe_mother_only", data={}, source=source,
+            state=Change.FAILED)
+
+        with mock.patch.object(implement_action, 'apply_async') as apply:
+            result = requeue_changes.apply_async()
+            again = requeue_changes.apply_async()
+
+        self.assertEqual(result.get(), "3 change(s) requeued")
+        self.assertEqual(again.get(), "0 change(s) requeued")
+        self.assertEqual(
+            sorted(call[1]['kwargs']['change_id']
+                   for call in apply.call_args_list),
+            sorted(str(change.id) for change in [lost, abandoned, failed]))
+
+
+class TestScheduledChanges(AuthenticatedAPITestCase):
+
+    @override_settings(ADMIN_CHANGE_RATES={'sbm': 1.0})
+    def test_reserve_change_slot(self):
+        """
+        Each reservation for a service is 1 / rate seconds after the last
+        """
+        first = reserve_change_slot('change_language')
+        second = reserve_change_slot('change_language')
+
+        self.assertEqual(second - first, datetime.timedelta(seconds=1))
+        self.assertTrue(first <= timezone.now())
+
+    @override_settings(ADMIN_CHANGE_RATES={'sbm': 1.0, 'identity_store': 0.5})
+    def test_reserve_change_slot_slowest_service(self):
+        """
+        A change waits for every service it calls
+        """
+        reserve_change_slot('change_baby')
+        first = reserve_change_slot('change_language')
+        second = reserve_change_slot('change_baby')
+
+        self.assertEqual(second - first, datetime.timedelta(seconds=1))
+
+    @override_settings(ADMIN_CHANGE_RATES={'sbm': 0, 'identity_store': 1.0})
+    def test_reserve_change_slot_zero_rate(self):
+        """
+        Services without a positive rate aren't limited
+        """
+        reserve_change_slot('change_language')
+        second = reserve_change_slot('change_language')
+
+        self.assertTrue(second <= timezone.now())
+        self.assertFalse(ServiceSlot.objects.filter(service='sbm').exists())
+
+    @override_settings(ADMIN_CHANGE_MAX_ETA=1800, ADMIN_CHANGE_QUEUE='slow')
+    def test_queue_scheduled_changes(self):
+        """
+        Scheduled changes should only be queued once they are due within
+        ADMIN_CHANGE_MAX_ETA, and only once
+        """
+        source = self.make_source_adminuser()
+        now = timezone.now()
+
+        def make_change(scheduled_at):
+            return Change.objects.create(
+                mother_id="846877e6-afaa-43de-acb1-09f61ad4de99",
+                action="unsubscribe_mother_only", data={}, source=source,
+                scheduled_at=scheduled_at)
+
+        due = make_change(now + datetime.timedelta(minutes=10))
+        later = make_change(now + datetime.timedelta(hours=10))
+
+        with mock.patch.object(implement_action, 'apply_async') as apply:
+            result = queue_scheduled_changes.apply_async()
+            queue_scheduled_changes.apply_async()
+
+        self.assertEqual(result.get(), "1 scheduled change(s) queued")
+        apply.assert_called_once_with(
+            kwargs={"change_id": str(due.id)}, eta=due.scheduled_at,
+            queue='slow')
+        due.refresh_from_db()
+        later.refresh_from_db()
+        self.assertIsNotNone(due.queued_at)
+        self.assertIsNone(later.queued_at)
+
+    @override_settings(CHANGE_RETRY_DELAY=300, ADMIN_CHANGE_QUEUE='slow')
+    def test_requeue_scheduled_changes(self):
+        """
+        Overdue scheduled changes should be queued again on the
+        ADMIN_CHANGE_QUEUE queue
+        """
+        source = self.make_source_adminuser()
+        hour_ago = timezone.now() - datetime.timedelta(hours=1)
+        change = Change.objects.create(
+            mother_id="846877e6-afaa-43de-acb1-09f61ad4de99",
+            action="unsubscribe_mother_only", data={}, source=source,
+            scheduled_at=hour_ago, queued_at=hour_ago)
+
+        with mock.patch.object(implement_action, 'apply_async') as apply:
+            result = requeue_changes.apply_async()
+
+        self.assertEqual(result.get(), "1 change(s) requeued")
+        apply.assert_called_once_with(
+            kwargs={"change_id": str(change.id)}, queue='slow')
+
+    @override_settings(ADMIN_CHANGE_HOURS=(22, 5))
+    def test_within_admin_change_hours(self):
+        """
+        Changes outside of the hours are moved to the next start of them
+        """
+        night = datetime.datetime(2018, 3, 1, 23, 30)
+        early = datetime.datetime(2018, 3, 2, 4, 30)
+        day = datetime.datetime(2018, 3, 2, 12, 15)
+
+        self.assertEqual(within_admin_change_hours(night), night)
+        self.assertEqual(within_admin_change_hours(early), early)
+        self.assertEqual(within_admin_change_hours(day),
+                         datetime.datetime(2018, 3, 2, 22, 0))
+
+    @override_settings(ADMIN_CHANGE_HOURS=None)
+    def test_within_admin_change_hours_unset(self):
+        day = datetime.datetime(2018, 3, 2, 12, 15)
+        self.assertEqual(within_admin_change_hours(day), day)
+
+
 class TestMetrics(AuthenticatedAPITestCase):
 
     @responses.activate
@@ -2791,6 +3337,36 @@ class TestMetrics(AuthenticatedAPITestCase):
 
         post_save.disconnect(fire_language_change_metric, sender=Change)
 
+    @responses.activate
+    def test_bulk_change_metrics(self):
+        """
+        Changes created together should fire their metrics once, with the
+        number of changes
+        """
+        # deactivate Testsession for this test
+        self.session = None
+        # add metric post response
+        responses.add(responses.POST,
+                      "http://metrics-url/metrics/",
+                      json={"foo": "bar"},
+                      status=200, content_type='application/json')
+        source = self.make_source_adminuser()
+        cache.set('registrations.change.language.total.last', 1)
+
+        changes = [Change(mother_id="846877e6-afaa-43de-acb1-09f61ad4de99",
+                          action="change_language", data={}, source=source)
+                   for _ in range(3)]
+        Change.objects.bulk_create(changes)
+        with mock.patch.object(implement_action, 'apply_async') as apply:
+            changes_created(changes)
+
+        self.assertEqual(apply.call_count, 3)
+        self.assertEqual(
+            [json.loads(call.request.body) for call in responses.calls], [
+                {"registrations.change.language.sum": 3.0},
+                {"registrations.change.language.total.last": 4.0},
+            ])
+
     @responses.activate
     def test_baby_change_metric(self):
         """
@@ -2904,66 +3480,6 @@ class IdentityStoreOptoutViewTest(AuthenticatedAPITestCase):
         self.factory = RequestFactory()
         super(IdentityStoreOptoutViewTest, self).setUp()
 
-    def optout_search_callback(self, request):
-        headers = {'Content-Type': "application/json"}
-        resp = {
-            "next": None,
-            "previous": None,
-            "results": [{
-                'identity': "846877e6-afaa-43de-acb1-09f61ad4de99",
-                'details': {
-                    'name': "testing",
-                    'addresses': {
-                        'msisdn': {
-                            '+1234': {}
-                        },
-                    },
-                    'language': "eng_NG",
-                },
-                'optout_type': "forget",
-                'optout_reason': "miscarriage",
-                'optout_source': "ussd_public",
-            }, {
-                'identity': "846877e6-afaa-43de-1111-09f61ad4de99",
-                'details': {
-                    'name': "testing",
-                    'addresses': {
-                        'msisdn': {
-                            '+1234': {}
-                        },
-                    },
-                    'language': "eng_NG",
-                },
-                'optout_type': "forget",
-                'optout_reason': "miscarriage",
-                'optout_source': "ussd_public",
-            }]
-        }
-        return (200, headers, json.dumps(resp))
-
-    def optout_search_callback_other(self, request):
-        headers = {'Content-Type': "application/json"}
-        resp = {
-            "next": None,
-            "previous": None,
-            "results": [{
-                'identity': "629eaf3c-04e5-1111-8a27-3ab3b811326a",
-                'details': {
-                    'name': "testing",
-                    'addresses': {
-                        'msisdn': {
-                            '+1234': {}
-                        },
-                    },
-                    'language': "eng_NG",
-                },
-                'optout_type': "forget",
-                'optout_reason': "other",
-                'optout_source': "ivr_public",
-            }]
-        }
-        return (200, headers, json.dumps(resp))
-
     @responses.activate
     def test_identity_optout_valid(self):
 
@@ -2977,22 +3493,10 @@ class IdentityStoreOptoutViewTest(AuthenticatedAPITestCase):
                       json={"foo": "bar"},
                       status=200, content_type='application/json')
 
-        url = 'http://localhost:8001/api/v1/optouts/search/?' \
-              'reason=miscarriage'
-        responses.add_callback(
-            responses.GET, url, callback=self.optout_search_callback,
-            match_querystring=True, content_type="application/json")
-
-        url = 'http://localhost:8001/api/v1/optouts/search/'
-        responses.add_callback(
-            responses.GET, url, callback=self.optout_search_callback,
-            match_querystring=True, content_type="application/json")
-
-        url = 'http://localhost:8001/api/v1/optouts/search/?' \
-              'request_source=ussd_public'
-        responses.add_callback(
-            responses.GET, url, callback=self.optout_search_callback,
-            match_querystring=True, content_type="application/json")
+        Optout.objects.create(
+            identity='846877e6-afaa-43de-1111-09f61ad4de99',
+            reason='miscarriage', source='ussd_public', msg_type='text',
+            msg_receiver='mother_only', processed_at=timezone.now())
 
         request = {
             'identity': "846877e6-afaa-43de-acb1-09f61ad4de99",
@@ -3014,30 +3518,38 @@ class IdentityStoreOptoutViewTest(AuthenticatedAPITestCase):
                                          content_type='application/json')
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(responses.calls), 12)
+        # The metrics are fired by a worker
+        self.assertEqual(len(responses.calls), 0)
+
+        optout = Optout.objects.get(
+            identity='846877e6-afaa-43de-acb1-09f61ad4de99')
+        self.assertEqual(process_optout(optout.id), "Optout processed")
+        self.assertEqual(
+            process_optout(optout.id), "Optout already processed")
+        self.assertEqual(len(responses.calls), 8)
 
         self.assertEqual(json.loads(responses.calls[0].request.body), {
             "optout.receiver_type.mother_only.sum": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[2].request.body), {
+        self.assertEqual(json.loads(responses.calls[1].request.body), {
             "optout.receiver_type.mother_only.total.last": 2.0
         })
-        self.assertEqual(json.loads(responses.calls[3].request.body), {
+        self.assertEqual(json.loads(responses.calls[2].request.body), {
             "optout.reason.miscarriage.sum": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[5].request.body), {
+        self.assertEqual(json.loads(responses.calls[3].request.body), {
             "optout.reason.miscarriage.total.last": 2.0
         })
-        self.assertEqual(json.loads(responses.calls[6].request.body), {
+        self.assertEqual(json.loads(responses.calls[4].request.body), {
             "optout.msg_type.text.sum": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[8].request.body), {
+        self.assertEqual(json.loads(responses.calls[5].request.body), {
             "optout.msg_type.text.total.last": 2.0
         })
-        self.assertEqual(json.loads(responses.calls[9].request.body), {
+        self.assertEqual(json.loads(responses.calls[6].request.body), {
             "optout.source.ussd.sum": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[11].request.body), {
+        self.assertEqual(json.loads(responses.calls[7].request.body), {
             "optout.source.ussd.total.last": 2.0
         })
 
@@ -3055,23 +3567,6 @@ class IdentityStoreOptoutViewTest(AuthenticatedAPITestCase):
                       json={"foo": "bar"},
                       status=200, content_type='application/json')
 
-        url = 'http://localhost:8001/api/v1/optouts/search/?' \
-              'reason=other'
-        responses.add_callback(
-            responses.GET, url, callback=self.optout_search_callback_other,
-            match_querystring=True, content_type="application/json")
-
-        url = 'http://localhost:8001/api/v1/optouts/search/'
-        responses.add_callback(
-            responses.GET, url, callback=self.optout_search_callback_other,
-            match_querystring=True, content_type="application/json")
-
-        url = 'http://localhost:8001/api/v1/optouts/search/?' \
-              'request_source=ivr_public'
-        responses.add_callback(
-            responses.GET, url, callback=self.optout_search_callback_other,
-            match_querystring=True, content_type="application/json")
-
         request = {
             'identity': "629eaf3c-04e5-1111-8a27-3ab3b811326a",
             'details': {
@@ -3092,33 +3587,78 @@ class IdentityStoreOptoutViewTest(AuthenticatedAPITestCase):
                                          content_type='application/json')
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(responses.calls), 12)
+        optout = Optout.objects.get(
+            identity='629eaf3c-04e5-1111-8a27-3ab3b811326a')
+        self.assertEqual(process_optout(optout.id), "Optout processed")
+
+        optout.refresh_from_db()
+        self.assertEqual(optout.reason, 'other')
+        self.assertEqual(optout.source, 'ivr_public')
+        self.assertEqual(optout.msg_type, 'audio')
+        self.assertEqual(optout.msg_receiver, 'friend_only')
+        self.assertEqual(len(responses.calls), 8)
 
         self.assertEqual(json.loads(responses.calls[0].request.body), {
             "optout.receiver_type.friend_only.sum": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[2].request.body), {
+        self.assertEqual(json.loads(responses.calls[1].request.body), {
             "optout.receiver_type.friend_only.total.last": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[3].request.body), {
+        self.assertEqual(json.loads(responses.calls[2].request.body), {
             "optout.reason.other.sum": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[5].request.body), {
+        self.assertEqual(json.loads(responses.calls[3].request.body), {
             "optout.reason.other.total.last": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[6].request.body), {
+        self.assertEqual(json.loads(responses.calls[4].request.body), {
             "optout.msg_type.audio.sum": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[8].request.body), {
+        self.assertEqual(json.loads(responses.calls[5].request.body), {
             "optout.msg_type.audio.total.last": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[9].request.body), {
+        self.assertEqual(json.loads(responses.calls[6].request.body), {
             "optout.source.ivr.sum": 1.0
         })
-        self.assertEqual(json.loads(responses.calls[11].request.body), {
+        self.assertEqual(json.loads(responses.calls[7].request.body), {
             "optout.source.ivr.total.last": 1.0
         })
 
+    def test_process_optout_metrics_fail(self):
+        """
+        An optout whose metrics fail to fire shouldn't be marked processed,
+        so that it is processed again
+        """
+        self.make_registration_mother_only()
+        optout = Optout.objects.create(
+            identity="846877e6-afaa-43de-acb1-09f61ad4de99",
+            reason="miscarriage", source="ussd_public")
+
+        with mock.patch('changes.tasks.fire_optout_reason_metric',
+                        side_effect=Exception("Metrics are down")):
+            with self.assertRaises(Exception):
+                process_optout(optout.id)
+
+        optout.refresh_from_db()
+        self.assertIsNone(optout.processed_at)
+        self.assertIsNone(optout.msg_type)
+
+    def test_identity_optout_redelivered(self):
+        request = {
+            'id': 7,
+            'identity': "846877e6-afaa-43de-acb1-09f61ad4de99",
+            'optout_type': "forget",
+            'optout_reason': "miscarriage",
+            'optout_source': "ussd_public",
+        }
+        for _ in range(2):
+            response = self.adminclient.post('/api/v1/optout/',
+                                             json.dumps(request),
+                                             content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+
+        optout = Optout.objects.get()
+        self.assertEqual(optout.optout_id, '7')
+
     @responses.activate
     def test_identity_optout_invalid(self):
 
@@ -3212,6 +3752,7 @@ class AdminViewsTest(AuthenticatedAPITestCase):
         self.assertEqual(change.mother_id, "mother-id-123")
         self.assertEqual(change.action, "unsubscribe_mother_only")
         self.assertEqual(change.source.name, "test_ussd_source_adminuser")
+        self.assertIsNotNone(change.scheduled_at)
 
     def test_ci_optout_no_source_username(self):
         request = {
@@ -3399,6 +3940,69 @@ class AdminViewsTest(AuthenticatedAPITestCase):
 
         self.assertEqual(response.status_code, 400)
 
+    @responses.activate
+    def test_ci_change_language_cached(self):
+        """
+        The messageset languages and ids are cached, so validating another
+        change doesn't ask the SBM for them again
+        """
+        request = {
+            "mother_id": "846877e6-afaa-43de-acb1-09f61ad4de99",
+            "messageset": "messageset_one",
+            "language": "eng_ZA"
+        }
+
+        self.make_source_adminuser()
+
+        self.add_messageset_language_callback()
+
+        self.add_messageset_via_short_name("messageset_one", 2)
+
+        for _ in range(2):
+            response = self.adminclient.post('/api/v1/change_admin/',
+                                             json.dumps(request),
+                                             content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_refresh_messageset_cache(self):
+        """
+        The cache can be filled in the background, so that validating a
+        change doesn't ask the SBM anything
+        """
+        self.add_messageset_language_callback()
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/messageset/',
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": 2,
+                    "short_name": "messageset_one",
+                    "default_schedule": 8
+                }]
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+
+        self.assertEqual(
+            refresh_messageset_cache(), "1 messageset(s) cached")
+        self.assertEqual(len(responses.calls), 2)
+
+        self.make_source_adminuser()
+        response = self.adminclient.post('/api/v1/change_admin/', json.dumps({
+            "mother_id": "846877e6-afaa-43de-acb1-09f61ad4de99",
+            "messageset": "messageset_one",
+            "language": "zul_ZA"
+        }), content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(responses.calls), 2)
+
 
 class AddChangeViewsTest(AuthenticatedAPITestCase):
     """
@@ -3658,3 +4262,78 @@ class AddChangeViewsTest(AuthenticatedAPITestCase):
             {'action': ['"change_everything" is not a valid choice.']})
 
         self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    def test_add_changes_bulk(self):
+        # Setup
+        self.make_source_adminuser()
+        mother_id = "4038a518-2940-4b15-9c5c-2b7b123b8735"
+
+        self.mock_identity_lookup("%2B2347031221927", mother_id)
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/search/?details__addresses__msisdn=%2B2347031221928',  # noqa
+            json={"next": None, "previous": None, "results": []},
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+        self.mock_identity_optout()
+
+        post_data = [{
+            "msisdn": "07031221927",
+            "action": "change_language",
+            "data": {"new_language": "english"}
+        }, {
+            "msisdn": "07031221927",
+            "action": "unsubscribe_mother_only",
+            "data": {"reason": "miscarriage"}
+        }, {
+            "msisdn": "07031221928",
+            "action": "change_language",
+            "data": {"new_language": "english"}
+        }, {
+            "msisdn": "07031221927",
+            "action": "change_everything",
+            "data": {}
+        }]
+        # Execute
+        response = self.adminclient.post('/api/v1/addchanges/',
+                                         json.dumps(post_data),
+                                         content_type='application/json')
+
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        results = response.data['results']
+        self.assertEqual(
+            [result['created'] for result in results],
+            [True, True, False, False])
+        self.assertEqual(
+            results[2]['errors'],
+            {"msisdn": ["No identity for this number."]})
+        self.assertEqual(
+            results[3]['errors'],
+            {'action': ['"change_everything" is not a valid choice.']})
+
+        changes = Change.objects.order_by('action')
+        self.assertEqual(
+            [(d.action, d.mother_id, d.data) for d in changes], [
+                ('change_language', mother_id, {"new_language": "eng_NG"}),
+                ('unsubscribe_mother_only', mother_id,
+                 {"reason": "miscarriage"}),
+            ])
+        self.assertEqual(changes[0].created_by, self.adminuser)
+        self.assertEqual(
+            results[0]['change']['id'], str(changes[0].id))
+
+        # Each msisdn is looked up once, plus the optout
+        self.assertEqual(len(responses.calls), 3)
+
+    def test_add_changes_bulk_not_a_list(self):
+        self.make_source_adminuser()
+
+        response = self.adminclient.post('/api/v1/addchanges/',
+                                         json.dumps({"action": "foo"}),
+                                         content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Change.objects.count(), 0)
@@ -19,5 +19,7 @@ urlpatterns = [
         views.ReceiveAdminChange.as_view(),
         name="change_admin"),
     url(r'^api/v1/addchange/',
-        views.AddChangeView.as_view())
+        views.AddChangeView.as_view()),
+    url(r'^api/v1/addchanges/$',
+        views.BulkAddChangeView.as_view()),
 ]
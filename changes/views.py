@@ -1,18 +1,22 @@
 import django_filters
 import django_filters.rest_framework as filters
-from .models import Source, Change
-from registrations.models import Registration, get_or_incr_cache
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+from .models import (
+    Source, Change, Optout, CHANGE_METRICS, change_post_save,
+    fire_change_metrics)
 from rest_framework import viewsets, mixins, generics, status
 from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from .serializers import ChangeSerializer
+from .tasks import process_optout, reserve_change_slot
 from django.http import JsonResponse
 from django.conf import settings
-from django.db.models import Q
+from django.db import transaction
 from hellomama_registration import utils
 from .serializers import AdminChangeSerializer, AddChangeSerializer
-from seed_services_client import IdentityStoreApiClient
 
 import six
 
@@ -86,142 +90,29 @@ class ReceiveIdentityStoreOptout(mixins.CreateModelMixin,
                                  '"optout_source" must be specified.'
                                  }, status=400)
 
-        registrations = Registration.objects.filter(mother_id=identity_id).\
-            order_by('-created_at')
-
-        if not registrations.exists():
-            registrations = Registration.objects.filter(
-                data__receiver_id=identity_id).order_by('-created_at')
-
-        for registration in registrations:
-            if registration.data.get('msg_receiver'):
-                fire_optout_receiver_type_metric(
-                    registration.data['msg_receiver'])
-
-            fire_optout_reason_metric(optout_reason)
-
-            if registration.data.get('msg_type'):
-                fire_optout_message_type_metric(registration.data['msg_type'])
-
-            fire_optout_source_metric(optout_source)
-
-            break
+        optout_id = data.get('id')
+        if optout_id is None:
+            optout = Optout.objects.create(
+                identity=identity_id, reason=optout_reason,
+                source=optout_source)
+        else:
+            # The Identity Store retries webhooks, so an optout it has
+            # already sent is ignored
+            optout, created = Optout.objects.get_or_create(
+                optout_id=str(optout_id), defaults={
+                    'identity': identity_id,
+                    'reason': optout_reason,
+                    'source': optout_source,
+                })
+            if not created:
+                return JsonResponse({})
+
+        transaction.on_commit(lambda: process_optout.apply_async(
+            kwargs={"optout_id": optout.id}))
 
         return JsonResponse({})
 
 
-def fire_optout_reason_metric(reason):
-    from registrations.tasks import fire_metric
-
-    if reason not in settings.OPTOUT_REASONS:
-        reason = 'other'
-
-    fire_metric.apply_async(kwargs={
-        "metric_name": 'optout.reason.%s.sum' % reason,
-        "metric_value": 1.0
-    })
-
-    def search_optouts_reason():
-        result = utils.search_optouts({"reason": reason})
-        return sum(1 for r in result)
-
-    total_key = 'optout.reason.%s.total.last' % reason
-    total = get_or_incr_cache(
-        total_key,
-        search_optouts_reason)
-    fire_metric.apply_async(kwargs={
-        'metric_name': total_key,
-        'metric_value': total,
-    })
-
-
-def fire_optout_source_metric(source):
-    from registrations.tasks import fire_metric
-
-    # remove the _public part
-    source_short = source.split('_')[0]
-
-    fire_metric.apply_async(kwargs={
-        "metric_name": 'optout.source.%s.sum' % source_short,
-        "metric_value": 1.0
-    })
-
-    def search_optouts_source():
-        result = utils.search_optouts({"request_source": source})
-        return sum(1 for r in result)
-
-    total_key = 'optout.source.%s.total.last' % source_short
-    total = get_or_incr_cache(
-        total_key,
-        search_optouts_source)
-    fire_metric.apply_async(kwargs={
-        'metric_name': total_key,
-        'metric_value': total,
-    })
-
-
-def fire_optout_receiver_type_metric(msg_receiver):
-    from registrations.tasks import fire_metric
-
-    fire_metric.apply_async(kwargs={
-        "metric_name": 'optout.receiver_type.%s.sum' % msg_receiver,
-        "metric_value": 1.0
-    })
-
-    def search_optouts_receiver_type():
-        result = utils.search_optouts()
-
-        identities = set(data['identity'] for data in result)
-
-        return Registration.objects.filter(
-            Q(
-                mother_id__in=identities,
-                data__msg_receiver=msg_receiver) |
-            Q(
-                data__receiver_id__in=identities,
-                data__msg_receiver=msg_receiver)).count()
-
-    total_key = 'optout.receiver_type.%s.total.last' % msg_receiver
-    total = get_or_incr_cache(
-        total_key,
-        search_optouts_receiver_type)
-    fire_metric.apply_async(kwargs={
-        'metric_name': total_key,
-        'metric_value': total,
-    })
-
-
-def fire_optout_message_type_metric(msg_type):
-    from registrations.tasks import fire_metric
-
-    fire_metric.apply_async(kwargs={
-        "metric_name": 'optout.msg_type.%s.sum' % msg_type,
-        "metric_value": 1.0
-    })
-
-    def search_optouts_message_type():
-        result = utils.search_optouts()
-
-        identities = set(data['identity'] for data in result)
-
-        return Registration.objects.filter(
-            Q(
-                mother_id__in=identities,
-                data__msg_type=msg_type) |
-            Q(
-                data__receiver_id__in=identities,
-                data__msg_type=msg_type)).count()
-
-    total_key = 'optout.msg_type.%s.total.last' % msg_type
-    total = get_or_incr_cache(
-        total_key,
-        search_optouts_message_type)
-    fire_metric.apply_async(kwargs={
-        'metric_name': total_key,
-        'metric_value': total,
-    })
-
-
 def get_or_create_source(request):
     source, created = Source.objects.get_or_create(
         user=request.user,
@@ -247,6 +138,10 @@ class ReceiveAdminOptout(generics.CreateAPIView):
 
         return super(ReceiveAdminOptout, self).post(request, *args, **kwargs)
 
+    def perform_create(self, serializer):
+        serializer.save(scheduled_at=reserve_change_slot(
+            serializer.validated_data['action']))
+
 
 class ReceiveAdminChange(generics.CreateAPIView):
     permission_classes = (IsAuthenticated,)
@@ -286,7 +181,9 @@ class ReceiveAdminChange(generics.CreateAPIView):
         serializer = ChangeSerializer(data=changes, many=True)
 
         if serializer.is_valid():
-            serializer.save()
+            # Either the messageset or the language is changed
+            serializer.save(
+                scheduled_at=reserve_change_slot(changes[0]['action']))
 
             return Response(data=serializer.data,
                             status=status.HTTP_201_CREATED)
@@ -295,6 +192,109 @@ class ReceiveAdminChange(generics.CreateAPIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
+def create_changes(changes):
+    """ Saves the changes with a single insert. bulk_create doesn't send
+    post_save, so once the changes are committed they are queued to be
+    applied the way change_post_save queues them, and the change metrics
+    are fired once for each action with the number of new changes.
+    """
+    with transaction.atomic():
+        Change.objects.bulk_create(changes)
+        transaction.on_commit(lambda: changes_created(changes))
+    return changes
+
+
+def changes_created(changes):
+    counts = Counter(change.action for change in changes)
+    for change in changes:
+        change_post_save(Change, change, created=True)
+    for action, count in counts.items():
+        if action in CHANGE_METRICS:
+            fire_change_metrics(action, count)
+
+
+def lookup_msisdn(msisdn):
+    """ Returns the first identity with the msisdn, or None """
+    identities = utils.identity_store_client.get_identity_by_address(
+        'msisdn', msisdn)['results']
+    return next(identities, None)
+
+
+def resolve_change_identities(data, lookup):
+    """ Fills in the mother_id and household_id of an AddChange from its
+    msisdns, using lookup to find the identity for an msisdn.
+
+    :returns: the errors to respond with, or None
+    """
+    if data.get('msisdn'):
+        mother_identity = lookup(data['msisdn'])
+        if mother_identity is None:
+            return {"msisdn": ["No identity for this number."]}
+        data['mother_id'] = mother_identity['id']
+
+    if data['data'].get('household_msisdn'):
+        household = lookup(data['data']['household_msisdn'])
+        if household is None:
+            return {"household_msisdn": ["No identity for this number."]}
+        data['data']['household_id'] = household['id']
+
+        if (not data.get('msisdn') and
+                household['details'].get('linked_to')):
+            data['mother_id'] = household['details']['linked_to']
+
+
+def prepare_change_data(data):
+    """ Normalises the msisdns of an AddChange, and maps its human readable
+    values to the ones the changes use
+    """
+    if data.get('msisdn'):
+        data['msisdn'] = utils.normalize_msisdn(data['msisdn'], '234')
+
+    if data['data'].get('household_msisdn'):
+        data['data']['household_msisdn'] = utils.normalize_msisdn(
+            data['data']['household_msisdn'], '234')
+
+    if ('voice_days' in data['data']):
+        data['data']['voice_days'] = utils.get_voice_days(
+            data['data']['voice_days'])
+
+    if ('voice_times' in data['data']):
+        data['data']['voice_times'] = utils.get_voice_times(
+            data['data']['voice_times'])
+
+    if ('msg_type' in data['data']):
+        data['data']['msg_type'] = utils.get_msg_type(
+            data['data']['msg_type'])
+
+    if ('new_language' in data['data']):
+        data['data']['new_language'] = utils.get_language(
+            data['data']['new_language'])
+
+
+def get_optout_info(data, source):
+    """ Returns the identity store optout for an unsubscribe AddChange, or
+    None for other actions
+    """
+    if 'unsubscribe' not in data['action']:
+        return None
+
+    identity_id = data['mother_id']
+    msisdn = data.get('msisdn')
+    if data['action'] == 'unsubscribe_household_only':
+        identity_id = data['data']['household_id']
+        msisdn = data.get('household_msisdn')
+
+    return {
+        'optout_type': 'stop',
+        'identity': identity_id,
+        'reason': data['data']['reason'],
+        'address_type': 'msisdn',
+        'address': msisdn,
+        'request_source': source.name,
+        'requestor_source_id': source.id
+    }
+
+
 class AddChangeView(generics.CreateAPIView):
 
     """ AddChangeView Interaction
@@ -318,70 +318,15 @@ class AddChangeView(generics.CreateAPIView):
 
         data["source"] = source.id
 
-        ids_client = IdentityStoreApiClient(
-            settings.IDENTITY_STORE_TOKEN, settings.IDENTITY_STORE_URL)
-
-        if data.get('msisdn'):
-            data['msisdn'] = utils.normalize_msisdn(data['msisdn'], '234')
-            identity = ids_client.get_identity_by_address('msisdn',
-                                                          data['msisdn'])
-            try:
-                mother_identity = next(identity['results'])
-            except StopIteration:
-                return Response({"msisdn": ["No identity for this number."]},
-                                status=status.HTTP_400_BAD_REQUEST)
-            data['mother_id'] = mother_identity['id']
-
-        if ('voice_days' in data['data']):
-            data['data']['voice_days'] = utils.get_voice_days(
-                data['data']['voice_days'])
-
-        if ('voice_times' in data['data']):
-            data['data']['voice_times'] = utils.get_voice_times(
-                data['data']['voice_times'])
-
-        if ('msg_type' in data['data']):
-            data['data']['msg_type'] = utils.get_msg_type(
-                data['data']['msg_type'])
-
-        if ('new_language' in data['data']):
-            data['data']['new_language'] = utils.get_language(
-                data['data']['new_language'])
-
-        if data['data'].get('household_msisdn'):
-            data['data']['household_msisdn'] = utils.normalize_msisdn(
-                data['data']['household_msisdn'], '234')
-            households = ids_client.get_identity_by_address(
-                'msisdn', data['data']['household_msisdn'])['results']
-            try:
-                household = next(households)
-            except StopIteration:
-                return Response({"household_msisdn":
-                                ["No identity for this number."]},
-                                status=status.HTTP_400_BAD_REQUEST)
-            data['data']['household_id'] = household['id']
-
-            if (not data.get('msisdn') and
-                    household['details'].get('linked_to')):
-                data['mother_id'] = household['details']['linked_to']
-
-        if 'unsubscribe' in data['action']:
-            identity_id = data['mother_id']
-            msisdn = data.get('msisdn')
-            if data['action'] == 'unsubscribe_household_only':
-                identity_id = data['data']['household_id']
-                msisdn = data.get('household_msisdn')
-
-            optout_info = {
-                'optout_type': 'stop',
-                'identity': identity_id,
-                'reason': data['data']['reason'],
-                'address_type': 'msisdn',
-                'address': msisdn,
-                'request_source': source.name,
-                'requestor_source_id': source.id
-            }
-            ids_client.create_optout(optout_info)
+        prepare_change_data(data)
+
+        errors = resolve_change_identities(data, lookup_msisdn)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        optout_info = get_optout_info(data, source)
+        if optout_info is not None:
+            utils.identity_store_client.create_optout(optout_info)
 
         serializer = ChangeSerializer(data=data)
 
@@ -394,3 +339,120 @@ class AddChangeView(generics.CreateAPIView):
         else:
             return Response(serializer.errors,
                             status=status.HTTP_400_BAD_REQUEST)
+
+
+class BulkAddChangeView(APIView):
+
+    """ BulkAddChangeView Interaction
+        POST - Validates and Saves a list of changes, optouts if needed,
+               and returns the outcome for each of them
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return Response(
+                {"non_field_errors": ["Expected a list of changes."]},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            source = Source.objects.get(user=self.request.user)
+        except Source.DoesNotExist:
+            return Response("Source not found for user.",
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(request.data)
+
+        def fail(index, errors):
+            results[index] = {"created": False, "errors": errors}
+
+        items = []
+        for index, item in enumerate(request.data):
+            add_serializer = AddChangeSerializer(data=item)
+            if not add_serializer.is_valid():
+                fail(index, add_serializer.errors)
+                continue
+            data = add_serializer.validated_data
+            data["source"] = source.id
+            prepare_change_data(data)
+            items.append((index, data))
+
+        pool = ThreadPool(settings.CHANGE_BATCH_WORKERS)
+        try:
+            # Every msisdn is only looked up once, and all of them together
+            msisdns = list(set(
+                msisdn for index, data in items
+                for msisdn in (data.get('msisdn'),
+                               data['data'].get('household_msisdn'))
+                if msisdn))
+
+            def safe_lookup(msisdn):
+                try:
+                    return lookup_msisdn(msisdn)
+                except Exception as error:
+                    return error
+
+            identities = dict(zip(msisdns, pool.map(safe_lookup, msisdns)))
+
+            def lookup(msisdn):
+                if isinstance(identities[msisdn], Exception):
+                    raise identities[msisdn]
+                return identities[msisdn]
+
+            serializers = []
+            for index, data in items:
+                try:
+                    errors = resolve_change_identities(data, lookup)
+                except Exception as error:
+                    errors = {"non_field_errors": [str(error)]}
+                if errors:
+                    fail(index, errors)
+                    continue
+
+                serializer = ChangeSerializer(data=data)
+                if not serializer.is_valid():
+                    fail(index, serializer.errors)
+                    continue
+                serializers.append(
+                    (index, serializer, get_optout_info(data, source)))
+
+            def create_optout(optout_info):
+                if optout_info is None:
+                    return None
+                try:
+                    utils.identity_store_client.create_optout(optout_info)
+                except Exception as error:
+                    return error
+
+            optout_errors = pool.map(
+                create_optout,
+                [optout_info for index, serializer, optout_info
+                 in serializers])
+        finally:
+            pool.close()
+
+        changes = []
+        for (index, serializer, optout_info), error in zip(
+                serializers, optout_errors):
+            if error is not None:
+                fail(index, {"non_field_errors": [
+                    "Optout failed: %s" % error]})
+                continue
+            change = Change(created_by=self.request.user,
+                            updated_by=self.request.user,
+                            **serializer.validated_data)
+            changes.append((index, change))
+
+        create_changes([change for index, change in changes])
+
+        for index, change in changes:
+            results[index] = {
+                "created": True,
+                "change": ChangeSerializer(change).data,
+            }
+
+        if changes:
+            response_status = status.HTTP_201_CREATED
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({"results": results}, status=response_status)
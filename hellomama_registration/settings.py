@@ -175,11 +175,37 @@ HOOK_DELIVERER = 'registrations.tasks.deliver_hook_wrapper'
 
 HOOK_AUTH_TOKEN = os.environ.get('HOOK_AUTH_TOKEN', 'REPLACEME')
 
+# Webhook delivery outbox
+HOOK_DELIVERY_TIMEOUT = int(os.environ.get('HOOK_DELIVERY_TIMEOUT', '10'))
+HOOK_DELIVERY_BATCH_SIZE = int(
+    os.environ.get('HOOK_DELIVERY_BATCH_SIZE', '100'))
+HOOK_DELIVERY_MAX_ATTEMPTS = int(
+    os.environ.get('HOOK_DELIVERY_MAX_ATTEMPTS', '10'))
+HOOK_DELIVERY_RETRY_DELAY = int(
+    os.environ.get('HOOK_DELIVERY_RETRY_DELAY', '30'))
+HOOK_DELIVERY_MAX_RETRY_DELAY = int(
+    os.environ.get('HOOK_DELIVERY_MAX_RETRY_DELAY', '3600'))
+# How long to collect hooks for targets that accept batches
+HOOK_BATCH_WINDOW = int(os.environ.get('HOOK_BATCH_WINDOW', '5'))
+# Webhook target health tracking
+HOOK_TARGET_LATENCY_SAMPLES = int(
+    os.environ.get('HOOK_TARGET_LATENCY_SAMPLES', '100'))
+HOOK_TARGET_SLOW_LATENCY = float(
+    os.environ.get('HOOK_TARGET_SLOW_LATENCY', '2.0'))
+HOOK_TARGET_FAILURE_THRESHOLD = int(
+    os.environ.get('HOOK_TARGET_FAILURE_THRESHOLD', '5'))
+
 # Celery configuration options
 CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
 CELERYBEAT_SCHEDULER = 'djcelery.schedulers.DatabaseScheduler'
 
 BROKER_URL = os.environ.get('BROKER_URL', 'redis://localhost:6379/0')
+# Tasks with an ETA further away than this are redelivered by the redis
+# broker, see ADMIN_CHANGE_MAX_ETA
+BROKER_TRANSPORT_OPTIONS = {
+    'visibility_timeout': int(
+        os.environ.get('BROKER_VISIBILITY_TIMEOUT', '3600')),
+}
 
 CELERY_DEFAULT_QUEUE = 'hellomama_registration'
 CELERY_QUEUES = (
@@ -204,12 +230,39 @@ CELERY_ROUTES = {
     'registrations.tasks.validate_registration': {
         'queue': 'priority',
     },
+    'hellomama_registration.registrations.tasks.process_registration_intake': {
+        'queue': 'priority',
+    },
     'changes.tasks.implement_action': {
         'queue': 'priority',
     },
+    'hellomama_registration.changes.tasks.implement_change_batch': {
+        'queue': 'mediumpriority',
+    },
+    'hellomama_registration.changes.tasks.process_optout': {
+        'queue': 'mediumpriority',
+    },
+    'hellomama_registration.changes.tasks.requeue_changes': {
+        'queue': 'mediumpriority',
+    },
+    'hellomama_registration.changes.tasks.queue_scheduled_changes': {
+        'queue': 'mediumpriority',
+    },
     'registrations.tasks.DeliverHook': {
         'queue': 'priority',
     },
+    'hellomama_registration.registrations.tasks.sync_subscription_mirror': {
+        'queue': 'mediumpriority',
+    },
+    'hellomama_registration.registrations.tasks.refresh_messageset_cache': {
+        'queue': 'mediumpriority',
+    },
+    'hellomama_registration.registrations.tasks.sync_messageset_catalog': {
+        'queue': 'mediumpriority',
+    },
+    'hellomama_registration.registrations.tasks.dispatch_hook_deliveries': {
+        'queue': 'mediumpriority',
+    },
     'registrations.tasks.fire_metric': {
         'queue': 'metrics',
     },
@@ -293,6 +346,11 @@ METRICS_SCHEDULED = [
 ]
 METRICS_SCHEDULED_TASKS = [
 ]
+# Each process caches the available metrics catalog under the current
+# version of the sources, so that a new or changed source is picked up
+# straight away. Source user renames are picked up once it times out.
+AVAILABLE_METRICS_CACHE_TIMEOUT = int(os.environ.get(
+    'AVAILABLE_METRICS_CACHE_TIMEOUT', '300'))
 
 METRICS_AUTH = (
     os.environ.get("METRICS_AUTH_USER", "REPLACEME"),
@@ -349,6 +407,71 @@ THIRDPARTY_REGISTRATIONS_USER = os.environ.get('THIRDPARTY_REGISTRATIONS_USER',
                                                'REPLACEME')
 THIRDPARTY_REGISTRATIONS_PASSWORD = os.environ.get(
     'THIRDPARTY_REGISTRATIONS_PASSWORD', 'REPLACEME')
+THIRDPARTY_REGISTRATIONS_WORKERS = int(os.environ.get(
+    'THIRDPARTY_REGISTRATIONS_WORKERS', '4'))
+THIRDPARTY_REGISTRATIONS_CHUNK = int(os.environ.get(
+    'THIRDPARTY_REGISTRATIONS_CHUNK', '100'))
+THIRDPARTY_REGISTRATIONS_STREAMING = os.environ.get(
+    'THIRDPARTY_REGISTRATIONS_STREAMING', 'true').lower() == 'true'
+THIRDPARTY_REGISTRATIONS_SPOOL_SIZE = int(os.environ.get(
+    'THIRDPARTY_REGISTRATIONS_SPOOL_SIZE', str(10 * 1024 * 1024)))
+PUBLIC_NOTIFICATION_WORKERS = int(os.environ.get(
+    'PUBLIC_NOTIFICATION_WORKERS', '4'))
+PUBLIC_NOTIFICATION_CHUNK = int(os.environ.get(
+    'PUBLIC_NOTIFICATION_CHUNK', '100'))
+
+# Answer subscription searches from the local copy of the SBM's
+# subscriptions, which is kept up to date by webhooks and the
+# sync_subscription_mirror task
+SUBSCRIPTION_MIRROR_READS = os.environ.get(
+    'SUBSCRIPTION_MIRROR_READS', 'false').lower() == 'true'
+MESSAGESET_CACHE_TIMEOUT = int(os.environ.get(
+    'MESSAGESET_CACHE_TIMEOUT', '3600'))
+# The most subscription PATCHes sent to the SBM at once by a single change
+SUBSCRIPTION_PATCH_WORKERS = int(os.environ.get(
+    'SUBSCRIPTION_PATCH_WORKERS', '8'))
+
+# Changes with these actions aren't applied one by one as they are
+# created, but together by the periodic implement_change_batch task
+CHANGE_BATCH_ACTIONS = [
+    action for action in os.environ.get(
+        'CHANGE_BATCH_ACTIONS', '').split(',') if action]
+CHANGE_BATCH_SIZE = int(os.environ.get('CHANGE_BATCH_SIZE', '500'))
+CHANGE_BATCH_WORKERS = int(os.environ.get('CHANGE_BATCH_WORKERS', '8'))
+# Seconds after which a change that a worker started applying, but stopped
+# making progress on, can be claimed by another worker
+CHANGE_APPLY_LEASE = int(os.environ.get('CHANGE_APPLY_LEASE', '600'))
+# The periodic requeue_changes task queues changes that have been pending
+# or failed for CHANGE_RETRY_DELAY seconds, until they have been attempted
+# CHANGE_MAX_ATTEMPTS times
+CHANGE_RETRY_DELAY = int(os.environ.get('CHANGE_RETRY_DELAY', '300'))
+CHANGE_MAX_ATTEMPTS = int(os.environ.get('CHANGE_MAX_ATTEMPTS', '5'))
+
+# Changes made through the admin change and optout endpoints are scheduled
+# on their own queue instead of being applied straight away. Each change
+# takes a slot from each external service its action calls, and each
+# service gives out at most ADMIN_CHANGE_RATES slots a second, e.g.
+# "sbm:5,identity_store:5". Services without a positive rate aren't
+# limited. If ADMIN_CHANGE_HOURS is set, e.g. "22-5", the changes are only
+# scheduled within those hours (UTC). queue_scheduled_changes queues them
+# ADMIN_CHANGE_MAX_ETA seconds before they are due, which has to be less
+# than the broker's visibility_timeout.
+ADMIN_CHANGE_QUEUE = os.environ.get('ADMIN_CHANGE_QUEUE', 'lowpriority')
+ADMIN_CHANGE_RATES = dict(
+    (service, float(rate)) for service, rate in (
+        item.split(':') for item in os.environ.get(
+            'ADMIN_CHANGE_RATES', 'sbm:5,identity_store:5').split(',')
+        if item)
+    if float(rate) > 0)
+ADMIN_CHANGE_HOURS = tuple(
+    int(hour) for hour in os.environ.get(
+        'ADMIN_CHANGE_HOURS', '').split('-') if hour) or None
+ADMIN_CHANGE_MAX_ETA = int(os.environ.get('ADMIN_CHANGE_MAX_ETA', '1800'))
+
+# Queue registrations pushed to the add registration endpoint, and
+# respond straight away, instead of processing them in the request
+ADD_REGISTRATION_ASYNC = os.environ.get(
+    'ADD_REGISTRATION_ASYNC', 'false').lower() == 'true'
 
 V2N_VOICE_URL = os.environ.get(
     'V2N_VOICE_URL', 'http://197.253.23.121:8087/praekelt/download.php')
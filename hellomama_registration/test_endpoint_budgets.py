@@ -0,0 +1,458 @@
+"""
+Query-count, outbound HTTP and wall time budgets for every API endpoint.
+
+Each endpoint listed in ENDPOINTS is requested once against a fixed set of
+fixtures, with all outbound services (identity store, stage based messaging,
+message sender, metrics and celery workers) mocked out. The number of
+database queries, the number of outbound HTTP calls and the wall time of the
+request are recorded, and the test fails if any endpoint goes over its
+budget. Set ENDPOINT_BUDGET_REPORT to a file path to have the measurements
+written out as JSON, so that they can be compared across commits.
+"""
+import json
+import os
+import re
+import time
+from collections import namedtuple
+from importlib import import_module
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+import responses
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from rest_hooks.models import Hook
+
+from changes.models import Change
+from registrations.models import (
+    Source, Registration, ThirdPartyRegistrationImport, RegistrationIntake)
+from registrations.views import UserDetailList
+from reports.models import ReportTaskStatus
+from uniqueids.models import State
+
+
+ENDPOINT_BUDGET_SECONDS = float(
+    os.environ.get('ENDPOINT_BUDGET_SECONDS', '2.0'))
+
+URLCONFS = (
+    'registrations.urls',
+    'changes.urls',
+    'uniqueids.urls',
+    'reports.urls',
+    'vas2nets.urls',
+)
+
+MOTHER_ID = "4038a518-2940-4b15-9c5c-2b7b123b8735"
+HOUSEHOLD_ID = "4038a518-2940-4b15-9c5c-829385793255"
+OPERATOR_ID = "nurse000-6a07-4377-a4f6-c0485ccba234"
+SUBSCRIPTION_ID = "1b47bab8-1c37-44a2-94e6-85c3ee9a8c8b"
+MSISDN = "+2348031234567"
+
+IDENTITY = {
+    "id": MOTHER_ID,
+    "operator": OPERATOR_ID,
+    "details": {
+        "addresses": {"msisdn": {MSISDN: {"default": True}}},
+        "personnel_code": "11111",
+        "preferred_language": "eng_NG",
+        "preferred_msg_type": "text",
+        "linked_to": HOUSEHOLD_ID,
+    },
+}
+
+SUBSCRIPTION = {
+    "id": SUBSCRIPTION_ID,
+    "identity": MOTHER_ID,
+    "active": True,
+    "completed": False,
+    "process_status": 0,
+    "messageset": 1,
+    "next_sequence_number": 7,
+    "lang": "eng_NG",
+    "schedule": 1,
+    "metadata": {},
+}
+
+MESSAGESET = {
+    "id": 1,
+    "short_name": "postbirth.mother.text.0_12",
+    "content_type": "text",
+    "default_schedule": 1,
+}
+
+SCHEDULE = {"id": 1, "day_of_week": "1,3"}
+
+REGISTRATION_DATA = {
+    "receiver_id": MOTHER_ID,
+    "operator_id": OPERATOR_ID,
+    "language": "eng_NG",
+    "msg_type": "text",
+    "gravida": "1",
+    "last_period_date": "20150202",
+    "msg_receiver": "mother_only",
+}
+
+THIRDPARTY_REGISTRATION = {
+    "mothers_phone_number": "08031234567",
+    "health_worker_personnel_code": "11111",
+    "pregnancy_week": "13",
+    "gravida": "2",
+    "preferred_msg_language": "english",
+    "type_of_registration": "prebirth",
+    "preferred_msg_type": "text",
+    "message_days": "",
+    "message_time": "",
+    "message_receiver": "mother_and_father",
+    "gatekeeper_phone_number": "08031234568",
+}
+
+REPORT_REQUEST = {
+    "start_date": "2016-01-01",
+    "end_date": "2016-02-01",
+    "email_to": ["foo@example.com"],
+}
+
+
+Endpoint = namedtuple(
+    'Endpoint', ['name', 'method', 'path', 'data', 'queries', 'http_calls'])
+
+# Paths are formatted with the ids of the fixtures created in setUp.
+ENDPOINTS = (
+    Endpoint('metrics-list', 'get', '/api/metrics/', None, 3, 0),
+    Endpoint('metrics-fire', 'post', '/api/metrics/', None, 1, 0),
+    Endpoint('health', 'get', '/api/health/', None, 1, 0),
+
+    # registrations.urls
+    Endpoint('api-root', 'get', '/api/v1/', None, 1, 0),
+    Endpoint('user-list', 'get', '/api/v1/user/', None, 6, 0),
+    Endpoint('user-detail', 'get', '/api/v1/user/{user}/', None, 3, 0),
+    Endpoint('group-list', 'get', '/api/v1/group/', None, 2, 0),
+    Endpoint('group-detail', 'get', '/api/v1/group/{group}/', None, 2, 0),
+    Endpoint('source-list', 'get', '/api/v1/source/', None, 2, 0),
+    Endpoint('source-detail', 'get', '/api/v1/source/{source}/', None, 2, 0),
+    Endpoint('webhook-list', 'get', '/api/v1/webhook/', None, 2, 0),
+    Endpoint('webhook-create', 'post', '/api/v1/webhook/', {
+        "target": "http://example.com/registration/",
+        "event": "subscriptionrequest.added",
+    }, 3, 0),
+    Endpoint('webhook-detail', 'get', '/api/v1/webhook/{hook}/', None, 2, 0),
+    Endpoint('registrations-list', 'get', '/api/v1/registrations/',
+             None, 2, 0),
+    Endpoint('registrations-detail', 'get',
+             '/api/v1/registrations/{registration}/', None, 2, 0),
+    Endpoint('registration-create', 'post', '/api/v1/registration/', {
+        "stage": "prebirth",
+        "mother_id": MOTHER_ID,
+        "data": REGISTRATION_DATA,
+    }, 16, 2),
+    Endpoint('registration-update', 'patch',
+             '/api/v1/registration/{registration}/', {
+                 "data": REGISTRATION_DATA,
+             }, 5, 0),
+    Endpoint('user-token', 'post', '/api/v1/user/token/', {
+        "email": "budget@example.com",
+    }, 8, 0),
+    Endpoint('extregistration', 'post', '/api/v1/extregistration/',
+             None, 1, 0),
+    Endpoint('thirdpartyimports-list', 'get', '/api/v1/thirdpartyimports/',
+             None, 2, 0),
+    Endpoint('thirdpartyimports-detail', 'get',
+             '/api/v1/thirdpartyimports/{thirdpartyimport}/', None, 2, 0),
+    Endpoint('addregistration', 'post', '/api/v1/addregistration/',
+             THIRDPARTY_REGISTRATION, 17, 10),
+    Endpoint('addregistration-status', 'get',
+             '/api/v1/addregistration/{intake}/', None, 2, 0),
+    Endpoint('personnelcode', 'get', '/api/v1/personnelcode/', None, 1, 1),
+    Endpoint('send-public-notifications', 'post',
+             '/api/v1/send_public_notifications/', None, 1, 0),
+    Endpoint('missedcall-notification', 'post',
+             '/api/v1/missedcall_notification/', {
+                 "hook": {},
+                 "data": {"identity": MOTHER_ID, "delivered": False},
+             }, 3, 3),
+    Endpoint('subscription-mirror', 'post', '/api/v1/subscription_mirror/', {
+        "hook": {},
+        "data": SUBSCRIPTION,
+    }, 6, 1),
+    Endpoint('user-details', 'get', '/api/v1/user_details/', None, 1, 0),
+
+    # changes.urls
+    Endpoint('changes-list', 'get', '/api/v1/changes/', None, 2, 0),
+    Endpoint('changes-detail', 'get', '/api/v1/changes/{change}/',
+             None, 2, 0),
+    Endpoint('change-create', 'post', '/api/v1/change/', {
+        "mother_id": MOTHER_ID,
+        "action": "change_language",
+        "data": {"household_id": None, "new_language": "ibo_NG"},
+    }, 6, 0),
+    Endpoint('identity-store-optout', 'post', '/api/v1/optout/', {
+        "identity": MOTHER_ID,
+        "optout_reason": "miscarriage",
+        "optout_source": "ussd",
+    }, 3, 0),
+    Endpoint('optout-admin', 'post', '/api/v1/optout_admin/', {
+        "mother_id": MOTHER_ID,
+    }, 15, 0),
+    Endpoint('change-admin', 'post', '/api/v1/change_admin/', {
+        "mother_id": MOTHER_ID,
+        "language": "eng_NG",
+    }, 16, 2),
+    Endpoint('addchange', 'post', '/api/v1/addchange/', {
+        "msisdn": "08031234567",
+        "action": "change_language",
+        "data": {"new_language": "english", "household_id": None},
+    }, 6, 1),
+    Endpoint('addchanges', 'post', '/api/v1/addchanges/', [{
+        "msisdn": "08031234567",
+        "action": "change_language",
+        "data": {"new_language": "english", "household_id": None},
+    }], 6, 1),
+
+    # uniqueids.urls
+    Endpoint('states-list', 'get', '/api/v1/states/', None, 2, 0),
+    Endpoint('states-detail', 'get', '/api/v1/states/{state}/', None, 2, 0),
+    Endpoint('uniqueid', 'post', '/api/v1/uniqueid/', {
+        "data": {"id": MOTHER_ID, "details": {}},
+    }, 3, 0),
+
+    # reports.urls
+    Endpoint('reports-list', 'get', '/api/v1/reports/', None, 1, 0),
+    Endpoint('reports-generate', 'post', '/api/v1/reports/',
+             REPORT_REQUEST, 2, 0),
+    Endpoint('reports-msisdn-messages', 'post',
+             '/api/v1/reports/msisdn-messages/', dict(REPORT_REQUEST, **{
+                 "msisdn_list": [MSISDN],
+             }), 2, 0),
+    Endpoint('reporttasks-list', 'get', '/api/v1/reporttasks/', None, 2, 0),
+    Endpoint('reporttasks-detail', 'get', '/api/v1/reporttasks/{report}/',
+             None, 2, 0),
+
+    # vas2nets.urls
+    Endpoint('fetch-voice-data', 'post', '/api/v1/fetch_voice_data/',
+             None, 1, 0),
+    Endpoint('sync-welcome-audio', 'post', '/api/v1/sync_welcome_audio/',
+             None, 1, 0),
+    Endpoint('resend-last-message', 'post', '/api/v1/resend_last_message/', {
+        "msisdn": "08031234567",
+    }, 1, 3),
+)
+
+
+def paginated(results):
+    return {"next": None, "previous": None, "results": results}
+
+
+def outbound_services():
+    """
+    Returns (method, url regex, json body) for every outbound service call
+    the endpoints can make. The first match wins, so more specific urls
+    must come before less specific ones.
+    """
+    ids = re.escape(settings.IDENTITY_STORE_URL)
+    sbm = re.escape(settings.STAGE_BASED_MESSAGING_URL)
+    ms = re.escape(settings.MESSAGE_SENDER_URL)
+    metrics = re.escape(settings.METRICS_URL)
+
+    return (
+        ('GET', ids + r'/identities/search/', paginated([IDENTITY])),
+        ('GET', ids + r'/optouts/search/', paginated([])),
+        ('GET', ids + r'/identities/[^/]+/addresses/msisdn',
+         paginated([{"address": MSISDN}])),
+        ('GET', ids + r'/identities/[^/]+/', IDENTITY),
+        ('PATCH', ids + r'/identities/[^/]+/', IDENTITY),
+        ('POST', ids + r'/identities/', IDENTITY),
+        ('POST', ids + r'/optout/', {"id": 1}),
+        ('GET', sbm + r'/subscriptions/', paginated([SUBSCRIPTION])),
+        ('PATCH', sbm + r'/subscriptions/[^/]+/', SUBSCRIPTION),
+        ('POST', sbm + r'/subscriptions/[^/]+/resend', {"accepted": True}),
+        ('GET', sbm + r'/messageset_languages/',
+         {"1": settings.LANGUAGES}),
+        ('GET', sbm + r'/messageset/\d+/', MESSAGESET),
+        ('GET', sbm + r'/messageset/', paginated([MESSAGESET])),
+        ('GET', sbm + r'/schedule/\d+/', SCHEDULE),
+        ('POST', ms + r'/outbound/', {"id": 1}),
+        ('POST', metrics, {}),
+    )
+
+
+def leaf_patterns(patterns, prefix=''):
+    """
+    Yields the full regex of every url pattern, following includes.
+    """
+    for pattern in patterns:
+        regex = prefix + pattern.regex.pattern.lstrip('^')
+        if hasattr(pattern, 'url_patterns'):
+            for leaf in leaf_patterns(pattern.url_patterns, regex):
+                yield leaf
+        else:
+            yield regex
+
+
+class EndpointBudgetTest(TestCase):
+
+    def setUp(self):
+        self.requests_mock = responses.RequestsMock(
+            assert_all_requests_are_fired=False)
+        self.requests_mock.start()
+        self.addCleanup(self.requests_mock.stop)
+        self.addCleanup(self.requests_mock.reset)
+        for method, url, body in outbound_services():
+            self.requests_mock.add(
+                method, re.compile(url), json=body, status=200,
+                content_type='application/json')
+
+        # Celery workers are an outbound service too, so nothing that is
+        # queued from the request path gets run inline. The tasks subclass
+        # celery.task.Task, which declares its own apply_async.
+        patcher = mock.patch('celery.task.base.Task.apply_async')
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # The user details view reads from another database over dblink
+        patcher = mock.patch.object(
+            UserDetailList, 'get_data', return_value=[])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.adminuser = User.objects.create_superuser(
+            'testadminuser', 'testadminuser@example.com', 'testadminpass')
+        self.normaluser = User.objects.create_user(
+            'testnormaluser', 'testnormaluser@example.com', 'testnormalpass')
+        token = Token.objects.create(user=self.adminuser)
+        self.adminclient = APIClient()
+        self.adminclient.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        group = Group.objects.create(name='budget')
+        self.adminuser.groups.add(group)
+        source = Source.objects.create(
+            name='test_source_adminuser', authority='hw_full',
+            user=self.adminuser)
+        Source.objects.create(
+            name='test_source_normaluser', authority='patient',
+            user=self.normaluser)
+        hook = Hook.objects.create(
+            user=self.adminuser, event='subscriptionrequest.added',
+            target='http://example.com/registration/')
+        registration = Registration.objects.create(
+            stage='prebirth', mother_id=MOTHER_ID,
+            data=dict(REGISTRATION_DATA), source=source)
+        change = Change.objects.create(
+            mother_id=MOTHER_ID, action='change_language',
+            data={"household_id": None, "new_language": "ibo_NG"},
+            source=source)
+        thirdpartyimport = ThirdPartyRegistrationImport.objects.create(
+            source=source, rows=2, imported=1, failed=1,
+            error_summary={"Operator not found.": 1})
+        intake = RegistrationIntake.objects.create(
+            source=source, data=THIRDPARTY_REGISTRATION)
+        state = State.objects.create(name='Ebonyi')
+        report = ReportTaskStatus.objects.create(
+            start_date='2016-01-01', end_date='2016-02-01',
+            email_subject='Budget', status=ReportTaskStatus.PENDING)
+
+        self.fixture_ids = {
+            'user': self.adminuser.id,
+            'group': group.id,
+            'source': source.id,
+            'hook': hook.id,
+            'registration': registration.id,
+            'change': change.id,
+            'thirdpartyimport': thirdpartyimport.id,
+            'intake': intake.id,
+            'state': state.id,
+            'report': report.id,
+        }
+
+    def measure(self, endpoint):
+        """
+        Requests the endpoint and returns the number of queries, outbound
+        HTTP calls and seconds it took. Any changes the endpoint makes are
+        rolled back afterwards so that the endpoints don't influence each
+        other.
+        """
+        path = endpoint.path.format(**self.fixture_ids)
+        request = getattr(self.adminclient, endpoint.method)
+        data = None
+        if endpoint.data is not None:
+            data = json.dumps(endpoint.data)
+        cache.clear()
+
+        with transaction.atomic():
+            calls_before = len(self.requests_mock.calls)
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                response = request(
+                    path, data, content_type='application/json')
+                seconds = time.time() - start
+            http_calls = len(self.requests_mock.calls) - calls_before
+            transaction.set_rollback(True)
+
+        self.assertLess(
+            response.status_code, 500,
+            "%s %s failed: %s" % (endpoint.method.upper(), path,
+                                  response.content))
+        return {
+            'status_code': response.status_code,
+            'queries': len(queries),
+            'http_calls': http_calls,
+            'seconds': seconds,
+        }
+
+    def test_endpoints_within_budget(self):
+        measurements = {}
+        over_budget = []
+        for endpoint in ENDPOINTS:
+            result = self.measure(endpoint)
+            measurements[endpoint.name] = result
+
+            if result['queries'] > endpoint.queries:
+                over_budget.append('%s: %s queries (budget %s)' % (
+                    endpoint.name, result['queries'], endpoint.queries))
+            if result['http_calls'] > endpoint.http_calls:
+                over_budget.append('%s: %s outbound calls (budget %s)' % (
+                    endpoint.name, result['http_calls'],
+                    endpoint.http_calls))
+            if result['seconds'] > ENDPOINT_BUDGET_SECONDS:
+                over_budget.append('%s: %.3fs (budget %.3fs)' % (
+                    endpoint.name, result['seconds'],
+                    ENDPOINT_BUDGET_SECONDS))
+
+        report_path = os.environ.get('ENDPOINT_BUDGET_REPORT')
+        if report_path:
+            with open(report_path, 'w') as report:
+                json.dump(measurements, report, indent=2, sort_keys=True)
+
+        self.assertEqual(
+            over_budget, [],
+            "Endpoints over budget:\n%s" % '\n'.join(over_budget))
+
+    def test_all_endpoints_have_budgets(self):
+        """
+        Every url in the app urlconfs must be exercised by an endpoint in
+        ENDPOINTS, so that new endpoints don't go unbudgeted.
+        """
+        paths = [
+            endpoint.path.format(**self.fixture_ids).lstrip('/')
+            for endpoint in ENDPOINTS]
+
+        missing = []
+        for urlconf in URLCONFS:
+            patterns = import_module(urlconf).urlpatterns
+            for regex in leaf_patterns(patterns):
+                # Format suffix variants are served by the same views
+                if '(?P<format>' in regex:
+                    continue
+                if not any(re.match('^' + regex, path) for path in paths):
+                    missing.append('%s: %s' % (urlconf, regex))
+
+        self.assertEqual(
+            missing, [], "Urls without a budget:\n%s" % '\n'.join(missing))
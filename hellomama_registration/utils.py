@@ -1,11 +1,18 @@
 import datetime
+import hashlib
 import requests
 import json
 import re
 import six
 from django.conf import settings
-from registrations.models import Source
+from django.core.cache import cache
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+from registrations.models import (
+    Source, MirroredSubscription, MirroredMessageset, MirroredSchedule,
+    SubscriptionMirrorSync)
 from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 from seed_services_client import (
     IdentityStoreApiClient,
     MessageSenderApiClient,
@@ -190,6 +197,60 @@ def get_messageset(messageset_id):
     return stage_based_messaging_client.get_messageset(messageset_id)
 
 
+def get_cached_messageset(messageset_id):
+    """ Returns the messageset, only asking the SBM for it once every
+    MESSAGESET_CACHE_TIMEOUT seconds
+    """
+    key = 'messageset:%s' % messageset_id
+    messageset = cache.get(key)
+    if messageset is None:
+        messageset = get_messageset(messageset_id)
+        cache.set(key, messageset, settings.MESSAGESET_CACHE_TIMEOUT)
+    return messageset
+
+
+def refresh_messageset_languages():
+    """ Fetches the languages available for each messageset from the SBM
+    and caches them for MESSAGESET_CACHE_TIMEOUT seconds
+    """
+    languages = stage_based_messaging_client.get_messageset_languages()
+    cache.set('messageset_languages', languages,
+              settings.MESSAGESET_CACHE_TIMEOUT)
+    return languages
+
+
+def get_messageset_languages():
+    """ Returns the languages available for each messageset, keyed by the
+    messageset id as a string
+    """
+    languages = cache.get('messageset_languages')
+    if languages is None:
+        languages = refresh_messageset_languages()
+    return languages
+
+
+def refresh_messageset_ids():
+    """ Fetches every messageset from the SBM and caches their ids by short
+    name for MESSAGESET_CACHE_TIMEOUT seconds
+    """
+    messagesets = stage_based_messaging_client.get_messagesets()["results"]
+    ids = dict((messageset['short_name'], messageset['id'])
+               for messageset in messagesets)
+    cache.set('messageset_ids', ids, settings.MESSAGESET_CACHE_TIMEOUT)
+    return ids
+
+
+def get_messageset_id(short_name):
+    """ Returns the id of the messageset with the short name, only asking
+    the SBM for it if it isn't in the cached index yet
+    """
+    ids = cache.get('messageset_ids') or {}
+    if short_name not in ids:
+        ids[short_name] = get_messageset_by_shortname(short_name)['id']
+        cache.set('messageset_ids', ids, settings.MESSAGESET_CACHE_TIMEOUT)
+    return ids[short_name]
+
+
 def search_messagesets(params):
     r = stage_based_messaging_client.get_messagesets(params=params)
     return r["results"]
@@ -207,8 +268,13 @@ def get_subscriptions(identity):
 
 
 def search_subscriptions(params):
-    """ Gets the subscriptions based on the params
+    """ Gets the subscriptions based on the params, from the local mirror
+    if SUBSCRIPTION_MIRROR_READS is set and it can answer the search
     """
+    if settings.SUBSCRIPTION_MIRROR_READS and subscription_mirror_ready():
+        subscriptions = search_mirrored_subscriptions(params)
+        if subscriptions is not None:
+            return subscriptions
     r = stage_based_messaging_client.get_subscriptions(params=params)
     return r["results"]
 
@@ -216,8 +282,205 @@ def search_subscriptions(params):
 def patch_subscription(subscription, data):
     """ Patches the given subscription with the data provided
     """
-    return stage_based_messaging_client.update_subscription(
+    result = stage_based_messaging_client.update_subscription(
         subscription["id"], data)
+    update_mirrored_subscription(result)
+    return result
+
+
+class SubscriptionPatchError(Exception):
+    """ For when some of the subscriptions in a bulk patch could not be
+    patched. `failures` is a list of (subscription, error) tuples.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super(SubscriptionPatchError, self).__init__(
+            "%d subscription(s) could not be patched: %s" % (
+                len(failures), '; '.join(
+                    '%s (%s)' % (subscription['id'], error)
+                    for subscription, error in failures)))
+
+
+def patch_subscriptions(subscriptions, data):
+    """ Patches all the subscriptions concurrently, with at most
+    SUBSCRIPTION_PATCH_WORKERS requests in flight. `data` is either the
+    patch for every subscription, or a function that returns the patch for
+    a subscription.
+
+    Every subscription is attempted, and SubscriptionPatchError is raised
+    afterwards if any of them failed.
+    """
+    subscriptions = list(subscriptions)
+
+    def patch(subscription):
+        patch_data = data(subscription) if callable(data) else data
+        try:
+            return stage_based_messaging_client.update_subscription(
+                subscription["id"], patch_data), None
+        except Exception as error:
+            return None, error
+
+    if len(subscriptions) > 1:
+        pool = ThreadPool(
+            min(settings.SUBSCRIPTION_PATCH_WORKERS, len(subscriptions)))
+        try:
+            results = pool.map(patch, subscriptions)
+        finally:
+            pool.close()
+    else:
+        results = [patch(subscription) for subscription in subscriptions]
+
+    failures = []
+    for subscription, (result, error) in zip(subscriptions, results):
+        if error is None:
+            update_mirrored_subscription(result)
+        else:
+            failures.append((subscription, error))
+    if failures:
+        raise SubscriptionPatchError(failures)
+
+    return [result for result, error in results]
+
+
+def deactivate_subscriptions(subscriptions):
+    """ Sets all the subscriptions deactive, see patch_subscriptions
+    """
+    return patch_subscriptions(subscriptions, {"active": False})
+
+
+def as_bool(value):
+    if isinstance(value, six.string_types):
+        return value.lower() == 'true'
+    return bool(value)
+
+
+MIRRORED_SUBSCRIPTION_FILTERS = {
+    'identity': lambda qs, value: qs.filter(identity=value),
+    'active': lambda qs, value: qs.filter(active=as_bool(value)),
+    'completed': lambda qs, value: qs.filter(completed=as_bool(value)),
+    'messageset': lambda qs, value: qs.filter(messageset=value),
+    'lang': lambda qs, value: qs.filter(lang=value),
+    'process_status': lambda qs, value: qs.filter(process_status=value),
+    'messageset_contains': lambda qs, value: qs.filter(
+        messageset_short_name__contains=value),
+    'metadata_has_key': lambda qs, value: qs.filter(
+        metadata__has_key=value),
+    'metadata_not_has_key': lambda qs, value: qs.exclude(
+        metadata__has_key=value),
+}
+
+
+def subscription_mirror_ready():
+    """ Returns True once the mirror has been fully synced with the SBM,
+    before which it could be missing subscriptions. A mirror never stops
+    being ready, so that is remembered.
+    """
+    if cache.get('subscription_mirror_ready'):
+        return True
+    ready = SubscriptionMirrorSync.objects.filter(
+        name=SubscriptionMirrorSync.SUBSCRIPTIONS,
+        full_sync_at__isnull=False).exists()
+    if ready:
+        cache.set('subscription_mirror_ready', True)
+    return ready
+
+
+def search_mirrored_subscriptions(params):
+    """ Searches the local subscription mirror the way the SBM would, or
+    returns None if the search uses a filter the mirror can't answer
+    """
+    queryset = MirroredSubscription.objects.order_by('created_at', 'id')
+    for key, value in params.items():
+        if key not in MIRRORED_SUBSCRIPTION_FILTERS:
+            return None
+        queryset = MIRRORED_SUBSCRIPTION_FILTERS[key](queryset, value)
+    return (subscription.as_dict() for subscription in queryset.iterator())
+
+
+def update_mirrored_subscription(result):
+    """ Writes a subscription returned by the SBM through to the mirror, if
+    the mirror is being read from
+    """
+    if settings.SUBSCRIPTION_MIRROR_READS and \
+            isinstance(result, dict) and 'id' in result:
+        mirror_subscription(result)
+
+
+def mirror_subscription(subscription):
+    """ Creates or updates the local copy of an SBM subscription, unless the
+    copy is already newer, since webhooks can arrive out of order. A copy
+    with the same updated_at is overwritten, since the SBM can save a
+    subscription more than once within the same timestamp.
+    """
+    messageset = get_cached_messageset(subscription['messageset'])
+    fields = {
+        'messageset_short_name': messageset['short_name'],
+        'metadata': subscription.get('metadata') or {},
+    }
+    for field in ('identity', 'messageset', 'next_sequence_number', 'lang',
+                  'active', 'completed', 'process_status', 'schedule',
+                  'created_at', 'updated_at'):
+        if field in subscription:
+            fields[field] = subscription[field]
+
+    subscriptions = MirroredSubscription.objects.filter(
+        id=subscription['id'])
+    if fields.get('updated_at') is not None:
+        subscriptions = subscriptions.filter(
+            Q(updated_at__isnull=True) |
+            Q(updated_at__lte=fields['updated_at']))
+    if not subscriptions.update(synced_at=timezone.now(), **fields):
+        MirroredSubscription.objects.get_or_create(
+            id=subscription['id'], defaults=fields)
+
+
+def messages_per_week(day_of_week):
+    """ Returns how many messages a week a schedule sends, from its
+    comma-seperated days of the week, e.g. 2 for '1,3'
+    """
+    return len(day_of_week.split(','))
+
+
+def mirror_messageset(messageset):
+    """ Creates or updates the local copy of an SBM messageset """
+    return MirroredMessageset.objects.update_or_create(
+        id=messageset['id'], defaults={
+            'short_name': messageset['short_name'],
+            'default_schedule': messageset.get('default_schedule'),
+        })[0]
+
+
+def mirror_schedule(schedule):
+    """ Creates or updates the local copy of an SBM schedule """
+    return MirroredSchedule.objects.update_or_create(
+        id=schedule['id'], defaults={
+            'day_of_week': schedule['day_of_week'],
+            'messages_per_week': messages_per_week(schedule['day_of_week']),
+        })[0]
+
+
+def get_mirrored_messageset(messageset_id=None, short_name=None):
+    """ Returns the local copy of the messageset with the id or short name,
+    copying it from the SBM if it hasn't been synced yet
+    """
+    try:
+        if messageset_id is not None:
+            return MirroredMessageset.objects.get(id=messageset_id)
+        return MirroredMessageset.objects.get(short_name=short_name)
+    except MirroredMessageset.DoesNotExist:
+        if messageset_id is not None:
+            return mirror_messageset(get_messageset(messageset_id))
+        return mirror_messageset(get_messageset_by_shortname(short_name))
+
+
+def get_mirrored_schedule(schedule_id):
+    """ Returns the local copy of the schedule, copying it from the SBM if
+    it hasn't been synced yet
+    """
+    try:
+        return MirroredSchedule.objects.get(id=schedule_id)
+    except MirroredSchedule.DoesNotExist:
+        return mirror_schedule(get_schedule(schedule_id))
 
 
 def resend_subscription(subscription_id):
@@ -301,22 +564,57 @@ def post_message(payload):
     return message_sender_client.create_outbound(payload)
 
 
-def get_available_metrics():
+def build_available_metrics():
     available_metrics = []
     available_metrics.extend(settings.METRICS_REALTIME)
     available_metrics.extend(settings.METRICS_SCHEDULED)
 
-    sources = Source.objects.all()
-    for source in sources:
+    usernames = Source.objects.values_list('user__username', flat=True)
+    for username in usernames:
         # only append usernames with characters that are all alphanumeric
         # and/or underscores
-        if re.match(r'\w+$', source.user.username):
+        if re.match(r'\w+$', username):
             available_metrics.append(
-                "registrations.source.%s.sum" % source.user.username)
+                "registrations.source.%s.sum" % username)
 
     return available_metrics
 
 
+def available_metrics_cache_key():
+    """
+    Returns the cache key for the available metrics catalog. The key
+    changes whenever a source is added, changed or removed, so every
+    process sees the new catalog without having to be told about it.
+    """
+    sources = Source.objects.aggregate(
+        count=Count('id'), updated_at=Max('updated_at'))
+    updated_at = sources['updated_at']
+    return 'available_metrics:%s:%s' % (
+        sources['count'],
+        updated_at.isoformat() if updated_at is not None else '')
+
+
+def get_available_metrics_catalog():
+    """
+    Returns a dict with the list of available `metrics`, and a `version`
+    that changes whenever the list changes. The catalog is cached under the
+    current version of the sources, for AVAILABLE_METRICS_CACHE_TIMEOUT.
+    """
+    key = available_metrics_cache_key()
+    catalog = cache.get(key)
+    if catalog is None:
+        metrics = build_available_metrics()
+        version = hashlib.md5(
+            json.dumps(metrics).encode('utf-8')).hexdigest()
+        catalog = {'version': version, 'metrics': metrics}
+        cache.set(key, catalog, settings.AVAILABLE_METRICS_CACHE_TIMEOUT)
+    return catalog
+
+
+def get_available_metrics():
+    return list(get_available_metrics_catalog()['metrics'])
+
+
 def normalise_string(string):
     """ Strips trailing whitespace from string, lowercases it and replaces
         spaces with underscores
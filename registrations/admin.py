@@ -7,7 +7,9 @@ from django.template.response import TemplateResponse
 
 from hellomama_registration.utils import get_available_metrics
 from .models import (Source, Registration, SubscriptionRequest,
-                     ThirdPartyRegistrationError)
+                     ThirdPartyRegistrationError, HookDelivery, HookTarget,
+                     ThirdPartyRegistrationImport, RegistrationIntake,
+                     PublicNotificationRun)
 from .tasks import repopulate_metrics
 
 
@@ -84,7 +86,58 @@ class SubscriptionRequestAdmin(admin.ModelAdmin):
 
 
 class ThirdPartyRegistrationErrorAdmin(admin.ModelAdmin):
-    list_display = ['id', 'data', 'created_at', 'updated_at']
+    list_display = ['id', 'data', 'registration_import', 'created_at',
+                    'updated_at']
+
+
+class ThirdPartyRegistrationImportAdmin(admin.ModelAdmin):
+    list_display = [
+        "id", "source", "rows", "imported", "skipped", "failed",
+        "rows_per_second", "created_at", "finished_at"]
+    list_filter = ["source", "created_at"]
+
+
+class RegistrationIntakeAdmin(admin.ModelAdmin):
+    list_display = [
+        "id", "source", "status", "registration", "created_at", "updated_at"]
+    list_filter = ["status", "source", "created_at"]
+    readonly_fields = ["created_at", "updated_at"]
+
+
+class PublicNotificationRunAdmin(admin.ModelAdmin):
+    list_display = [
+        "id", "processed", "notifications", "subscriptions_per_second",
+        "created_at", "finished_at"]
+    list_filter = ["created_at"]
+
+
+class HookDeliveryAdmin(admin.ModelAdmin):
+    list_display = [
+        "id", "instance_id", "target", "status", "attempts",
+        "next_attempt_at", "created_at", "delivered_at"]
+    list_filter = ["status", "target", "created_at"]
+    search_fields = ["instance_id"]
+    readonly_fields = ["created_at", "delivered_at"]
+
+
+class HookTargetAdmin(admin.ModelAdmin):
+    list_display = [
+        "target", "batch_deliveries", "max_concurrency", "concurrency",
+        "success_rate", "latency_p50", "latency_p95", "consecutive_failures",
+        "last_success_at", "last_failure_at", "suspended_until"]
+    list_filter = ["batch_deliveries"]
+    search_fields = ["target"]
+    readonly_fields = [
+        "attempts", "failures", "consecutive_failures", "recent_latencies",
+        "last_success_at", "last_failure_at", "concurrency", "success_rate",
+        "latency_p50", "latency_p95"]
+    actions = ["resume_targets"]
+
+    def resume_targets(self, request, queryset):
+        updated = queryset.update(consecutive_failures=0,
+                                  suspended_until=None)
+        self.message_user(request, "%d target(s) resumed" % updated)
+    resume_targets.short_description = "Resume deliveries to the targets"
 
 
 admin.site.register(Source)
@@ -92,3 +145,9 @@ admin.site.register(Registration, RegistrationAdmin)
 admin.site.register(SubscriptionRequest, SubscriptionRequestAdmin)
 admin.site.register(ThirdPartyRegistrationError,
                     ThirdPartyRegistrationErrorAdmin)
+admin.site.register(ThirdPartyRegistrationImport,
+                    ThirdPartyRegistrationImportAdmin)
+admin.site.register(RegistrationIntake, RegistrationIntakeAdmin)
+admin.site.register(PublicNotificationRun, PublicNotificationRunAdmin)
+admin.site.register(HookDelivery, HookDeliveryAdmin)
+admin.site.register(HookTarget, HookTargetAdmin)
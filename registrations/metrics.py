@@ -11,101 +11,112 @@ from changes.models import Change
 
 
 class MetricGenerator(object):
-    def __init__(self):
+    """
+    Generates historical values for the available metrics.
+
+    Metrics that are parameterised (eg. `registrations.language.eng_NG.sum`)
+    are looked up in a class level table that maps the metric name to the
+    method that generates it, and the arguments to call it with. The table is
+    built the first time it is needed, and is shared by all instances, so
+    creating a MetricGenerator is cheap. Metrics without parameters map
+    directly to the method with the same name, with dots replaced by
+    underscores.
+    """
+    _metrics = None
+
+    @classmethod
+    def build_metrics(cls):
+        """
+        Returns a dict mapping each parameterised metric name to a tuple of
+        (method name, args).
+        """
+        metrics = {}
+
+        def add(name, method, *args):
+            metrics[name] = (method, args)
+
         for msg_type in settings.MSG_TYPES:
-            setattr(
-                self, 'registrations_msg_type_{}_sum'.format(msg_type),
-                partial(self.registrations_msg_type_sum, msg_type)
-            )
-            setattr(
-                self, 'registrations_msg_type_{}_total_last'.format(msg_type),
-                partial(self.registrations_msg_type_total_last, msg_type)
-            )
-            setattr(
-                self, 'optout_msg_type_{}_sum'.format(msg_type),
-                partial(self.optout_msg_type_sum, msg_type)
-            )
-            setattr(
-                self, 'optout_msg_type_{}_total_last'.format(msg_type),
-                partial(self.optout_msg_type_total_last, msg_type)
-            )
+            add('registrations.msg_type.{}.sum'.format(msg_type),
+                'registrations_msg_type_sum', msg_type)
+            add('registrations.msg_type.{}.total.last'.format(msg_type),
+                'registrations_msg_type_total_last', msg_type)
+            add('optout.msg_type.{}.sum'.format(msg_type),
+                'optout_msg_type_sum', msg_type)
+            add('optout.msg_type.{}.total.last'.format(msg_type),
+                'optout_msg_type_total_last', msg_type)
         for receiver_type in settings.RECEIVER_TYPES:
-            setattr(
-                self, 'registrations_receiver_type_{}_sum'.format(
-                    receiver_type),
-                partial(self.registrations_receiver_type_sum, receiver_type)
-            )
-            setattr(
-                self, 'registrations_receiver_type_{}_total_last'.format(
-                    receiver_type),
-                partial(
-                    self.registrations_receiver_type_total_last, receiver_type)
-            )
-            setattr(
-                self, 'optout_receiver_type_{}_sum'.format(
-                    receiver_type),
-                partial(
-                    self.optout_receiver_type_sum, receiver_type)
-            )
-            setattr(
-                self, 'optout_receiver_type_{}_total_last'.format(
-                    receiver_type),
-                partial(
-                    self.optout_receiver_type_total_last, receiver_type)
-            )
+            add('registrations.receiver_type.{}.sum'.format(receiver_type),
+                'registrations_receiver_type_sum', receiver_type)
+            add('registrations.receiver_type.{}.total.last'.format(
+                receiver_type),
+                'registrations_receiver_type_total_last', receiver_type)
+            add('optout.receiver_type.{}.sum'.format(receiver_type),
+                'optout_receiver_type_sum', receiver_type)
+            add('optout.receiver_type.{}.total.last'.format(receiver_type),
+                'optout_receiver_type_total_last', receiver_type)
         for language in settings.LANGUAGES:
-            setattr(
-                self, 'registrations_language_{}_sum'.format(language),
-                partial(self.registrations_language_sum, language)
-            )
-            setattr(
-                self, 'registrations_language_{}_total_last'.format(language),
-                partial(self.registrations_language_total_last, language)
-            )
+            add('registrations.language.{}.sum'.format(language),
+                'registrations_language_sum', language)
+            add('registrations.language.{}.total.last'.format(language),
+                'registrations_language_total_last', language)
         for state in settings.STATES:
-            setattr(
-                self, 'registrations_state_{}_sum'.format(state),
-                partial(self.registrations_state_sum, state)
-            )
-            setattr(
-                self, 'registrations_state_{}_total_last'.format(state),
-                partial(self.registrations_state_total_last, state)
-            )
+            add('registrations.state.{}.sum'.format(state),
+                'registrations_state_sum', state)
+            add('registrations.state.{}.total.last'.format(state),
+                'registrations_state_total_last', state)
         for role in settings.ROLES:
-            setattr(
-                self, 'registrations_role_{}_sum'.format(role),
-                partial(self.registrations_role_sum, role)
-            )
-            setattr(
-                self, 'registrations_role_{}_total_last'.format(role),
-                partial(self.registrations_role_total_last, role)
-            )
+            add('registrations.role.{}.sum'.format(role),
+                'registrations_role_sum', role)
+            add('registrations.role.{}.total.last'.format(role),
+                'registrations_role_total_last', role)
         for reason in settings.OPTOUT_REASONS:
-            setattr(
-                self, 'optout_reason_{}_sum'.format(reason),
-                partial(self.optout_reason_sum, reason)
-            )
-            setattr(
-                self, 'optout_reason_{}_total_last'.format(reason),
-                partial(self.optout_reason_total_last, reason)
-            )
+            add('optout.reason.{}.sum'.format(reason),
+                'optout_reason_sum', reason)
+            add('optout.reason.{}.total.last'.format(reason),
+                'optout_reason_total_last', reason)
         for source in settings.OPTOUT_SOURCES:
-            setattr(
-                self, 'optout_source_{}_sum'.format(source),
-                partial(self.optout_source_sum, source)
-            )
-            setattr(
-                self, 'optout_source_{}_total_last'.format(source),
-                partial(self.optout_source_total_last, source)
-            )
-        sources = Source.objects.all()
-        sources.prefetch_related('user')
-        for source in Source.objects.all():
-            username = source.user.username
-            setattr(
-                self, 'registrations_source_{}_sum'.format(username),
-                partial(self.registrations_source_sum, username)
-            )
+            add('optout.source.{}.sum'.format(source),
+                'optout_source_sum', source)
+            add('optout.source.{}.total.last'.format(source),
+                'optout_source_total_last', source)
+
+        usernames = Source.objects.values_list('user__username', flat=True)
+        for username in usernames:
+            add('registrations.source.{}.sum'.format(username),
+                'registrations_source_sum', username)
+
+        return metrics
+
+    @classmethod
+    def get_metrics(cls, refresh=False):
+        if cls._metrics is None or refresh:
+            cls._metrics = cls.build_metrics()
+        return cls._metrics
+
+    @classmethod
+    def clear_metrics(cls):
+        """
+        Forces the metrics table to be rebuilt the next time it is used.
+        Called whenever a Source changes, since there is a metric per source.
+        """
+        cls._metrics = None
+
+    def get_metric_func(self, name):
+        """
+        Returns a function that takes the start and end datetimes, and
+        returns the value of the named metric.
+        """
+        metrics = self.get_metrics()
+        if (name not in metrics and
+                name.startswith('registrations.source.')):
+            # The source could have been added by another process
+            metrics = self.get_metrics(refresh=True)
+
+        if name in metrics:
+            method, args = metrics[name]
+            return partial(getattr(self, method), *args)
+
+        return getattr(self, name.replace('.', '_'))
 
     def generate_metric(self, name, start, end):
         """
@@ -116,7 +127,7 @@ class MetricGenerator(object):
             start: Datetime for where the metric window starts
             end: Datetime for where the metric window ends
         """
-        metric_func = getattr(self, name.replace('.', '_'))
+        metric_func = self.get_metric_func(name)
         return metric_func(start, end)
 
     def registrations_created_sum(self, start, end):
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_public_identities(apps, schema_editor):
+    Registration = apps.get_model('registrations', 'Registration')
+    PublicRegistrationIdentity = apps.get_model(
+        'registrations', 'PublicRegistrationIdentity')
+
+    identities = Registration.objects.filter(
+        stage='public', validated=True).values_list(
+        'mother_id', flat=True).distinct()
+
+    PublicRegistrationIdentity.objects.bulk_create((
+        PublicRegistrationIdentity(identity=identity)
+        for identity in identities.iterator()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0009_create_get_registrations_view'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublicRegistrationIdentity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identity', models.CharField(max_length=36, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunPython(
+            populate_public_identities, migrations.RunPython.noop),
+    ]
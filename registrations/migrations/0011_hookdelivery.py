@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 10:04
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0010_publicregistrationidentity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HookDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hook_id', models.IntegerField(blank=True, null=True)),
+                ('target', models.URLField(max_length=255)),
+                ('payload', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('instance_id', models.CharField(blank=True, max_length=36, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('delivered', 'Delivered'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='hookdelivery',
+            index_together=set([('status', 'next_attempt_at')]),
+        ),
+    ]
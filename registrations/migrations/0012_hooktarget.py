@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 10:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0011_hookdelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HookTarget',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target', models.URLField(max_length=255, unique=True)),
+                ('batch_deliveries', models.BooleanField(default=False)),
+                ('max_batch_size', models.IntegerField(default=100)),
+                ('max_concurrency', models.IntegerField(default=4)),
+                ('batch_scheduled_until', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HookSlot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target', models.URLField(max_length=255)),
+                ('slot', models.IntegerField()),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='hookslot',
+            unique_together=set([('target', 'slot')]),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 11:20
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0012_hooktarget'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hooktarget',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='hooktarget',
+            name='failures',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='hooktarget',
+            name='consecutive_failures',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='hooktarget',
+            name='recent_latencies',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='hooktarget',
+            name='last_success_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='hooktarget',
+            name='last_failure_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='hooktarget',
+            name='suspended_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 13:15
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0014_thirdpartyregistrationimport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thirdpartyregistrationerror',
+            name='registration_import',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='errors', to='registrations.ThirdPartyRegistrationImport'),
+        ),
+        migrations.AddField(
+            model_name='thirdpartyregistrationimport',
+            name='error_summary',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict),
+        ),
+    ]
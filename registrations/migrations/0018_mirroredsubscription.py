@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 15:12
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0017_publicnotificationrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MirroredSubscription',
+            fields=[
+                ('id', models.UUIDField(primary_key=True, serialize=False)),
+                ('identity', models.CharField(db_index=True, max_length=36)),
+                ('messageset', models.IntegerField()),
+                ('messageset_short_name', models.CharField(blank=True, max_length=100)),
+                ('next_sequence_number', models.IntegerField(default=1)),
+                ('lang', models.CharField(blank=True, max_length=6)),
+                ('active', models.BooleanField(default=True)),
+                ('completed', models.BooleanField(default=False)),
+                ('process_status', models.IntegerField(default=0)),
+                ('schedule', models.IntegerField(blank=True, null=True)),
+                ('metadata', django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SubscriptionMirrorSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('synced_until', models.DateTimeField(blank=True, null=True)),
+                ('full_sync_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='mirroredsubscription',
+            index_together=set([('identity', 'active')]),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 15:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_participants(apps, schema_editor):
+    Registration = apps.get_model('registrations', 'Registration')
+    RegistrationParticipant = apps.get_model(
+        'registrations', 'RegistrationParticipant')
+
+    def participants():
+        registrations = Registration.objects.values_list(
+            'id', 'mother_id', 'data', 'created_at')
+        for id, mother_id, data, created_at in registrations.iterator():
+            if mother_id:
+                yield RegistrationParticipant(
+                    identity=mother_id, role='mother', registration_id=id,
+                    created_at=created_at)
+            receiver_id = (data or {}).get('receiver_id')
+            if receiver_id:
+                yield RegistrationParticipant(
+                    identity=receiver_id, role='receiver',
+                    registration_id=id, created_at=created_at)
+
+    RegistrationParticipant.objects.bulk_create(
+        participants(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0018_mirroredsubscription'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrationParticipant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identity', models.CharField(max_length=36)),
+                ('role', models.CharField(choices=[('mother', 'Mother'), ('receiver', 'Receiver')], max_length=8)),
+                ('created_at', models.DateTimeField()),
+                ('registration', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participants', to='registrations.Registration')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='registrationparticipant',
+            index_together=set([('identity', 'created_at')]),
+        ),
+        migrations.RunPython(
+            populate_participants, migrations.RunPython.noop),
+    ]
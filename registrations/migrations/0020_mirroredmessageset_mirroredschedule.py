@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-19 18:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0019_registrationparticipant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MirroredMessageset',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('short_name', models.CharField(max_length=100, unique=True)),
+                ('default_schedule', models.IntegerField(blank=True, null=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MirroredSchedule',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('day_of_week', models.CharField(max_length=64)),
+                ('messages_per_week', models.IntegerField()),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
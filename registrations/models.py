@@ -1,12 +1,17 @@
+import json
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 
+from django.conf import settings
 from django.contrib.postgres.fields import JSONField
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
 
@@ -33,6 +38,28 @@ class Source(models.Model):
         return "%s" % self.name
 
 
+@receiver(post_save, sender=Source)
+@receiver(post_delete, sender=Source)
+def source_changed(sender, instance, **kwargs):
+    """ There is a metric per source username, so the available metrics
+        need to be rebuilt whenever the sources change
+    """
+    from .metrics import MetricGenerator
+    MetricGenerator.clear_metrics()
+
+
+@receiver(post_save, sender=User)
+def source_user_changed(sender, instance, update_fields=None, **kwargs):
+    """ The available metrics also need to be rebuilt when a user with a
+        source is saved, since their username could have changed. Saves
+        that don't touch the username, like recording a login, are skipped.
+    """
+    if update_fields is not None and 'username' not in update_fields:
+        return
+    if instance.sources.exists():
+        source_changed(sender, instance, **kwargs)
+
+
 class RegistrationException(Exception):
     pass
 
@@ -79,6 +106,46 @@ class Registration(models.Model):
     def __str__(self):
         return str(self.id)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Registration, cls).from_db(db, field_names, values)
+        if 'mother_id' in field_names and 'data' in field_names:
+            instance._participants = instance.get_participants()
+        return instance
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super(Registration, self).save(*args, **kwargs)
+
+        # Keep the RegistrationParticipant index up to date, only touching
+        # it when the mother or receiver changed
+        participants = self.get_participants()
+        if created or participants != getattr(self, '_participants', None):
+            if not created:
+                RegistrationParticipant.objects.filter(
+                    registration=self).delete()
+            RegistrationParticipant.objects.bulk_create([
+                RegistrationParticipant(
+                    identity=identity, role=role, registration=self,
+                    created_at=self.created_at)
+                for identity, role in participants])
+            self._participants = participants
+
+    def get_participants(self):
+        """
+        :returns: set of (identity, role) tuples for the people this
+            registration is for
+        """
+        participants = set()
+        if self.mother_id:
+            participants.add(
+                (self.mother_id, RegistrationParticipant.MOTHER))
+        receiver_id = (self.data or {}).get('receiver_id')
+        if receiver_id:
+            participants.add(
+                (receiver_id, RegistrationParticipant.RECEIVER))
+        return participants
+
     def get_voice_days_and_times(self):
         return self.data.get('voice_days'), self.data.get('voice_times')
 
@@ -119,6 +186,51 @@ class Registration(models.Model):
             today, self.data['last_period_date'])
 
 
+@python_2_unicode_compatible
+class RegistrationParticipant(models.Model):
+    """ An index of the identities each registration is for, so that the
+    registrations for an identity can be found whether it is the mother or
+    the receiver. Maintained by Registration.save.
+
+    Args:
+        identity (str): The identity the registration is for
+        role (str): Whether the identity is the mother or the receiver
+        created_at (datetime): When the registration was created
+    """
+    MOTHER = 'mother'
+    RECEIVER = 'receiver'
+    ROLE_CHOICES = (
+        (MOTHER, "Mother"),
+        (RECEIVER, "Receiver"),
+    )
+
+    identity = models.CharField(max_length=36)
+    registration = models.ForeignKey(Registration,
+                                     related_name='participants',
+                                     on_delete=models.CASCADE)
+    role = models.CharField(max_length=8, choices=ROLE_CHOICES)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        index_together = (('identity', 'created_at'),)
+
+    @classmethod
+    def get_latest_registration(cls, identity, roles=None):
+        """
+        Returns the latest registration for the identity in any of the
+        roles, or None if there isn't one
+        """
+        participants = cls.objects.filter(identity=identity)
+        if roles is not None:
+            participants = participants.filter(role__in=roles)
+        participant = participants.select_related(
+            'registration').order_by('-created_at').first()
+        return participant and participant.registration
+
+    def __str__(self):
+        return "%s %s" % (self.role, self.identity)
+
+
 @receiver(post_save, sender=Registration)
 def registration_post_save(sender, instance, created, **kwargs):
     """ Post save hook to fire Registration validation task
@@ -172,7 +284,7 @@ def fire_unique_operator_metric(sender, instance, created, **kwargs):
         })
 
 
-def get_or_incr_cache(key, func):
+def get_or_incr_cache(key, func, amount=1):
     """
     Used to either get a value from the cache, or if the value doesn't exist
     in the cache, run the function to get a value to use to populate the cache
@@ -182,8 +294,8 @@ def get_or_incr_cache(key, func):
         value = func()
         cache.set(key, value)
     else:
-        cache.incr(key)
-        value += 1
+        cache.incr(key, amount)
+        value += amount
     return value
 
 
@@ -351,6 +463,13 @@ class SubscriptionRequest(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def save(self, *args, **kwargs):
+        # The subscriptionrequest.added webhook is written to the
+        # HookDelivery outbox by a post_save receiver, so keep it in the same
+        # transaction as the SubscriptionRequest itself
+        with transaction.atomic():
+            super(SubscriptionRequest, self).save(*args, **kwargs)
+
     def serialize_hook(self, hook):
         # optional, there are serialization defaults
         # we recommend always sending the Hook
@@ -381,8 +500,482 @@ class ThirdPartyRegistrationError(models.Model):
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     data = JSONField(null=True, blank=True)
+    registration_import = models.ForeignKey(
+        'ThirdPartyRegistrationImport', related_name='errors', null=True,
+        blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+@python_2_unicode_compatible
+class ThirdPartyRegistrationImport(models.Model):
+    """ A run of the third party registration pull, with its progress.
+
+    Args:
+        source (object): The source the registrations are created for
+        rows (int): The number of spreadsheet rows read so far
+        skipped (int): Rows that were already imported by an earlier run
+        imported (int): Rows that resulted in a registration
+        failed (int): Rows that resulted in a ThirdPartyRegistrationError
+        error_summary (json): The number of failed rows per error message
+        finished_at (datetime): When the run completed
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    source = models.ForeignKey(Source, related_name='third_party_imports',
+                               null=False)
+    rows = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)
+    imported = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    error_summary = JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def rows_per_second(self):
+        end = self.finished_at or timezone.now()
+        seconds = (end - self.created_at).total_seconds()
+        if seconds <= 0:
+            return None
+        return self.rows / seconds
 
     def __str__(self):
         return str(self.id)
+
+
+@python_2_unicode_compatible
+class ThirdPartyRegistrationRow(models.Model):
+    """ A third party spreadsheet row that has been imported, so that it is
+    skipped by later runs of the pull.
+
+    Args:
+        key (str): The SHA-256 hex digest of the row's contents
+    """
+    key = models.CharField(max_length=64, unique=True)
+    registration_import = models.ForeignKey(
+        ThirdPartyRegistrationImport, related_name='imported_rows',
+        null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key
+
+
+@python_2_unicode_compatible
+class RegistrationIntake(models.Model):
+    """ A registration pushed to the add registration endpoint, waiting to
+    be processed by a worker.
+
+    Args:
+        source (object): The source of the user that pushed the registration
+        data (json): The registration as it was pushed
+        status (str): How far processing has got
+        error (str): Why the registration could not be created, if it failed
+        registration (object): The registration that was created
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (PROCESSING, "Processing"),
+        (COMPLETED, "Completed"),
+        (FAILED, "Failed"),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    source = models.ForeignKey(Source, related_name='registration_intakes',
+                               null=False)
+    data = JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING)
+    error = models.TextField(blank=True, default='')
+    registration = models.ForeignKey(
+        Registration, related_name='+', null=True, blank=True,
+        on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+@python_2_unicode_compatible
+class PublicNotificationRun(models.Model):
+    """ A run of the public registration notifications task, which is the
+    checkpoint an interrupted run resumes from.
+
+    Args:
+        processed (int): The number of public subscriptions checked so far
+        details (json): The msisdns still to be sent to each CORP, by the
+            CORP's identity id
+        notifications (int): The number of CORPs notified once finished
+        finished_at (datetime): When the notifications were sent
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    processed = models.IntegerField(default=0)
+    details = JSONField(default=dict, blank=True)
+    notifications = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def subscriptions_per_second(self):
+        end = self.finished_at or timezone.now()
+        seconds = (end - self.created_at).total_seconds()
+        if seconds <= 0:
+            return None
+        return self.processed / seconds
+
+    def __str__(self):
+        return str(self.id)
+
+
+@python_2_unicode_compatible
+class MirroredSubscription(models.Model):
+    """ A read-only copy of a subscription in the stage based messaging
+    service, kept up to date by its webhooks and a periodic sync, so that
+    subscription lookups can be answered locally.
+
+    Args:
+        id (uuid): The id of the subscription in the SBM
+        messageset_short_name (str): The short name of the messageset, so
+            that `messageset_contains` searches can be answered
+        updated_at (datetime): When the SBM last changed the subscription
+        synced_at (datetime): When this copy was last updated
+    """
+    id = models.UUIDField(primary_key=True)
+    identity = models.CharField(max_length=36, db_index=True)
+    messageset = models.IntegerField()
+    messageset_short_name = models.CharField(max_length=100, blank=True)
+    next_sequence_number = models.IntegerField(default=1)
+    lang = models.CharField(max_length=6, blank=True)
+    active = models.BooleanField(default=True)
+    completed = models.BooleanField(default=False)
+    process_status = models.IntegerField(default=0)
+    schedule = models.IntegerField(null=True, blank=True)
+    metadata = JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        index_together = (('identity', 'active'),)
+
+    def as_dict(self):
+        """ Returns the subscription the way the SBM API would """
+        return {
+            'id': str(self.id),
+            'identity': self.identity,
+            'messageset': self.messageset,
+            'next_sequence_number': self.next_sequence_number,
+            'lang': self.lang,
+            'active': self.active,
+            'completed': self.completed,
+            'process_status': self.process_status,
+            'schedule': self.schedule,
+            'metadata': self.metadata,
+            'created_at': self.created_at and self.created_at.isoformat(),
+            'updated_at': self.updated_at and self.updated_at.isoformat(),
+        }
+
+    def __str__(self):
+        return str(self.id)
+
+
+@python_2_unicode_compatible
+class SubscriptionMirrorSync(models.Model):
+    """ How far a periodic sync has copied subscriptions from the stage
+    based messaging service into the mirror, with one row per sync name.
+
+    The webhooks write to the mirror too, so the sync keeps its own cursor
+    rather than going by the latest subscription in the mirror.
+
+    Args:
+        name (str): Which sync this is the cursor for
+        synced_until (datetime): The latest SBM updated_at the sync has
+            copied
+        full_sync_at (datetime): When the first full sync finished, after
+            which the mirror can answer subscription searches
+    """
+    SUBSCRIPTIONS = 'subscriptions'
+
+    name = models.CharField(max_length=100, unique=True)
+    synced_until = models.DateTimeField(null=True, blank=True)
+    full_sync_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def get(cls, name=SUBSCRIPTIONS):
+        return cls.objects.get_or_create(name=name)[0]
+
+    def __str__(self):
+        return "%s synced until %s" % (self.name, self.synced_until)
+
+
+@python_2_unicode_compatible
+class MirroredMessageset(models.Model):
+    """ A copy of a messageset in the stage based messaging service, kept
+    up to date by a periodic sync, so that changes can be worked out
+    without asking the SBM.
+
+    Args:
+        id (int): The id of the messageset in the SBM
+        default_schedule (int): The id of the messageset's default schedule
+        synced_at (datetime): When this copy was last updated
+    """
+    id = models.IntegerField(primary_key=True)
+    short_name = models.CharField(max_length=100, unique=True)
+    default_schedule = models.IntegerField(null=True, blank=True)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.short_name
+
+
+@python_2_unicode_compatible
+class MirroredSchedule(models.Model):
+    """ A copy of a schedule in the stage based messaging service, with the
+    number of messages it sends each week worked out from its days.
+
+    Args:
+        id (int): The id of the schedule in the SBM
+        day_of_week (str): Comma separated days, e.g. '1,3' for Mon & Wed
+        messages_per_week (int): How many days are in day_of_week
+        synced_at (datetime): When this copy was last updated
+    """
+    id = models.IntegerField(primary_key=True)
+    day_of_week = models.CharField(max_length=64)
+    messages_per_week = models.IntegerField()
+    synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.id, self.day_of_week)
+
+
+@python_2_unicode_compatible
+class PublicRegistrationIdentity(models.Model):
+    """ The identities that have had a validated public registration.
+
+    Only these identities can have public subscriptions that need to be
+    stopped when they do a full registration, so we can avoid searching the
+    Stage Based Messaging service for everyone else.
+    """
+
+    identity = models.CharField(max_length=36, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.identity
+
+
+@python_2_unicode_compatible
+class HookDelivery(models.Model):
+    """ An outbox entry for a webhook that needs to be delivered.
+
+    Entries are written in the same transaction as the instance that
+    triggered the hook, and are retried with a backoff until the target
+    accepts them, so every hook is delivered at least once.
+    """
+    PENDING = 'pending'
+    DELIVERED = 'delivered'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (DELIVERED, "Delivered"),
+        (FAILED, "Failed"),
+    )
+
+    hook_id = models.IntegerField(null=True, blank=True)
+    target = models.URLField(max_length=255)
+    payload = JSONField()
+    instance_id = models.CharField(max_length=36, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = (('status', 'next_attempt_at'),)
+
+    def __str__(self):
+        return "%s => %s" % (self.instance_id, self.target)
+
+
+# Appends a latency to HookTarget.recent_latencies, keeping only the most
+# recent HOOK_TARGET_LATENCY_SAMPLES
+RECENT_LATENCIES_SQL = """
+    SELECT COALESCE(jsonb_agg(latency ORDER BY position), '[]'::jsonb)
+    FROM (
+        SELECT latency, position
+        FROM jsonb_array_elements(recent_latencies || %s::jsonb)
+            WITH ORDINALITY AS samples(latency, position)
+        ORDER BY position DESC
+        LIMIT %s
+    ) AS recent
+"""
+
+
+@python_2_unicode_compatible
+class HookTarget(models.Model):
+    """ Delivery options and health statistics for a webhook target URL.
+
+    Targets without a HookTarget get one delivery per hook, with the
+    default concurrency. A HookTarget is created for every target once a
+    delivery to it has been attempted.
+
+    Args:
+        target (str): The URL the options apply to
+        batch_deliveries (bool): True if the target accepts a JSON array
+            of hook payloads per request
+        max_batch_size (int): The most payloads to post in one request
+        max_concurrency (int): The most deliveries to have in flight to
+            the target at once, when it is healthy
+        attempts (int): The number of requests made to the target
+        failures (int): The number of those requests that failed
+        consecutive_failures (int): The number of failures since the last
+            successful request
+        recent_latencies (json): The durations of the most recent requests,
+            in seconds
+        suspended_until (datetime): No requests are made to the target
+            until this time
+        batch_scheduled_until (datetime): The end of the current batch
+            window, when a dispatch for the target has been scheduled
+    """
+    target = models.URLField(max_length=255, unique=True)
+    batch_deliveries = models.BooleanField(default=False)
+    max_batch_size = models.IntegerField(default=100)
+    max_concurrency = models.IntegerField(default=4)
+    attempts = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    consecutive_failures = models.IntegerField(default=0)
+    recent_latencies = JSONField(default=list, blank=True)
+    last_success_at = models.DateTimeField(null=True, blank=True)
+    last_failure_at = models.DateTimeField(null=True, blank=True)
+    suspended_until = models.DateTimeField(null=True, blank=True)
+    batch_scheduled_until = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def get_for_targets(cls, targets):
+        """ Returns a dict of target URL to HookTarget, with unsaved default
+        HookTargets for targets that haven't been configured.
+        """
+        targets = set(targets)
+        configs = {
+            config.target: config
+            for config in cls.objects.filter(target__in=targets)}
+        for target in targets - set(configs):
+            configs[target] = cls(target=target)
+        return configs
+
+    @classmethod
+    def record_attempt(cls, target, success, latency):
+        """ Updates the statistics for `target` with the outcome of a request
+        that took `latency` seconds, suspending the target if it keeps
+        failing.
+
+        The counters are updated in place, rather than saving the whole
+        row, so that concurrent deliveries to the target don't wait on each
+        other for a lock.
+        """
+        now = timezone.now()
+        updates = {
+            'attempts': F('attempts') + 1,
+            'recent_latencies': RawSQL(
+                RECENT_LATENCIES_SQL,
+                (json.dumps([latency]), settings.HOOK_TARGET_LATENCY_SAMPLES),
+                output_field=JSONField()),
+        }
+        if success:
+            updates.update(consecutive_failures=0, last_success_at=now,
+                           suspended_until=None)
+        else:
+            updates.update(failures=F('failures') + 1,
+                           consecutive_failures=F('consecutive_failures') + 1,
+                           last_failure_at=now)
+
+        targets = cls.objects.filter(target=target)
+        if not targets.update(**updates):
+            cls.objects.get_or_create(target=target)
+            targets.update(**updates)
+        if success:
+            return
+
+        consecutive_failures = targets.values_list(
+            'consecutive_failures', flat=True).get()
+        excess = consecutive_failures - settings.HOOK_TARGET_FAILURE_THRESHOLD
+        if excess >= 0:
+            delay = min(settings.HOOK_DELIVERY_RETRY_DELAY * 2 ** excess,
+                        settings.HOOK_DELIVERY_MAX_RETRY_DELAY)
+            targets.update(suspended_until=now + timedelta(seconds=delay))
+
+    def latency_percentile(self, percentile):
+        if not self.recent_latencies:
+            return None
+        latencies = sorted(self.recent_latencies)
+        index = int(round(percentile / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+    @property
+    def latency_p50(self):
+        return self.latency_percentile(50)
+
+    @property
+    def latency_p95(self):
+        return self.latency_percentile(95)
+
+    @property
+    def success_rate(self):
+        if not self.attempts:
+            return None
+        return 1.0 - float(self.failures) / self.attempts
+
+    @property
+    def is_suspended(self):
+        return (self.suspended_until is not None and
+                self.suspended_until > timezone.now())
+
+    @property
+    def concurrency(self):
+        """ The number of deliveries allowed in flight right now. This is
+        halved for every consecutive failure, and again if the target is
+        slow.
+        """
+        concurrency = self.max_concurrency >> self.consecutive_failures
+        latency = self.latency_p95
+        if latency is not None and latency > settings.HOOK_TARGET_SLOW_LATENCY:
+            concurrency //= 2
+        return max(concurrency, 1)
+
+    def __str__(self):
+        return self.target
+
+
+@python_2_unicode_compatible
+class HookSlot(models.Model):
+    """ A delivery in flight to a webhook target, so that the number of
+    deliveries to a target can be limited across all of the workers.
+
+    Args:
+        target (str): The URL the delivery is being made to
+        slot (int): Which of the target's concurrency slots is taken
+        expires_at (datetime): When the slot is free again, if the worker
+            making the delivery dies before releasing it
+    """
+    target = models.URLField(max_length=255)
+    slot = models.IntegerField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('target', 'slot'),)
+
+    def __str__(self):
+        return "%s #%s" % (self.target, self.slot)
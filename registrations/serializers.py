@@ -1,5 +1,6 @@
 from django.contrib.auth.models import User, Group
-from .models import Source, Registration
+from .models import (Source, Registration, ThirdPartyRegistrationImport,
+                     RegistrationIntake)
 from rest_hooks.models import Hook
 from rest_framework import serializers
 
@@ -39,6 +40,32 @@ class RegistrationSerializer(serializers.ModelSerializer):
                   'created_at', 'updated_at', 'created_by', 'updated_by')
 
 
+class ThirdPartyRegistrationImportSerializer(serializers.ModelSerializer):
+    rows_per_second = serializers.FloatField(read_only=True)
+    error_summary = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ThirdPartyRegistrationImport
+        fields = ('id', 'source', 'rows', 'imported', 'skipped', 'failed',
+                  'rows_per_second', 'error_summary', 'created_at',
+                  'updated_at', 'finished_at')
+
+    def get_error_summary(self, obj):
+        """ The error messages with their counts, most common first """
+        return [
+            {'error': error, 'count': count}
+            for error, count in sorted(
+                obj.error_summary.items(), key=lambda e: (-e[1], e[0]))]
+
+
+class RegistrationIntakeSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = RegistrationIntake
+        fields = ('id', 'status', 'error', 'registration', 'created_at',
+                  'updated_at')
+
+
 class HookSerializer(serializers.ModelSerializer):
 
     class Meta:
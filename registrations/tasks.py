@@ -1,21 +1,33 @@
+import hashlib
 import json
 import requests
+import tempfile
+import threading
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pika
 from celery.task import Task
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from seed_services_client.metrics import MetricsApiClient
 from openpyxl import load_workbook
 from io import BytesIO
-from collections import defaultdict
+from collections import Counter, defaultdict
+from multiprocessing.pool import ThreadPool
 
 from hellomama_registration import utils
 from .graphite import RetentionScheme
 from .models import (Registration, SubscriptionRequest, Source,
-                     ThirdPartyRegistrationError)
+                     ThirdPartyRegistrationError, PublicRegistrationIdentity,
+                     HookDelivery, HookTarget, ThirdPartyRegistrationImport,
+                     ThirdPartyRegistrationRow, RegistrationIntake,
+                     PublicNotificationRun, HookSlot, SubscriptionMirrorSync)
 from .metrics import MetricGenerator, send_metric
 from .serializers import RegistrationSerializer
 
@@ -210,36 +222,58 @@ class ValidateRegistration(Task):
             registration.save()
             return False
 
+    def record_public_registration(self, registration):
+        """ Keeps track of the mothers that have had a public registration,
+        so that we know whose public subscriptions need to be stopped later.
+        """
+        if registration.stage == 'public':
+            PublicRegistrationIdentity.objects.get_or_create(
+                identity=registration.mother_id)
+
     def stop_public_subscriptions(self, registration):
-        if registration.stage != 'public':
-            subscriptions = utils.search_subscriptions(
-                {"identity": registration.mother_id, "completed": False,
-                 "active": True, "messageset_contains": "public.mother"})
+        if registration.stage == 'public':
+            return
 
-            def deactivate_subscription(sub):
-                metadata = sub['metadata']
-                metadata['converted_full'] = 'true'
-                utils.patch_subscription(
-                    sub, {"metadata": metadata, "active": False})
+        # Only mothers that have had a public registration can have public
+        # subscriptions, so don't search for everyone else's
+        if not PublicRegistrationIdentity.objects.filter(
+                identity=registration.mother_id).exists():
+            return
 
-            for subscription in subscriptions:
-                deactivate_subscription(subscription)
+        stopped = set()
 
-            registrations = Registration.objects.filter(
-                mother_id=registration.mother_id, stage='public',
-                validated=True).order_by("-created_at")
+        def deactivate_subscription(sub):
+            if sub['id'] in stopped:
+                return
+            stopped.add(sub['id'])
+            metadata = sub['metadata']
+            metadata['converted_full'] = 'true'
+            utils.patch_subscription(
+                sub, {"metadata": metadata, "active": False})
 
-            if registrations.exists():
-                household_id = registrations[0].data['receiver_id']
+        subscriptions = utils.search_subscriptions(
+            {"identity": registration.mother_id, "completed": False,
+             "active": True, "messageset_contains": "public.mother"})
 
-                if household_id != registration.mother_id:
-                    subscriptions = utils.search_subscriptions(
-                        {"identity": household_id, "completed": False,
-                         "messageset_contains": "public.household",
-                         "active": True})
+        for subscription in subscriptions:
+            deactivate_subscription(subscription)
+
+        registrations = Registration.objects.filter(
+            mother_id=registration.mother_id, stage='public',
+            validated=True).order_by("-created_at")
+
+        public_registration = registrations.first()
+        if public_registration is not None:
+            household_id = public_registration.data['receiver_id']
+
+            if household_id != registration.mother_id:
+                subscriptions = utils.search_subscriptions(
+                    {"identity": household_id, "completed": False,
+                     "messageset_contains": "public.household",
+                     "active": True})
 
-                    for subscription in subscriptions:
-                        deactivate_subscription(subscription)
+                for subscription in subscriptions:
+                    deactivate_subscription(subscription)
 
     def create_subscriptionrequests(self, registration):
         """ Create SubscriptionRequest(s) based on the
@@ -357,11 +391,17 @@ class ValidateRegistration(Task):
         """
         l = self.get_logger(**kwargs)
         l.info("Looking up the registration")
-        registration = Registration.objects.get(id=registration_id)
+        try:
+            registration = Registration.objects.get(id=registration_id)
+        except Registration.DoesNotExist as error:
+            # Registrations can be saved in a transaction that hasn't been
+            # committed yet when this is queued
+            raise self.retry(exc=error, countdown=5)
         reg_validates = self.validate(registration)
 
         validation_string = "Validation completed - "
         if reg_validates:
+            self.record_public_registration(registration)
             self.stop_public_subscriptions(registration)
             self.create_subscriptionrequests(registration)
             validation_string += "Success"
@@ -373,22 +413,180 @@ class ValidateRegistration(Task):
 validate_registration = ValidateRegistration()
 
 
+hook_session = requests.Session()
+
+
+def post_hook(target, payload, session=hook_session):
+    response = session.post(
+        url=target,
+        data=json.dumps(payload),
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': 'Token %s' % settings.HOOK_AUTH_TOKEN
+        },
+        timeout=settings.HOOK_DELIVERY_TIMEOUT
+    )
+    response.raise_for_status()
+    return response
+
+
+def attempt_hook_delivery(deliveries, batch=False, session=hook_session):
+    """ Posts HookDeliveries for a single target and records the outcome.
+
+    With `batch` the payloads are posted together as a JSON array, otherwise
+    there should only be one delivery. Failed deliveries are rescheduled with
+    an exponential backoff until HOOK_DELIVERY_MAX_ATTEMPTS is reached.
+
+    :returns: a list of the delivery latencies in seconds, or None if the
+              delivery failed
+    """
+    if batch:
+        payload = [delivery.payload for delivery in deliveries]
+    else:
+        [delivery] = deliveries
+        payload = delivery.payload
+
+    target = deliveries[0].target
+    start = time.time()
+    try:
+        post_hook(target, payload, session=session)
+    except requests.exceptions.RequestException as e:
+        HookTarget.record_attempt(target, False, time.time() - start)
+        for delivery in deliveries:
+            delivery.attempts += 1
+            delivery.last_error = str(e)
+            if delivery.attempts >= settings.HOOK_DELIVERY_MAX_ATTEMPTS:
+                delivery.status = HookDelivery.FAILED
+            else:
+                delay = min(
+                    settings.HOOK_DELIVERY_RETRY_DELAY *
+                    2 ** (delivery.attempts - 1),
+                    settings.HOOK_DELIVERY_MAX_RETRY_DELAY)
+                delivery.next_attempt_at = timezone.now() + timedelta(
+                    seconds=delay)
+            delivery.save(update_fields=[
+                'attempts', 'last_error', 'status', 'next_attempt_at'])
+        return None
+
+    HookTarget.record_attempt(target, True, time.time() - start)
+    now = timezone.now()
+    HookDelivery.objects.filter(
+        id__in=[delivery.id for delivery in deliveries]).update(
+        attempts=F('attempts') + 1, status=HookDelivery.DELIVERED,
+        delivered_at=now)
+    return [
+        (now - delivery.created_at).total_seconds()
+        for delivery in deliveries]
+
+
+def acquire_hook_slot(target, max_concurrency):
+    """ Takes one of the `max_concurrency` delivery slots for `target`, so
+    that a slow target can't tie up all of the workers. The slots are
+    HookSlot rows, so the limit holds across all of the workers.
+
+    Slots expire on their own in case a worker dies before releasing one.
+
+    :returns: the HookSlot's id, or None if all the slots are taken
+    """
+    now = timezone.now()
+    HookSlot.objects.filter(target=target, expires_at__lte=now).delete()
+    taken = set(HookSlot.objects.filter(target=target).values_list(
+        'slot', flat=True))
+    expires_at = now + timedelta(seconds=settings.HOOK_DELIVERY_TIMEOUT * 2)
+    for slot in range(max_concurrency):
+        if slot in taken:
+            continue
+        try:
+            # Another worker could have taken the slot since
+            with transaction.atomic():
+                return HookSlot.objects.create(
+                    target=target, slot=slot, expires_at=expires_at).id
+        except IntegrityError:
+            continue
+    return None
+
+
+def release_hook_slot(slot_id):
+    HookSlot.objects.filter(id=slot_id).delete()
+
+
+def schedule_hook_batch(target):
+    """ Schedules a dispatch for a batched target at the end of the current
+    batch window, unless one has already been scheduled.
+    """
+    now = timezone.now()
+    scheduled = HookTarget.objects.filter(
+        Q(batch_scheduled_until__isnull=True) |
+        Q(batch_scheduled_until__lte=now),
+        target=target).update(batch_scheduled_until=now + timedelta(
+            seconds=settings.HOOK_BATCH_WINDOW))
+    if scheduled:
+        dispatch_hook_deliveries.apply_async(
+            kwargs={'target': target}, countdown=settings.HOOK_BATCH_WINDOW)
+
+
+def fire_hook_delivery_metrics(latencies, failed):
+    if latencies:
+        fire_metric.apply_async(kwargs={
+            'metric_name': 'registrations.hooks.delivered.sum',
+            'metric_value': float(len(latencies)),
+        })
+        fire_metric.apply_async(kwargs={
+            'metric_name': 'registrations.hooks.delivery_latency.avg',
+            'metric_value': sum(latencies) / len(latencies),
+        })
+    if failed:
+        fire_metric.apply_async(kwargs={
+            'metric_name': 'registrations.hooks.failed.sum',
+            'metric_value': float(failed),
+        })
+
+
 class DeliverHook(Task):
-    def run(self, target, payload, instance_id=None, hook_id=None, **kwargs):
+    def run(self, delivery_id=None, target=None, payload=None,
+            instance_id=None, hook_id=None, **kwargs):
         """
+        delivery_id:   the ID of the HookDelivery to attempt
         target:     the url to receive the payload.
         payload:    a python primitive data structure
         instance_id:   a possibly None "trigger" instance ID
         hook_id:       the ID of defining Hook object
+
+        `target`, `payload`, `instance_id` and `hook_id` are only used for
+        tasks that were queued before the HookDelivery outbox existed.
         """
-        requests.post(
-            url=target,
-            data=json.dumps(payload),
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': 'Token %s' % settings.HOOK_AUTH_TOKEN
-            }
-        )
+        if delivery_id is None:
+            delivery = HookDelivery.objects.create(
+                target=target, payload=payload, instance_id=instance_id,
+                hook_id=hook_id)
+        else:
+            try:
+                delivery = HookDelivery.objects.get(
+                    id=delivery_id, status=HookDelivery.PENDING)
+            except HookDelivery.DoesNotExist:
+                return "Hook already handled"
+
+        config = HookTarget.get_for_targets([delivery.target])[
+            delivery.target]
+        if config.batch_deliveries:
+            return "Hook left for batched delivery"
+
+        if config.is_suspended:
+            return "Target suspended, hook left for the dispatcher"
+
+        slot = acquire_hook_slot(delivery.target, config.concurrency)
+        if slot is None:
+            return "Target busy, hook left for the dispatcher"
+        try:
+            latencies = attempt_hook_delivery([delivery])
+        finally:
+            release_hook_slot(slot)
+
+        if latencies is None:
+            fire_hook_delivery_metrics([], 1)
+            return "Hook delivery failed"
+        fire_hook_delivery_metrics(latencies, 0)
+        return "Hook delivered"
 
 
 def deliver_hook_wrapper(target, payload, instance, hook):
@@ -396,9 +594,109 @@ def deliver_hook_wrapper(target, payload, instance, hook):
         instance_id = str(instance.id)
     else:
         instance_id = instance.id
-    kwargs = dict(target=target, payload=payload,
-                  instance_id=instance_id, hook_id=hook.id)
-    DeliverHook.apply_async(kwargs=kwargs)
+    delivery = HookDelivery.objects.create(
+        target=target, payload=payload, instance_id=instance_id,
+        hook_id=hook.id)
+    # The dispatcher will pick it up if these tasks never run
+    config = HookTarget.get_for_targets([target])[target]
+    if config.batch_deliveries:
+        transaction.on_commit(lambda: schedule_hook_batch(target))
+    else:
+        transaction.on_commit(lambda: DeliverHook.apply_async(
+            kwargs={'delivery_id': delivery.id}))
+
+
+class DispatchHookDeliveries(Task):
+
+    """ Drains the HookDelivery outbox, delivering the pending hooks that are
+    due in batches. Should be run periodically, to deliver the hooks whose
+    delivery tasks never ran.
+    """
+    name = ("hellomama_registration.registrations.tasks."
+            "dispatch_hook_deliveries")
+
+    def claim_deliveries(self, batch_size, target=None):
+        """ Takes the next batch of due deliveries, and pushes their next
+        attempt out so that concurrent dispatchers don't also take them.
+        """
+        now = timezone.now()
+        deliveries = HookDelivery.objects.select_for_update(
+            skip_locked=True).filter(
+            status=HookDelivery.PENDING, next_attempt_at__lte=now)
+        if target is not None:
+            deliveries = deliveries.filter(target=target)
+        with transaction.atomic():
+            deliveries = list(
+                deliveries.order_by('next_attempt_at')[:batch_size])
+            HookDelivery.objects.filter(
+                id__in=[d.id for d in deliveries]).update(
+                next_attempt_at=now + timedelta(
+                    seconds=settings.HOOK_DELIVERY_TIMEOUT * batch_size))
+        return deliveries
+
+    def postpone_deliveries(self, deliveries, until=None):
+        until = until or timezone.now() + timedelta(
+            seconds=settings.HOOK_BATCH_WINDOW)
+        HookDelivery.objects.filter(
+            id__in=[d.id for d in deliveries]).update(next_attempt_at=until)
+
+    def group_deliveries(self, deliveries, config):
+        if not config.batch_deliveries:
+            return [[delivery] for delivery in deliveries]
+        size = config.max_batch_size
+        return [
+            deliveries[i:i + size] for i in range(0, len(deliveries), size)]
+
+    def run(self, batch_size=None, target=None, **kwargs):
+        batch_size = batch_size or settings.HOOK_DELIVERY_BATCH_SIZE
+        latencies = []
+        failed = 0
+
+        deliveries = self.claim_deliveries(batch_size, target)
+        while deliveries:
+            by_target = defaultdict(list)
+            for delivery in deliveries:
+                by_target[delivery.target].append(delivery)
+            configs = HookTarget.get_for_targets(by_target.keys())
+
+            for url, target_deliveries in by_target.items():
+                config = configs[url]
+                if config.is_suspended:
+                    self.postpone_deliveries(
+                        target_deliveries, config.suspended_until)
+                    continue
+                groups = self.group_deliveries(target_deliveries, config)
+                for i, group in enumerate(groups):
+                    slot = acquire_hook_slot(url, config.concurrency)
+                    if slot is None:
+                        # The target is busy, try the rest again later
+                        self.postpone_deliveries(
+                            [d for g in groups[i:] for d in g])
+                        break
+                    try:
+                        group_latencies = attempt_hook_delivery(
+                            group, batch=config.batch_deliveries)
+                    finally:
+                        release_hook_slot(slot)
+                    if group_latencies is not None:
+                        latencies.extend(group_latencies)
+                        continue
+                    failed += len(group)
+                    config = HookTarget.objects.get(target=url)
+                    if config.is_suspended:
+                        self.postpone_deliveries(
+                            [d for g in groups[i + 1:] for d in g],
+                            config.suspended_until)
+                        break
+
+            if len(deliveries) < batch_size:
+                break
+            deliveries = self.claim_deliveries(batch_size, target)
+
+        fire_hook_delivery_metrics(latencies, failed)
+        return "%d hook(s) delivered, %d failed" % (len(latencies), failed)
+
+dispatch_hook_deliveries = DispatchHookDeliveries()
 
 
 def get_metric_client(session=None):
@@ -432,6 +730,7 @@ class RepopulateMetrics(Task):
     Repopulates historical metrics.
     """
     name = 'registrations.tasks.repopulate_metrics'
+    metric_generator = MetricGenerator()
 
     def generate_and_send(
             self, amqp_url, prefix, metric_name, start, end):
@@ -439,7 +738,8 @@ class RepopulateMetrics(Task):
         Generates the value for the specified metric, and sends it.
         """
         try:
-            value = MetricGenerator().generate_metric(metric_name, start, end)
+            value = self.metric_generator.generate_metric(
+                metric_name, start, end)
         except requests.exceptions.RequestException:
             # If we have an issue contacting an external service for this
             # metric, just skip it.
@@ -477,10 +777,71 @@ class AlreadySubscribedError(Exception):
     """
 
 
+class ThirdPartyRegistrationsFailed(Exception):
+    """
+    For when some of the rows of a third party registration pull could not
+    be imported
+    """
+
+
+class LookupCache(object):
+    """
+    Remembers the results of lookups for the length of a single task run,
+    counting how many of them it saved. Can be shared between threads, but
+    two threads that miss on the same key at once will both do the lookup,
+    so lookups with side effects must be kept to one thread per key.
+    """
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, kind, key, func):
+        with self.lock:
+            if (kind, key) in self.values:
+                self.hits += 1
+                return self.values[(kind, key)]
+            self.misses += 1
+        value = func()
+        self.set(kind, key, value)
+        return value
+
+    def set(self, kind, key, value):
+        with self.lock:
+            self.values[(kind, key)] = value
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+
+def cached_lookup(lookups, kind, key, func):
+    if lookups is None:
+        return func()
+    return lookups.get(kind, key, func)
+
+
+def chunks(data, size):
+    """ Splits any iterable, including generators, into lists of size """
+    chunk = []
+    for item in data:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 class PullThirdPartyRegistrations(Task):
 
     def get_or_create_identity(
-            self, msisdn=None, communicate_through=None, details={}):
+            self, msisdn=None, communicate_through=None, details={},
+            lookups=None):
 
         if not msisdn and not communicate_through:
             return {}
@@ -488,10 +849,14 @@ class PullThirdPartyRegistrations(Task):
         if msisdn:
             msisdn = utils.normalize_msisdn(msisdn, '234')
 
-            identities = utils.search_identities(
-                "details__addresses__msisdn", msisdn)
+            # The cached identity is shared, so that any changes made to it
+            # for one row are seen by the next row with the same number
+            identity = cached_lookup(
+                lookups, 'msisdn', msisdn, lambda: next(iter(
+                    utils.search_identities(
+                        "details__addresses__msisdn", msisdn)), None))
 
-            for identity in identities:
+            if identity is not None:
                 if details:
                     identity['details'].update(details)
                     utils.patch_identity(
@@ -519,44 +884,71 @@ class PullThirdPartyRegistrations(Task):
 
         identity['details'].update(details)
         identity = utils.create_identity(identity)
+        if msisdn and lookups is not None:
+            lookups.set('msisdn', msisdn, identity)
         return identity
 
-    def get_operator_identity(self, personnel_code):
-        identities = utils.search_identities(
-            "details__personnel_code", personnel_code)
+    def get_operator_identity(self, personnel_code, lookups=None):
+        def search():
+            identities = utils.search_identities(
+                "details__personnel_code", personnel_code)
+
+            for identity in identities:
+                return identity
 
-        for identity in identities:
-            return identity
+            raise ValueError('Operator not found.')
 
-        raise ValueError('Operator not found.')
+        return cached_lookup(lookups, 'operator', personnel_code, search)
 
-    def get_data(self):
+    def download_workbook(self, stream=False):
         url = settings.THIRDPARTY_REGISTRATIONS_URL
         username = settings.THIRDPARTY_REGISTRATIONS_USER
         password = settings.THIRDPARTY_REGISTRATIONS_PASSWORD
 
-        response = requests.get(url, auth=(username, password))
+        response = requests.get(url, auth=(username, password), stream=stream)
+        if not stream:
+            return BytesIO(response.content)
 
-        wb = load_workbook(filename=BytesIO(response.content))
-        ws = wb.get_sheet_by_name('Forms')
+        # Only written to disk once it gets too big to keep in memory
+        workbook = tempfile.SpooledTemporaryFile(
+            max_size=settings.THIRDPARTY_REGISTRATIONS_SPOOL_SIZE)
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            workbook.write(chunk)
+        workbook.seek(0)
+        return workbook
+
+    def get_rows(self, ws):
+        rows = ws.iter_rows()
 
         columns = []
-        header_row = ws[1]
-        for cell in header_row:
+        for cell in next(rows):
             columns.append(cell.value.replace('form.', ''))
 
-        data = []
+        for row in rows:
+            values = [cell.value for cell in row]
+            # Read only worksheets leave out empty cells at the end of a row
+            values.extend([None] * (len(columns) - len(values)))
+            yield dict(zip(columns, values))
+
+    def stream_data(self):
+        with self.download_workbook(stream=True) as workbook:
+            wb = load_workbook(filename=workbook, read_only=True)
+            for reg in self.get_rows(wb.get_sheet_by_name('Forms')):
+                yield reg
 
-        for row in ws.iter_rows(min_row=2):
-            reg = {}
-            for i, column in enumerate(columns):
-                reg[column] = row[i].value
+    def get_data(self):
+        """ Returns the registrations from the third party spreadsheet.
 
-            data.append(reg)
+        With THIRDPARTY_REGISTRATIONS_STREAMING this is a generator that
+        reads the rows as they are needed, otherwise it is a list.
+        """
+        if settings.THIRDPARTY_REGISTRATIONS_STREAMING:
+            return self.stream_data()
 
-        return data
+        wb = load_workbook(filename=self.download_workbook())
+        return list(self.get_rows(wb.get_sheet_by_name('Forms')))
 
-    def check_already_subscribed(self, identity_id):
+    def check_already_subscribed(self, identity_id, lookups=None):
         """
         Ensures that the mother doesn't have any existing prebirth
         subscriptions
@@ -567,20 +959,30 @@ class PullThirdPartyRegistrations(Task):
                     not subscription['active'] or subscription['completed'] or
                     subscription['process_status'] not in (0, 1)):
                 continue
-            messageset = utils.get_messageset(subscription['messageset'])
+            messageset_id = subscription['messageset']
+            messageset = cached_lookup(
+                lookups, 'messageset', messageset_id,
+                lambda: utils.get_messageset(messageset_id))
             if 'prebirth.mother' in messageset['short_name']:
                 raise AlreadySubscribedError(
                     "Mother already has a subscription to messageset "
                     "{}".format(messageset['short_name']))
 
-    def create_registration(self, line, source):
+    def build_registration(self, line, source, lookups=None):
+        """ Looks up and updates the identities for a spreadsheet row, and
+        returns the data for its registration. This makes no changes to the
+        database, so can be run for several rows at once.
+
+        `lookups` is an optional LookupCache to share lookups between rows.
+        """
         mother_identity = self.get_or_create_identity(
-            line['mothers_phone_number'], details={})
+            line['mothers_phone_number'], details={}, lookups=lookups)
         operator_identity = self.get_operator_identity(
-            line['health_worker_personnel_code'])
+            line['health_worker_personnel_code'], lookups=lookups)
 
         if mother_identity.get('id') is not None:
-            self.check_already_subscribed(mother_identity['id'])
+            self.check_already_subscribed(
+                mother_identity['id'], lookups=lookups)
 
         language = utils.get_language(line['preferred_msg_language'])
         receiver = utils.get_receiver(line['message_receiver'])
@@ -629,7 +1031,7 @@ class PullThirdPartyRegistrations(Task):
 
             receiver_identity = self.get_or_create_identity(
                 line['gatekeeper_phone_number'],
-                details=receiver_details)
+                details=receiver_details, lookups=lookups)
             reg_info['data']['receiver_id'] = receiver_identity['id']
 
             identity_details["linked_to"] = receiver_identity['id']
@@ -661,32 +1063,181 @@ class PullThirdPartyRegistrations(Task):
                 utils.get_today(),
                 line["pregnancy_week"]).strftime("%Y%m%d")
 
+        return reg_info
+
+    def save_registration(self, reg_info, source):
         serializer = RegistrationSerializer(data=reg_info)
         serializer.is_valid(raise_exception=True)
-        serializer.save(created_by=source.user,
-                        updated_by=source.user)
+        return serializer.save(created_by=source.user,
+                               updated_by=source.user)
+
+    def create_registration(self, line, source):
+        return self.save_registration(
+            self.build_registration(line, source), source)
+
+    def group_lines(self, lines):
+        """ Groups the lines so that lines sharing a mother or gatekeeper
+        phone number are in the same group, in their original order. Each
+        group is built by a single thread, so that an identity is only ever
+        looked up, created or changed by one thread at a time.
+
+        :returns: a list of lists of indexes into `lines`
+        """
+        parents = list(range(len(lines)))
+
+        def find(index):
+            while parents[index] != index:
+                parents[index] = parents[parents[index]]
+                index = parents[index]
+            return index
+
+        owners = {}
+        for index, line in enumerate(lines):
+            for field in ('mothers_phone_number', 'gatekeeper_phone_number'):
+                try:
+                    msisdn = utils.normalize_msisdn(line[field], '234')
+                except Exception:
+                    # The row will fail when it is built
+                    continue
+                if not msisdn:
+                    continue
+                if msisdn in owners:
+                    parents[find(index)] = find(owners[msisdn])
+                else:
+                    owners[msisdn] = index
+
+        groups = defaultdict(list)
+        for index in range(len(lines)):
+            groups[find(index)].append(index)
+        return sorted(groups.values())
+
+    def get_row_key(self, line):
+        return hashlib.sha256(json.dumps(
+            line, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
     def run(self, user_id, **kwargs):
         data = self.get_data()
 
         source = Source.objects.get(user=user_id)
+        progress = ThirdPartyRegistrationImport.objects.create(source=source)
+        pool = ThreadPool(settings.THIRDPARTY_REGISTRATIONS_WORKERS)
+        lookups = LookupCache()
+        seen = set()
+        error_counts = Counter()
 
-        loop_error = None
-
-        for line in data:
+        def build(line):
             try:
-                self.create_registration(line, source)
+                return self.build_registration(line, source, lookups)
             except Exception as error:
-                loop_error = error
-                line['error'] = str(error)
-                ThirdPartyRegistrationError.objects.create(**{'data': line})
+                return error
 
-        if loop_error:
-            raise
+        def build_group(group_lines):
+            return [build(line) for line in group_lines]
+
+        try:
+            chunk_size = settings.THIRDPARTY_REGISTRATIONS_CHUNK
+            for chunk in chunks(data, chunk_size):
+                progress.rows += len(chunk)
+                keys = [self.get_row_key(line) for line in chunk]
+                seen.update(ThirdPartyRegistrationRow.objects.filter(
+                    key__in=keys).values_list('key', flat=True))
+
+                lines = []
+                for key, line in zip(keys, chunk):
+                    if key in seen:
+                        progress.skipped += 1
+                    else:
+                        seen.add(key)
+                        lines.append((key, line))
+
+                # The identity store and SBM lookups are the slow part, so they
+                # are done concurrently, and the results saved in this thread
+                groups = self.group_lines([line for key, line in lines])
+                results = [None] * len(lines)
+                group_results = pool.map(build_group, [
+                    [lines[index][1] for index in group] for group in groups])
+                for group, reg_infos in zip(groups, group_results):
+                    for index, reg_info in zip(group, reg_infos):
+                        results[index] = reg_info
+
+                errors = []
+                for (key, line), reg_info in zip(lines, results):
+                    try:
+                        if isinstance(reg_info, Exception):
+                            raise reg_info
+                        # The row is only recorded as imported if its
+                        # registration is saved
+                        with transaction.atomic():
+                            self.save_registration(reg_info, source)
+                            ThirdPartyRegistrationRow.objects.create(
+                                key=key, registration_import=progress)
+                        progress.imported += 1
+                    except Exception as error:
+                        progress.failed += 1
+                        line['error'] = str(error)
+                        error_counts[line['error']] += 1
+                        errors.append(ThirdPartyRegistrationError(
+                            data=line, registration_import=progress))
+
+                ThirdPartyRegistrationError.objects.bulk_create(errors)
+                progress.error_summary = dict(error_counts)
+                progress.save()
+        finally:
+            pool.close()
+
+        progress.finished_at = timezone.now()
+        progress.save()
+
+        if error_counts:
+            raise ThirdPartyRegistrationsFailed(
+                "%d row(s) failed to import: %s" % (
+                    progress.failed, '; '.join(
+                        '%s (%d)' % (message, count)
+                        for message, count in error_counts.most_common(5))))
+
+        return "%d imported, %d skipped, %d failed, %d%% lookup hits" % (
+            progress.imported, progress.skipped, progress.failed,
+            round(lookups.hit_rate * 100))
 
 pull_third_party_registrations = PullThirdPartyRegistrations()
 
 
+class ProcessRegistrationIntake(Task):
+    """
+    Creates the registration for a RegistrationIntake that was pushed to the
+    add registration endpoint
+    """
+    name = ("hellomama_registration.registrations.tasks."
+            "process_registration_intake")
+
+    def run(self, intake_id, **kwargs):
+        # Only one worker gets to process each intake
+        claimed = RegistrationIntake.objects.filter(
+            id=intake_id, status=RegistrationIntake.PENDING).update(
+            status=RegistrationIntake.PROCESSING)
+        if not claimed:
+            return "Intake already processed"
+
+        intake = RegistrationIntake.objects.select_related(
+            'source__user').get(id=intake_id)
+        try:
+            intake.registration = \
+                pull_third_party_registrations.create_registration(
+                    intake.data, intake.source)
+            intake.status = RegistrationIntake.COMPLETED
+        except KeyError as error:
+            intake.status = RegistrationIntake.FAILED
+            intake.error = 'Missing field: %s' % str(error)
+        except Exception as error:
+            intake.status = RegistrationIntake.FAILED
+            intake.error = str(error)
+        intake.save()
+
+        return "Intake %s" % intake.status
+
+process_registration_intake = ProcessRegistrationIntake()
+
+
 class SendPublicRegistrationNotifications(Task):
     """
     Send out a notification SMS to the CORP for public registrations not
@@ -710,34 +1261,172 @@ class SendPublicRegistrationNotifications(Task):
                 }
                 utils.post_message(payload)
 
+    def has_full_subscription(self, subscription):
+        active_subscriptions = utils.search_subscriptions({
+            'identity': subscription['identity'],
+            'messageset_contains': 'birth.mother',
+            'active': True})
+        return next(active_subscriptions, None) is not None
+
+    def notified_metadata(self, subscription):
+        metadata = subscription['metadata']
+        metadata['public_notification'] = 'true'
+        return {"metadata": metadata}
+
+    def get_checkpoint(self):
+        """
+        Returns the unfinished run to resume, or a new one if the last run
+        finished
+        """
+        run = PublicNotificationRun.objects.filter(
+            finished_at__isnull=True).order_by('created_at').first()
+        if run is None:
+            run = PublicNotificationRun.objects.create()
+        return run
+
     def run(self):
+        checkpoint = self.get_checkpoint()
+        pool = ThreadPool(settings.PUBLIC_NOTIFICATION_WORKERS)
+        lookups = LookupCache()
+
+        def get_identity(identity_id):
+            return cached_lookup(
+                lookups, 'identity', identity_id,
+                lambda: utils.get_identity(identity_id))
 
         subscriptions = utils.search_subscriptions(
             {'completed': True, 'metadata_not_has_key': 'public_notification',
              'messageset_contains': 'public.mother'})
 
-        corp_details = defaultdict(list)
+        for chunk in chunks(
+                subscriptions, settings.PUBLIC_NOTIFICATION_CHUNK):
+            full = pool.map(self.has_full_subscription, chunk)
 
-        for subscription in subscriptions:
-            active_subscriptions = utils.search_subscriptions({
-                'identity': subscription['identity'],
-                'messageset_contains': 'birth.mother',
-                'active': True})
+            # Resolve each identity without a full subscription once, however
+            # many public subscriptions it has in this chunk
+            identity_ids = []
+            for subscription, has_full in zip(chunk, full):
+                if not has_full and \
+                        subscription['identity'] not in identity_ids:
+                    identity_ids.append(subscription['identity'])
+            identities = pool.map(get_identity, identity_ids)
 
-            if not next(active_subscriptions, None):
-                identity = utils.get_identity(subscription['identity'])
+            for identity in identities:
+                msisdns = checkpoint.details.setdefault(
+                    identity['operator'], [])
+                msisdn = utils.get_address_from_identity(identity)
+                if msisdn not in msisdns:
+                    msisdns.append(msisdn)
 
-                corp_details[identity['operator']].append(
-                    utils.get_address_from_identity(identity))
+            # The msisdns are saved before the subscriptions are marked, so
+            # that no notification is lost if the run is interrupted
+            checkpoint.processed += len(chunk)
+            checkpoint.save()
 
-            metadata = subscription['metadata']
-            metadata['public_notification'] = 'true'
-            utils.patch_subscription(
-                subscription, {"metadata": metadata})
+            utils.patch_subscriptions(chunk, self.notified_metadata)
 
-        self.send_notifications(corp_details)
+        pool.close()
 
-        return '{} CORP notification(s) sent'.format(len(corp_details))
+        self.send_notifications(checkpoint.details)
+
+        checkpoint.notifications = len(checkpoint.details)
+        checkpoint.details = {}
+        checkpoint.finished_at = timezone.now()
+        checkpoint.save()
+
+        return '{} CORP notification(s) sent, {} subscription(s) checked ' \
+            'at {:.1f}/s'.format(
+                checkpoint.notifications, checkpoint.processed,
+                checkpoint.subscriptions_per_second or 0)
 
 
 send_public_registration_notifications = SendPublicRegistrationNotifications()
+
+
+class SyncSubscriptionMirror(Task):
+    """
+    Copies the subscriptions that changed since the last sync from the SBM
+    into the local mirror, to catch any webhooks that were missed. Should
+    be run periodically. The first run copies every subscription.
+    """
+    name = ("hellomama_registration.registrations.tasks."
+            "sync_subscription_mirror")
+
+    def run(self, full=False, **kwargs):
+        sync = SubscriptionMirrorSync.get()
+        full = full or sync.synced_until is None
+
+        params = {}
+        if not full:
+            params['updated_after'] = sync.synced_until.isoformat()
+
+        # The SBM is asked directly, since search_subscriptions might read
+        # from the mirror itself
+        subscriptions = utils.stage_based_messaging_client.get_subscriptions(
+            params=params)["results"]
+
+        synced = 0
+        synced_until = sync.synced_until
+        for subscription in subscriptions:
+            utils.mirror_subscription(subscription)
+            synced += 1
+            updated_at = parse_datetime(subscription.get('updated_at') or '')
+            if updated_at is not None and (
+                    synced_until is None or updated_at > synced_until):
+                synced_until = updated_at
+
+        sync.synced_until = synced_until
+        if full and sync.full_sync_at is None:
+            sync.full_sync_at = timezone.now()
+        sync.save()
+
+        return "%d subscription(s) synced" % synced
+
+
+sync_subscription_mirror = SyncSubscriptionMirror()
+
+
+class RefreshMessagesetCache(Task):
+    """
+    Refreshes the cached messageset languages and messageset ids, so that
+    validating changes doesn't have to ask the SBM for them. Should be run
+    more often than MESSAGESET_CACHE_TIMEOUT.
+    """
+    name = ("hellomama_registration.registrations.tasks."
+            "refresh_messageset_cache")
+
+    def run(self, **kwargs):
+        utils.refresh_messageset_languages()
+        ids = utils.refresh_messageset_ids()
+        return "%d messageset(s) cached" % len(ids)
+
+
+refresh_messageset_cache = RefreshMessagesetCache()
+
+
+class SyncMessagesetCatalog(Task):
+    """
+    Copies every messageset and schedule from the SBM into the local
+    catalog that changes are worked out from. Should be run periodically.
+    """
+    name = ("hellomama_registration.registrations.tasks."
+            "sync_messageset_catalog")
+
+    def run(self, **kwargs):
+        sbm_client = utils.stage_based_messaging_client
+
+        messagesets = 0
+        for messageset in sbm_client.get_messagesets()["results"]:
+            utils.mirror_messageset(messageset)
+            messagesets += 1
+
+        schedules = 0
+        for schedule in sbm_client.get_schedules()["results"]:
+            utils.mirror_schedule(schedule)
+            schedules += 1
+
+        return "%d messageset(s) and %d schedule(s) synced" % (
+            messagesets, schedules)
+
+
+sync_messageset_catalog = SyncMessagesetCatalog()
@@ -82,6 +82,64 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
 
         generator.foo_bar.assert_called_once_with(start, end)
 
+    def test_generate_metric_parameterised(self):
+        """
+        Parameterised metrics should be looked up in the metrics table, and
+        call the generating function with the parameter from the name.
+        """
+        generator = MetricGenerator()
+        generator.registrations_language_sum = mock.MagicMock()
+        start = datetime(2016, 10, 26)
+        end = datetime(2016, 10, 26)
+        generator.generate_metric('registrations.language.eng_NG.sum',
+                                  start, end)
+
+        generator.registrations_language_sum.assert_called_once_with(
+            'eng_NG', start, end)
+
+    def test_metrics_table_shared(self):
+        """
+        The metrics table should only be built once, and be shared between
+        instances of the generator.
+        """
+        MetricGenerator.clear_metrics()
+        with self.assertNumQueries(1):
+            MetricGenerator().get_metrics()
+        with self.assertNumQueries(0):
+            MetricGenerator().get_metrics()
+            MetricGenerator().get_metric_func('registrations.created.sum')
+
+    def test_metrics_table_refreshed_on_source_change(self):
+        """
+        Creating a source should add its metric to the metrics table.
+        """
+        MetricGenerator().get_metrics()
+        user = User.objects.create(username='newsource')
+        Source.objects.create(
+            name='NewSource', authority='hw_full', user=user)
+
+        self.assertIn('registrations.source.newsource.sum',
+                      MetricGenerator().get_metrics())
+
+    def test_metrics_table_refreshed_on_username_change(self):
+        """
+        Renaming a user with a source should rename its metric, but other
+        user saves shouldn't throw the metrics table away.
+        """
+        user = User.objects.create(username='oldname')
+        Source.objects.create(name='OldSource', authority='hw_full', user=user)
+        metrics = MetricGenerator().get_metrics()
+
+        user.save(update_fields=['last_login'])
+        User.objects.create(username='nosource')
+        self.assertIs(MetricGenerator().get_metrics(), metrics)
+
+        user.username = 'newname'
+        user.save()
+        metrics = MetricGenerator().get_metrics()
+        self.assertIn('registrations.source.newname.sum', metrics)
+        self.assertNotIn('registrations.source.oldname.sum', metrics)
+
     def create_registration_on(self, timestamp, source, **kwargs):
         r = Registration.objects.create(
             mother_id='motherid', source=source, data=kwargs)
@@ -772,8 +830,8 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
         Source.objects.create(
             name='TestSource', authority='hw_full', user=user)
         for metric in utils.get_available_metrics():
-            self.assertTrue(callable(getattr(
-                MetricGenerator(), metric.replace('.', '_'))))
+            self.assertTrue(callable(
+                MetricGenerator().get_metric_func(metric)))
 
 
 class SendMetricTests(TestCase):
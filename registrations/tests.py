@@ -8,6 +8,7 @@ except ImportError:
     from io import StringIO
 import responses
 import openpyxl
+import six
 
 try:
     from urllib.parse import urlparse
@@ -24,6 +25,7 @@ from django.test import TestCase, override_settings
 from django.db.models.signals import post_save
 from django.conf import settings
 from django.core.cache import cache
+from django.utils import timezone
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from rest_framework import status
@@ -40,12 +42,18 @@ from .models import (
     Source, Registration, SubscriptionRequest, registration_post_save,
     fire_created_metric, fire_unique_operator_metric, fire_message_type_metric,
     fire_source_metric, fire_receiver_type_metric, fire_language_metric,
-    fire_state_metric, fire_role_metric, ThirdPartyRegistrationError)
+    fire_state_metric, fire_role_metric, ThirdPartyRegistrationError,
+    PublicRegistrationIdentity, HookDelivery, HookTarget, HookSlot,
+    ThirdPartyRegistrationImport, RegistrationIntake, PublicNotificationRun,
+    MirroredSubscription, RegistrationParticipant, SubscriptionMirrorSync)
 from .tasks import (
     validate_registration,
     is_valid_date, is_valid_uuid, is_valid_lang, is_valid_msg_type,
     is_valid_msg_receiver, is_valid_loss_reason, is_valid_state, is_valid_role,
-    repopulate_metrics, send_public_registration_notifications)
+    repopulate_metrics, send_public_registration_notifications,
+    deliver_hook_wrapper, dispatch_hook_deliveries,
+    process_registration_intake, sync_subscription_mirror,
+    sync_messageset_catalog)
 
 
 def override_get_today():
@@ -2469,6 +2477,43 @@ class TestMetricsAPI(AuthenticatedAPITestCase):
             ])
         )
 
+    def test_metrics_read_not_modified(self):
+        """
+        If the ETag from a previous response is sent, and the available
+        metrics haven't changed, a 304 should be returned without querying
+        the sources again.
+        """
+        self.make_source_adminuser()
+        response = self.adminclient.get(
+            '/api/metrics/', content_type='application/json')
+        etag = response['ETag']
+
+        # Token authentication and the version of the sources
+        with self.assertNumQueries(2):
+            response = self.adminclient.get(
+                '/api/metrics/', content_type='application/json',
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_metrics_read_source_added(self):
+        """
+        Adding a source should change the available metrics, and the ETag.
+        """
+        self.make_source_adminuser()
+        response = self.adminclient.get(
+            '/api/metrics/', content_type='application/json')
+        etag = response['ETag']
+
+        self.make_source_normaluser()
+        response = self.adminclient.get(
+            '/api/metrics/', content_type='application/json',
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('registrations.source.testnormaluser.sum',
+                      response.data["metrics_available"])
+
     @responses.activate
     def test_post_metrics(self):
         # Setup
@@ -3004,6 +3049,278 @@ class TestSubscriptionRequestWebhook(AuthenticatedAPITestCase):
         self.assertEqual(d.target, 'http://example.com/registration/')
         self.assertEqual(d.user, user)
 
+    def make_hook_delivery(self, **kwargs):
+        data = {
+            "target": "http://example.com/registration/",
+            "payload": {
+                "data": {"id": "subscrip-9d89-4aa6-99ff-13c225365b5d"}},
+            "instance_id": "subscrip-9d89-4aa6-99ff-13c225365b5d",
+        }
+        data.update(kwargs)
+        return HookDelivery.objects.create(**data)
+
+    def add_metrics_callback(self):
+        responses.add(
+            responses.POST, "http://metrics-url/metrics/",
+            json={}, status=200, content_type='application/json')
+
+    def test_deliver_hook_wrapper(self):
+        """
+        The hook should be written to the outbox instead of being posted
+        directly
+        """
+        hook = Hook.objects.create(
+            user=self.adminuser, event='subscriptionrequest.added',
+            target='http://example.com/registration/')
+        subscription = SubscriptionRequest.objects.create(
+            identity="mother00-9d89-4aa6-99ff-13c225365b5d", messageset=1,
+            lang="eng_NG")
+
+        deliver_hook_wrapper(
+            hook.target, subscription.serialize_hook(hook), subscription,
+            hook)
+
+        [delivery] = HookDelivery.objects.all()
+        self.assertEqual(delivery.target, hook.target)
+        self.assertEqual(delivery.hook_id, hook.id)
+        self.assertEqual(delivery.instance_id, str(subscription.id))
+        self.assertEqual(delivery.payload['data']['id'], str(subscription.id))
+        self.assertEqual(delivery.status, HookDelivery.PENDING)
+
+    @responses.activate
+    def test_dispatch_hook_deliveries(self):
+        """
+        Pending hooks should be posted to their targets and marked as
+        delivered
+        """
+        responses.add(
+            responses.POST, "http://example.com/registration/",
+            json={}, status=201, content_type='application/json')
+        self.add_metrics_callback()
+        delivery = self.make_hook_delivery()
+        self.make_hook_delivery(status=HookDelivery.DELIVERED)
+        self.make_hook_delivery(
+            next_attempt_at=timezone.now() + timedelta(minutes=5))
+
+        result = dispatch_hook_deliveries.apply_async()
+
+        self.assertEqual(result.get(), "1 hook(s) delivered, 0 failed")
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.status, HookDelivery.DELIVERED)
+        self.assertEqual(delivery.attempts, 1)
+        self.assertIsNotNone(delivery.delivered_at)
+
+        call = responses.calls[0]
+        self.assertEqual(json.loads(call.request.body), delivery.payload)
+        self.assertEqual(
+            call.request.headers['Authorization'],
+            'Token %s' % settings.HOOK_AUTH_TOKEN)
+        # Metrics are posted as {<metric name>: <value>}
+        self.assertEqual(
+            [list(json.loads(c.request.body).keys())
+             for c in responses.calls[1:]],
+            [['registrations.hooks.delivered.sum'],
+             ['registrations.hooks.delivery_latency.avg']])
+
+    @responses.activate
+    @override_settings(HOOK_DELIVERY_RETRY_DELAY=30,
+                       HOOK_DELIVERY_MAX_ATTEMPTS=3)
+    def test_dispatch_hook_deliveries_retry(self):
+        """
+        Failed hooks should be retried with a backoff, until the maximum
+        number of attempts is reached
+        """
+        responses.add(
+            responses.POST, "http://example.com/registration/",
+            json={}, status=500, content_type='application/json')
+        self.add_metrics_callback()
+        retry = self.make_hook_delivery(attempts=1)
+        give_up = self.make_hook_delivery(attempts=2)
+
+        before = timezone.now()
+        result = dispatch_hook_deliveries.apply_async()
+
+        self.assertEqual(result.get(), "0 hook(s) delivered, 2 failed")
+        retry.refresh_from_db()
+        self.assertEqual(retry.status, HookDelivery.PENDING)
+        self.assertEqual(retry.attempts, 2)
+        self.assertIn('500', retry.last_error)
+        self.assertGreaterEqual(
+            retry.next_attempt_at, before + timedelta(seconds=60))
+
+        give_up.refresh_from_db()
+        self.assertEqual(give_up.status, HookDelivery.FAILED)
+        self.assertEqual(give_up.attempts, 3)
+
+    @responses.activate
+    def test_dispatch_hook_deliveries_batched(self):
+        """
+        Targets that accept batches should get the payloads posted together
+        as a list, in batches of at most `max_batch_size`
+        """
+        responses.add(
+            responses.POST, "http://example.com/registration/",
+            json={}, status=201, content_type='application/json')
+        self.add_metrics_callback()
+        HookTarget.objects.create(
+            target="http://example.com/registration/",
+            batch_deliveries=True, max_batch_size=2)
+        deliveries = [
+            self.make_hook_delivery(payload={"data": {"id": i}})
+            for i in range(3)]
+
+        result = dispatch_hook_deliveries.apply_async(
+            kwargs={"target": "http://example.com/registration/"})
+
+        self.assertEqual(result.get(), "3 hook(s) delivered, 0 failed")
+        self.assertEqual(
+            [json.loads(c.request.body) for c in responses.calls[:2]],
+            [[deliveries[0].payload, deliveries[1].payload],
+             [deliveries[2].payload]])
+        self.assertEqual(
+            HookDelivery.objects.filter(
+                status=HookDelivery.DELIVERED).count(), 3)
+
+    @responses.activate
+    def test_deliver_hook_target_busy(self):
+        """
+        If the target already has `max_concurrency` deliveries in flight, the
+        hook should be left for the dispatcher
+        """
+        HookTarget.objects.create(
+            target="http://example.com/registration/", max_concurrency=1)
+        delivery = self.make_hook_delivery()
+        slot = tasks.acquire_hook_slot("http://example.com/registration/", 1)
+        self.assertIsNone(
+            tasks.acquire_hook_slot("http://example.com/registration/", 1))
+
+        try:
+            result = tasks.DeliverHook.apply_async(
+                kwargs={"delivery_id": delivery.id})
+        finally:
+            tasks.release_hook_slot(slot)
+
+        self.assertEqual(
+            result.get(), "Target busy, hook left for the dispatcher")
+        self.assertEqual(len(responses.calls), 0)
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.status, HookDelivery.PENDING)
+        self.assertEqual(delivery.attempts, 0)
+
+    def test_hook_slot_expires(self):
+        """
+        A slot that wasn't released should be free again once it expires
+        """
+        target = "http://example.com/registration/"
+        tasks.acquire_hook_slot(target, 1)
+        self.assertIsNone(tasks.acquire_hook_slot(target, 1))
+
+        HookSlot.objects.filter(target=target).update(
+            expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertIsNotNone(tasks.acquire_hook_slot(target, 1))
+
+    def test_schedule_hook_batch_once_per_window(self):
+        """
+        Only one dispatch should be scheduled per batch window, whichever
+        worker the hooks come in on
+        """
+        target = "http://example.com/registration/"
+        HookTarget.objects.create(target=target, batch_deliveries=True)
+
+        with mock.patch.object(
+                tasks.dispatch_hook_deliveries, 'apply_async') as dispatch:
+            tasks.schedule_hook_batch(target)
+            tasks.schedule_hook_batch(target)
+
+        dispatch.assert_called_once_with(
+            kwargs={'target': target}, countdown=settings.HOOK_BATCH_WINDOW)
+
+    @override_settings(HOOK_TARGET_SLOW_LATENCY=2.0,
+                       HOOK_TARGET_FAILURE_THRESHOLD=3,
+                       HOOK_TARGET_LATENCY_SAMPLES=5)
+    def test_hook_target_statistics(self):
+        """
+        The target statistics should track the success rate and latencies,
+        and reduce the concurrency for slow or failing targets
+        """
+        url = "http://example.com/registration/"
+        HookTarget.objects.create(target=url, max_concurrency=8)
+        for latency in [0.1, 0.2, 0.3, 0.4]:
+            HookTarget.record_attempt(url, True, latency)
+        target = HookTarget.objects.get(target=url)
+        self.assertEqual(target.success_rate, 1.0)
+        self.assertEqual(target.latency_p50, 0.3)
+        self.assertEqual(target.latency_p95, 0.4)
+        self.assertEqual(target.concurrency, 8)
+
+        HookTarget.record_attempt(url, False, 10.0)
+        HookTarget.record_attempt(url, False, 10.0)
+        target = HookTarget.objects.get(target=url)
+        self.assertAlmostEqual(target.success_rate, 4.0 / 6)
+        self.assertEqual(target.consecutive_failures, 2)
+        # Only the most recent HOOK_TARGET_LATENCY_SAMPLES are kept
+        self.assertEqual(target.recent_latencies,
+                         [0.2, 0.3, 0.4, 10.0, 10.0])
+        # halved for each failure, and again for the slow p95
+        self.assertEqual(target.concurrency, 1)
+        self.assertFalse(target.is_suspended)
+
+        HookTarget.record_attempt(url, False, 10.0)
+        target = HookTarget.objects.get(target=url)
+        self.assertTrue(target.is_suspended)
+
+        HookTarget.record_attempt(url, True, 0.1)
+        target = HookTarget.objects.get(target=url)
+        self.assertEqual(target.consecutive_failures, 0)
+        self.assertFalse(target.is_suspended)
+
+    def test_hook_target_statistics_new_target(self):
+        """
+        Recording an attempt for a target without a HookTarget creates one
+        """
+        HookTarget.record_attempt("http://example.com/new/", False, 1.5)
+
+        target = HookTarget.objects.get(target="http://example.com/new/")
+        self.assertEqual(target.attempts, 1)
+        self.assertEqual(target.failures, 1)
+        self.assertEqual(target.recent_latencies, [1.5])
+
+    @responses.activate
+    @override_settings(HOOK_TARGET_FAILURE_THRESHOLD=1)
+    def test_dispatch_hook_deliveries_failing_target(self):
+        """
+        Once a target has failed too many times in a row, no more requests
+        should be made to it until its suspension is over
+        """
+        responses.add(
+            responses.POST, "http://example.com/registration/",
+            json={}, status=503, content_type='application/json')
+        self.add_metrics_callback()
+        first = self.make_hook_delivery()
+        second = self.make_hook_delivery()
+
+        result = dispatch_hook_deliveries.apply_async()
+
+        self.assertEqual(result.get(), "0 hook(s) delivered, 1 failed")
+        self.assertEqual(
+            [c.request.url for c in responses.calls].count(
+                "http://example.com/registration/"), 1)
+        target = HookTarget.objects.get(
+            target="http://example.com/registration/")
+        self.assertTrue(target.is_suspended)
+        self.assertEqual(target.failures, 1)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.attempts, 1)
+        self.assertEqual(second.attempts, 0)
+        self.assertEqual(second.next_attempt_at, target.suspended_until)
+
+        result = tasks.DeliverHook.apply_async(
+            kwargs={"delivery_id": second.id})
+        self.assertEqual(
+            result.get(), "Target suspended, hook left for the dispatcher")
+
     # This test is not working despite the code working fine
     # If you run these same steps below interactively the webhook will fire
     # @responses.activate
@@ -4036,8 +4353,37 @@ class TestThirdPartyRegistrations(AuthenticatedAPITestCase):
         task = tasks.PullThirdPartyRegistrations()
         data = task.get_data()
 
+        self.assertEqual(list(data), override_get_data(None))
+
+    @responses.activate
+    @override_settings(THIRDPARTY_REGISTRATIONS_URL='http://www.3rd.org/d/99/',
+                       THIRDPARTY_REGISTRATIONS_STREAMING=False)
+    def test_get_data_not_streaming(self):
+
+        self.mock_excel_download()
+
+        task = tasks.PullThirdPartyRegistrations()
+        data = task.get_data()
+
         self.assertEqual(data, override_get_data(None))
 
+    @responses.activate
+    @override_settings(THIRDPARTY_REGISTRATIONS_URL='http://www.3rd.org/d/99/',
+                       THIRDPARTY_REGISTRATIONS_STREAMING=True)
+    def test_get_data_streaming(self):
+        """
+        In streaming mode the rows should only be read as they are needed
+        """
+        self.mock_excel_download()
+
+        task = tasks.PullThirdPartyRegistrations()
+        data = task.get_data()
+        self.assertEqual(len(responses.calls), 0)
+
+        self.assertEqual(next(data), override_get_data(None)[0])
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(list(data), [])
+
     @responses.activate
     def test_start_pull_task(self):
         tasks.PullThirdPartyRegistrations.get_data = override_get_data
@@ -4218,6 +4564,180 @@ class TestThirdPartyRegistrations(AuthenticatedAPITestCase):
 
         self.assertTrue(e.data['error'].find("Connection refused") != -1)
 
+    @responses.activate
+    def test_start_pull_task_skips_imported_rows(self):
+        """
+        Rows that were imported by an earlier run should be skipped, and the
+        progress of each run recorded
+        """
+        tasks.PullThirdPartyRegistrations.get_data = override_get_data
+        self.make_source_adminuser()
+
+        mother_id = "4038a518-2940-4b15-9c5c-2b7b123b8735"
+        father_id = "4038a518-2940-4b15-9c5c-829385793255"
+        operator_id = "4038a518-1111-1111-1111-hfud7383gfyt"
+
+        self.mock_identity_lookup("%2B2347031221927", mother_id)
+        self.mock_identity_lookup("%2B2347031221928", father_id)
+        self.mock_operator_lookup("11111", operator_id)
+        self.mock_subscription_lookup(mother_id)
+        self.mock_identity_patch(mother_id)
+        self.mock_identity_patch(father_id)
+
+        result = tasks.pull_third_party_registrations.apply_async(
+            args=[self.adminuser.id])
+        self.assertEqual(
+            result.get(), "1 imported, 0 skipped, 0 failed, 0% lookup hits")
+        self.assertEqual(len(responses.calls), 6)
+
+        result = tasks.pull_third_party_registrations.apply_async(
+            args=[self.adminuser.id])
+        self.assertEqual(
+            result.get(), "0 imported, 1 skipped, 0 failed, 0% lookup hits")
+        self.assertEqual(len(responses.calls), 6)
+        self.assertEqual(Registration.objects.count(), 1)
+
+        first, second = ThirdPartyRegistrationImport.objects.order_by(
+            'created_at')
+        self.assertEqual(
+            (first.rows, first.imported, first.skipped, first.failed),
+            (1, 1, 0, 0))
+        self.assertEqual(
+            (second.rows, second.imported, second.skipped, second.failed),
+            (1, 0, 1, 0))
+        self.assertIsNotNone(second.finished_at)
+        self.assertEqual(first.imported_rows.count(), 1)
+
+    @responses.activate
+    def test_start_pull_task_error_summary(self):
+        """
+        Errors should be linked to the run they happened in, and identical
+        errors counted together in the run's summary
+        """
+        def get_data(task):
+            rows = override_get_data_bad(task) + override_get_data_bad(task)
+            rows[1] = dict(rows[1], pregnancy_week="14")
+            return rows
+
+        tasks.PullThirdPartyRegistrations.get_data = get_data
+        self.make_source_adminuser()
+        self.mock_operator_lookup(
+            "11111", "4038a518-1111-1111-1111-hfud7383gfyt")
+
+        with self.assertRaises(tasks.ThirdPartyRegistrationsFailed) as cm:
+            tasks.pull_third_party_registrations.apply_async(
+                args=[self.adminuser.id])
+        self.assertTrue(
+            str(cm.exception).startswith("2 row(s) failed to import: "))
+
+        [run] = ThirdPartyRegistrationImport.objects.all()
+        self.assertEqual(run.failed, 2)
+        self.assertEqual(run.errors.count(), 2)
+        [(error, count)] = run.error_summary.items()
+        self.assertTrue(error.find("mother_id") != -1)
+        self.assertEqual(count, 2)
+
+        response = self.adminclient.get(
+            '/api/v1/thirdpartyimports/%s/' % run.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['failed'], 2)
+        self.assertEqual(
+            response.data['error_summary'], [{'error': error, 'count': 2}])
+
+    @responses.activate
+    @override_settings(THIRDPARTY_REGISTRATIONS_WORKERS=1)
+    def test_start_pull_task_caches_lookups(self):
+        """
+        Identities should only be looked up once per run, no matter how many
+        rows they are on
+        """
+        def get_data(task):
+            rows = override_get_data(task) + override_get_data(task)
+            rows[1] = dict(rows[1], pregnancy_week="14")
+            return rows
+
+        tasks.PullThirdPartyRegistrations.get_data = get_data
+        self.make_source_adminuser()
+
+        mother_id = "4038a518-2940-4b15-9c5c-2b7b123b8735"
+        father_id = "4038a518-2940-4b15-9c5c-829385793255"
+        operator_id = "4038a518-1111-1111-1111-hfud7383gfyt"
+
+        self.mock_identity_lookup("%2B2347031221927", mother_id)
+        self.mock_identity_lookup("%2B2347031221928", father_id)
+        self.mock_operator_lookup("11111", operator_id)
+        self.mock_subscription_lookup(mother_id)
+        self.mock_identity_patch(mother_id)
+        self.mock_identity_patch(father_id)
+
+        result = tasks.pull_third_party_registrations.apply_async(
+            args=[self.adminuser.id])
+
+        self.assertEqual(
+            result.get(), "2 imported, 0 skipped, 0 failed, 50% lookup hits")
+        self.assertEqual(Registration.objects.count(), 2)
+        searches = [
+            call.request.url for call in responses.calls
+            if '/identities/search/' in call.request.url]
+        self.assertEqual(len(searches), 3)
+
+    @responses.activate
+    @override_settings(THIRDPARTY_REGISTRATIONS_WORKERS=4)
+    def test_start_pull_task_shared_numbers_concurrent(self):
+        """
+        Rows with the same phone numbers should be built by the same
+        thread, so that their identities are only looked up once even when
+        the rows are built concurrently
+        """
+        def get_data(task):
+            rows = override_get_data(task) + override_get_data(task)
+            rows[1] = dict(rows[1], pregnancy_week="14")
+            return rows
+
+        tasks.PullThirdPartyRegistrations.get_data = get_data
+        self.make_source_adminuser()
+
+        mother_id = "4038a518-2940-4b15-9c5c-2b7b123b8735"
+        father_id = "4038a518-2940-4b15-9c5c-829385793255"
+        operator_id = "4038a518-1111-1111-1111-hfud7383gfyt"
+
+        self.mock_identity_lookup("%2B2347031221927", mother_id)
+        self.mock_identity_lookup("%2B2347031221928", father_id)
+        self.mock_operator_lookup("11111", operator_id)
+        self.mock_subscription_lookup(mother_id)
+        self.mock_identity_patch(mother_id)
+        self.mock_identity_patch(father_id)
+
+        result = tasks.pull_third_party_registrations.apply_async(
+            args=[self.adminuser.id])
+
+        self.assertEqual(
+            result.get(), "2 imported, 0 skipped, 0 failed, 50% lookup hits")
+        searches = [
+            call.request.url for call in responses.calls
+            if '/identities/search/' in call.request.url]
+        self.assertEqual(len(searches), 3)
+
+    def test_group_lines(self):
+        """
+        Lines should be grouped when they share a mother or gatekeeper
+        number, including through another line
+        """
+        lines = [
+            {"mothers_phone_number": "08031234567",
+             "gatekeeper_phone_number": "08031234568"},
+            {"mothers_phone_number": "08031234569",
+             "gatekeeper_phone_number": ""},
+            {"mothers_phone_number": "+2348031234568",
+             "gatekeeper_phone_number": "08031234570"},
+            {"mothers_phone_number": "08031234571",
+             "gatekeeper_phone_number": "08031234570"},
+        ]
+
+        self.assertEqual(
+            tasks.pull_third_party_registrations.group_lines(lines),
+            [[0, 2, 3], [1]])
+
 
 class TestAddRegistrationsAPI(TestThirdPartyRegistrations):
 
@@ -4597,6 +5117,72 @@ class TestAddRegistrationsAPI(TestThirdPartyRegistrations):
 
         self.assertEqual(Registration.objects.count(), 0)
 
+    @responses.activate
+    @override_settings(ADD_REGISTRATION_ASYNC=True)
+    def test_add_registration_async(self):
+        """
+        If ADD_REGISTRATION_ASYNC is set, the registration should be queued
+        and accepted straight away, with its status available once a worker
+        has created the registration
+        """
+        self.make_source_adminuser()
+
+        mother_id = "4038a518-2940-4b15-9c5c-2b7b123b8735"
+        operator_id = "4038a518-1111-1111-1111-hfud7383gfyt"
+
+        self.mock_identity_lookup("%2B2347031221927", mother_id)
+        self.mock_operator_lookup("11111", operator_id)
+        self.mock_subscription_lookup(mother_id)
+        self.mock_identity_patch(mother_id)
+
+        data = override_get_data_mother_only(None)[0]
+
+        response = self.adminclient.post('/api/v1/addregistration/',
+                                         json.dumps(data),
+                                         content_type='application/json')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['registration_accepted'], True)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual(len(responses.calls), 0)
+        self.assertEqual(Registration.objects.count(), 0)
+
+        intake_id = response.data['intake_id']
+        self.assertEqual(
+            process_registration_intake(intake_id), "Intake completed")
+        self.assertEqual(
+            process_registration_intake(intake_id), "Intake already processed")
+
+        reg = Registration.objects.get()
+        self.assertEqual(
+            reg.created_by, User.objects.get(username='testadminuser'))
+
+        response = self.adminclient.get(
+            '/api/v1/addregistration/%s/' % intake_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'completed')
+        self.assertEqual(response.data['registration'], reg.id)
+
+    @override_settings(ADD_REGISTRATION_ASYNC=True)
+    def test_add_registration_async_missing_field(self):
+        """
+        Registrations with missing fields should be rejected before they are
+        queued
+        """
+        self.make_source_adminuser()
+
+        data = override_get_data_mother_only(None)[0]
+        del data['gravida']
+
+        response = self.adminclient.post('/api/v1/addregistration/',
+                                         json.dumps(data),
+                                         content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['registration_accepted'], False)
+        self.assertEqual(response.data['error'], "Missing field: 'gravida'")
+        self.assertEqual(RegistrationIntake.objects.count(), 0)
+
 
 class TestPersonnelCodeView(AuthenticatedAPITestCase):
 
@@ -4895,7 +5481,10 @@ class TestSendPublicRegistrationNotifications(AuthenticatedAPITestCase):
         # Execute
         result = send_public_registration_notifications.apply_async()
         # Check
-        self.assertEqual(result.get(), "0 CORP notification(s) sent")
+        six.assertRegex(
+            self, result.get(),
+            r'^0 CORP notification\(s\) sent, 0 subscription\(s\) '
+            r'checked at [0-9.]+/s$')
 
         self.assertEqual(len(responses.calls), 1)
 
@@ -4958,16 +5547,19 @@ class TestSendPublicRegistrationNotifications(AuthenticatedAPITestCase):
         # Execute
         result = send_public_registration_notifications.apply_async()
         # Check
-        self.assertEqual(result.get(), "1 CORP notification(s) sent")
+        six.assertRegex(
+            self, result.get(),
+            r'^1 CORP notification\(s\) sent, 2 subscription\(s\) '
+            r'checked at [0-9.]+/s$')
 
         self.assertEqual(len(responses.calls), 8)
 
-        # check the subscription patch
-        call = responses.calls[-2]
-        self.assertEqual(
-            call.request.url,
+        # check the subscription patch, the patches are sent concurrently
+        [call] = [
+            call for call in responses.calls
+            if call.request.url ==
             'http://localhost:8005/api/v1/subscriptions/{}/'.format(
-                subscription_id2))
+                subscription_id2)]
         self.assertEqual(
             json.loads(call.request.body)['metadata'],
             {
@@ -4984,6 +5576,44 @@ class TestSendPublicRegistrationNotifications(AuthenticatedAPITestCase):
         self.assertEqual(json.loads(call.request.body)['to_identity'],
                          operator_id)
 
+        run = PublicNotificationRun.objects.get()
+        self.assertEqual(run.processed, 2)
+        self.assertEqual(run.notifications, 1)
+        self.assertEqual(run.details, {})
+        self.assertIsNotNone(run.finished_at)
+
+    @responses.activate
+    def test_send_notifications_resumes_checkpoint(self):
+        """
+        If an earlier run was interrupted, the msisdns it had already found
+        should be sent out by the next run.
+        """
+        operator_id = "nurse000-6a07-4377-a4f6-c0485ccba234"
+        run = PublicNotificationRun.objects.create(
+            processed=3, details={operator_id: ["+234333"]})
+
+        self.mock_subscription_search(
+            'completed=True&metadata_not_has_key=public_notification&'
+            'messageset_contains=public.mother')
+        self.mock_outbound()
+
+        result = send_public_registration_notifications.apply_async()
+        six.assertRegex(
+            self, result.get(),
+            r'^1 CORP notification\(s\) sent, 3 subscription\(s\) '
+            r'checked at [0-9.]+/s$')
+
+        self.assertEqual(len(responses.calls), 2)
+        call = responses.calls[-1]
+        self.assertEqual(
+            json.loads(call.request.body)['content'],
+            'Public registrations not on full set: +234333')
+
+        run.refresh_from_db()
+        self.assertEqual(run.processed, 3)
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual(PublicNotificationRun.objects.count(), 1)
+
     @responses.activate
     def test_send_notifications_with_active(self):
         """
@@ -5027,7 +5657,10 @@ class TestSendPublicRegistrationNotifications(AuthenticatedAPITestCase):
         # Execute
         result = send_public_registration_notifications.apply_async()
         # Check
-        self.assertEqual(result.get(), "0 CORP notification(s) sent")
+        six.assertRegex(
+            self, result.get(),
+            r'^0 CORP notification\(s\) sent, 1 subscription\(s\) '
+            r'checked at [0-9.]+/s$')
 
         self.assertEqual(len(responses.calls), 3)
 
@@ -5454,12 +6087,24 @@ class TestStopPublicRegistrations(AuthenticatedAPITestCase):
         validate_registration.stop_public_subscriptions(registration)
         self.assertEqual(len(responses.calls), 0)
 
+    @responses.activate
+    def test_stop_public_subscription_no_public_registration(self):
+        """
+        If the mother has never had a public registration then there is no
+        need to look for public subscriptions
+        """
+        registration = self.make_registration_normaluser()
+        validate_registration.stop_public_subscriptions(registration)
+        self.assertEqual(len(responses.calls), 0)
+
     @responses.activate
     def test_stop_public_subscription_new(self):
         """
         If no public subscriptions are found then nothing should be stopped
         """
         registration = self.make_registration_normaluser()
+        PublicRegistrationIdentity.objects.create(
+            identity="mother00-9d89-4aa6-99ff-13c225365b5d")
 
         self.mock_subscription_search(
             'active=True&completed=False&messageset_contains=public.mother&'
@@ -5478,6 +6123,7 @@ class TestStopPublicRegistrations(AuthenticatedAPITestCase):
         mother_id = "mother00-9d89-4aa6-99ff-13c225365b5d"
         subscription_id = "subscrip-9d89-4aa6-99ff-13c225365b5d"
         registration = self.make_registration_normaluser()
+        PublicRegistrationIdentity.objects.create(identity=mother_id)
 
         self.mock_subscription_search(
             'active=True&completed=False&messageset_contains=public.mother&'
@@ -5519,6 +6165,7 @@ class TestStopPublicRegistrations(AuthenticatedAPITestCase):
         household_id = "househ00-9d89-4aa6-99ff-13c225365b5d"
         subscription_id = "subscrip-9d89-4aa6-99ff-13c225365b5d"
         registration = self.make_registration_normaluser()
+        PublicRegistrationIdentity.objects.create(identity=mother_id)
 
         self.mock_subscription_search(
             'active=True&completed=False&messageset_contains=public.mother&'
@@ -5559,3 +6206,300 @@ class TestStopPublicRegistrations(AuthenticatedAPITestCase):
                 "existing": "key"
             }
         })
+
+    def test_record_public_registration(self):
+        """
+        Public registrations should add the mother to the public registration
+        index, other registrations should not
+        """
+        validate_registration.record_public_registration(
+            self.make_registration_normaluser())
+        self.assertFalse(PublicRegistrationIdentity.objects.exists())
+
+        registration = self.make_registration_normaluser("public")
+        validate_registration.record_public_registration(registration)
+        validate_registration.record_public_registration(registration)
+        self.assertEqual(
+            list(PublicRegistrationIdentity.objects.values_list(
+                'identity', flat=True)),
+            [registration.mother_id])
+
+
+class TestRegistrationParticipant(AuthenticatedAPITestCase):
+
+    def test_participants_indexed_on_save(self):
+        """
+        Saving a registration should index it under the mother and the
+        receiver, and only rewrite the index if either of them changes.
+        """
+        registration = Registration.objects.create(
+            mother_id="mother01-63e2-4acc-9b94-26663b9bc267",
+            stage="prebirth", source=self.make_source_normaluser(),
+            data={"receiver_id": "friend01-63e2-4acc-9b94-26663b9bc267"})
+
+        self.assertEqual(
+            set(registration.participants.values_list('identity', 'role')),
+            set([("mother01-63e2-4acc-9b94-26663b9bc267", "mother"),
+                 ("friend01-63e2-4acc-9b94-26663b9bc267", "receiver")]))
+
+        registration = Registration.objects.get(id=registration.id)
+        registration.validated = True
+        with self.assertNumQueries(1):
+            registration.save()
+
+        registration.data["receiver_id"] = \
+            "friend02-63e2-4acc-9b94-26663b9bc267"
+        registration.save()
+        self.assertEqual(
+            set(registration.participants.values_list('identity', 'role')),
+            set([("mother01-63e2-4acc-9b94-26663b9bc267", "mother"),
+                 ("friend02-63e2-4acc-9b94-26663b9bc267", "receiver")]))
+
+    def test_get_latest_registration(self):
+        """
+        The latest registration for an identity should be found whether it
+        is the mother or the receiver.
+        """
+        source = self.make_source_normaluser()
+        mother_id = "mother01-63e2-4acc-9b94-26663b9bc267"
+        first = Registration.objects.create(
+            mother_id=mother_id, stage="prebirth", source=source, data={})
+        latest = Registration.objects.create(
+            mother_id="mother02-63e2-4acc-9b94-26663b9bc267",
+            stage="postbirth", source=source,
+            data={"receiver_id": mother_id})
+
+        self.assertEqual(
+            RegistrationParticipant.get_latest_registration(mother_id),
+            latest)
+        self.assertEqual(
+            RegistrationParticipant.get_latest_registration(
+                mother_id, roles=[RegistrationParticipant.MOTHER]),
+            first)
+        self.assertIsNone(
+            RegistrationParticipant.get_latest_registration(
+                "unknown1-63e2-4acc-9b94-26663b9bc267"))
+
+
+class TestSubscriptionMirror(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestSubscriptionMirror, self).setUp()
+        cache.clear()
+
+    def make_subscription(self, subscription_id, **kwargs):
+        subscription = {
+            "id": subscription_id,
+            "identity": "mother01-63e2-4acc-9b94-26663b9bc267",
+            "messageset": 1,
+            "next_sequence_number": 3,
+            "lang": "eng_NG",
+            "active": True,
+            "completed": False,
+            "process_status": 0,
+            "schedule": 1,
+            "metadata": {},
+            "created_at": "2017-01-01T00:00:00Z",
+            "updated_at": "2017-01-02T00:00:00Z",
+        }
+        subscription.update(kwargs)
+        return subscription
+
+    @responses.activate
+    def test_webhook_updates_mirror(self):
+        """
+        The SBM's subscription webhooks should create and then update the
+        local copy of the subscription.
+        """
+        subscription_id = "1b47bab8-1c37-44a2-94e6-85c3ee9a8c8b"
+        self.mock_messageset_lookup(1, {
+            "id": 1, "short_name": "prebirth.mother.text.10_42"})
+
+        for active in (True, False):
+            response = self.adminclient.post(
+                '/api/v1/subscription_mirror/', json.dumps({
+                    "hook": {},
+                    "data": self.make_subscription(
+                        subscription_id, active=active),
+                }), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+
+        subscription = MirroredSubscription.objects.get()
+        self.assertEqual(str(subscription.id), subscription_id)
+        self.assertEqual(subscription.active, False)
+        self.assertEqual(
+            subscription.messageset_short_name, "prebirth.mother.text.10_42")
+        # The messageset is only looked up once
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_webhook_requires_subscription(self):
+        """
+        Payloads that aren't subscriptions should be rejected.
+        """
+        response = self.adminclient.post(
+            '/api/v1/subscription_mirror/',
+            json.dumps({"hook": {}, "data": {"identity": "mother01"}}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(MirroredSubscription.objects.exists())
+
+    @responses.activate
+    def test_sync_is_incremental(self):
+        """
+        The sync should only ask for the subscriptions updated since the
+        latest one in the mirror.
+        """
+        subscription_id = "1b47bab8-1c37-44a2-94e6-85c3ee9a8c8b"
+        MirroredSubscription.objects.create(
+            id="2c58cbc9-1c37-44a2-94e6-85c3ee9a8c8b",
+            identity="mother02-63e2-4acc-9b94-26663b9bc267", messageset=1,
+            updated_at=datetime(2017, 1, 1, tzinfo=timezone.utc))
+        sync = SubscriptionMirrorSync.get()
+        sync.synced_until = datetime(2017, 1, 1, tzinfo=timezone.utc)
+        sync.full_sync_at = datetime(2017, 1, 1, tzinfo=timezone.utc)
+        sync.save()
+        self.mock_subscription_search(
+            'updated_after=2017-01-01T00%3A00%3A00%2B00%3A00',
+            [self.make_subscription(subscription_id)])
+        self.mock_messageset_lookup(1, {
+            "id": 1, "short_name": "prebirth.mother.text.10_42"})
+
+        result = sync_subscription_mirror.apply_async()
+
+        self.assertEqual(result.get(), "1 subscription(s) synced")
+        self.assertEqual(MirroredSubscription.objects.count(), 2)
+        self.assertTrue(
+            MirroredSubscription.objects.filter(id=subscription_id).exists())
+        self.assertEqual(
+            SubscriptionMirrorSync.get().synced_until,
+            datetime(2017, 1, 2, tzinfo=timezone.utc))
+
+    @responses.activate
+    def test_sync_cursor_ignores_webhooks(self):
+        """
+        Subscriptions written by webhooks shouldn't move the sync on, so the
+        first sync should still copy every subscription, and searches should
+        go to the SBM until it has.
+        """
+        identity = "mother01-63e2-4acc-9b94-26663b9bc267"
+        self.mock_messageset_lookup(1, {
+            "id": 1, "short_name": "prebirth.mother.text.10_42"})
+        self.adminclient.post(
+            '/api/v1/subscription_mirror/', json.dumps({
+                "hook": {},
+                "data": self.make_subscription(
+                    "1b47bab8-1c37-44a2-94e6-85c3ee9a8c8b",
+                    updated_at="2017-03-01T00:00:00Z"),
+            }), content_type='application/json')
+
+        self.mock_subscription_search(
+            'identity={}&active=True'.format(identity), [])
+        with override_settings(SUBSCRIPTION_MIRROR_READS=True):
+            self.assertEqual(list(utils.get_subscriptions(identity)), [])
+
+        responses.add(
+            responses.GET, 'http://localhost:8005/api/v1/subscriptions/',
+            json={"next": None, "previous": None, "results": [
+                self.make_subscription(
+                    "2c58cbc9-1c37-44a2-94e6-85c3ee9a8c8b")]},
+            status=200, content_type='application/json',
+            match_querystring=True)
+
+        result = sync_subscription_mirror.apply_async()
+
+        self.assertEqual(result.get(), "1 subscription(s) synced")
+        self.assertEqual(MirroredSubscription.objects.count(), 2)
+        sync = SubscriptionMirrorSync.get()
+        self.assertIsNotNone(sync.full_sync_at)
+        self.assertEqual(
+            sync.synced_until, datetime(2017, 1, 2, tzinfo=timezone.utc))
+
+    @responses.activate
+    def test_webhook_out_of_order(self):
+        """
+        A webhook for an older version of a subscription shouldn't overwrite
+        a newer copy in the mirror.
+        """
+        subscription_id = "1b47bab8-1c37-44a2-94e6-85c3ee9a8c8b"
+        self.mock_messageset_lookup(1, {
+            "id": 1, "short_name": "prebirth.mother.text.10_42"})
+
+        for active, updated_at in ((False, "2017-01-03T00:00:00Z"),
+                                   (True, "2017-01-02T00:00:00Z")):
+            response = self.adminclient.post(
+                '/api/v1/subscription_mirror/', json.dumps({
+                    "hook": {},
+                    "data": self.make_subscription(
+                        subscription_id, active=active,
+                        updated_at=updated_at),
+                }), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+
+        subscription = MirroredSubscription.objects.get()
+        self.assertEqual(subscription.active, False)
+        self.assertEqual(
+            subscription.updated_at,
+            datetime(2017, 1, 3, tzinfo=timezone.utc))
+
+    @override_settings(SUBSCRIPTION_MIRROR_READS=True)
+    def test_search_reads_from_mirror(self):
+        """
+        With SUBSCRIPTION_MIRROR_READS set, searches the mirror can answer
+        should not go to the SBM.
+        """
+        identity = "mother01-63e2-4acc-9b94-26663b9bc267"
+        sync = SubscriptionMirrorSync.get()
+        sync.full_sync_at = timezone.now()
+        sync.save()
+        MirroredSubscription.objects.create(
+            id="1b47bab8-1c37-44a2-94e6-85c3ee9a8c8b", identity=identity,
+            messageset=1, messageset_short_name="prebirth.mother.text.10_42")
+        MirroredSubscription.objects.create(
+            id="2c58cbc9-1c37-44a2-94e6-85c3ee9a8c8b", identity=identity,
+            messageset=2, messageset_short_name="public.mother.text.0_12",
+            active=False)
+
+        subscriptions = list(utils.get_subscriptions(identity))
+        self.assertEqual(
+            [s['id'] for s in subscriptions],
+            ["1b47bab8-1c37-44a2-94e6-85c3ee9a8c8b"])
+
+        subscriptions = list(utils.search_subscriptions({
+            'identity': identity, 'messageset_contains': 'public.mother'}))
+        self.assertEqual(
+            [s['id'] for s in subscriptions],
+            ["2c58cbc9-1c37-44a2-94e6-85c3ee9a8c8b"])
+
+        self.assertIsNone(utils.search_mirrored_subscriptions(
+            {'created_after': '2017-01-01'}))
+
+    @responses.activate
+    def test_sync_messageset_catalog(self):
+        """
+        The sync should copy every messageset and schedule, working out how
+        many messages a week each schedule sends.
+        """
+        responses.add(
+            responses.GET, 'http://localhost:8005/api/v1/messageset/',
+            json={"next": None, "previous": None, "results": [{
+                "id": 1, "short_name": "prebirth.mother.text.10_42",
+                "default_schedule": 3}]},
+            status=200, content_type='application/json',
+            match_querystring=True)
+        responses.add(
+            responses.GET, 'http://localhost:8005/api/v1/schedule/',
+            json={"next": None, "previous": None, "results": [{
+                "id": 3, "day_of_week": "1,3,5"}]},
+            status=200, content_type='application/json',
+            match_querystring=True)
+
+        result = sync_messageset_catalog.apply_async()
+
+        self.assertEqual(
+            result.get(), "1 messageset(s) and 1 schedule(s) synced")
+        messageset = utils.get_mirrored_messageset(
+            short_name="prebirth.mother.text.10_42")
+        self.assertEqual(messageset.id, 1)
+        self.assertEqual(messageset.default_schedule, 3)
+        self.assertEqual(utils.get_mirrored_schedule(3).messages_per_week, 3)
+        self.assertEqual(len(responses.calls), 2)
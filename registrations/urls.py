@@ -8,6 +8,8 @@ router.register(r'group', views.GroupViewSet)
 router.register(r'source', views.SourceViewSet)
 router.register(r'webhook', views.HookViewSet)
 router.register(r'registrations', views.RegistrationGetViewSet)
+router.register(r'thirdpartyimports',
+                views.ThirdPartyRegistrationImportViewSet)
 
 
 # Wire up our API using automatic URL routing.
@@ -23,12 +25,16 @@ urlpatterns = [
         views.ThirdPartyRegistrationView.as_view()),
     url(r'^api/v1/addregistration/$',
         views.AddRegistrationView.as_view()),
+    url(r'^api/v1/addregistration/(?P<id>[^/]+)/$',
+        views.AddRegistrationStatusView.as_view()),
     url(r'^api/v1/personnelcode/$',
         views.PersonnelCodeView.as_view()),
     url(r'^api/v1/send_public_notifications/$',
         views.SendPublicRegistrationNotificationView.as_view()),
     url(r'^api/v1/missedcall_notification/',
         views.MissedCallNotification.as_view()),
+    url(r'^api/v1/subscription_mirror/$',
+        views.SubscriptionMirrorWebhook.as_view()),
     url(r'^api/v1/user_details/$',
         views.UserDetailList.as_view()),
 ]
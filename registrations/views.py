@@ -1,10 +1,10 @@
 import django_filters
 import django_filters.rest_framework as filters
 from django.contrib.auth.models import User, Group
-from django.db.models import Q
 from django.conf import settings
-from django.db import connection
-from .models import Source, Registration
+from django.db import connection, transaction
+from .models import (Source, Registration, ThirdPartyRegistrationImport,
+                     RegistrationIntake, RegistrationParticipant)
 from rest_hooks.models import Hook
 from rest_framework import viewsets, mixins, generics, status
 from rest_framework.exceptions import ValidationError
@@ -15,12 +15,15 @@ from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from .serializers import (UserSerializer, GroupSerializer,
                           SourceSerializer, RegistrationSerializer,
-                          HookSerializer, CreateUserSerializer)
+                          HookSerializer, CreateUserSerializer,
+                          ThirdPartyRegistrationImportSerializer,
+                          RegistrationIntakeSerializer)
 from hellomama_registration import utils
 # Uncomment line below if scheduled metrics are added
 # from .tasks import scheduled_metrics
 from .tasks import (
-    pull_third_party_registrations, send_public_registration_notifications)
+    pull_third_party_registrations, send_public_registration_notifications,
+    process_registration_intake)
 
 
 class CreatedAtCursorPagination(CursorPagination):
@@ -109,11 +112,19 @@ class MetricsView(APIView):
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, *args, **kwargs):
+        catalog = utils.get_available_metrics_catalog()
+        etag = '"%s"' % catalog['version']
+        headers = {'ETag': etag}
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return Response(status=304, headers=headers)
+
         status = 200
         resp = {
-            "metrics_available": utils.get_available_metrics()
+            "metrics_available": catalog['metrics']
         }
-        return Response(resp, status=status)
+        return Response(resp, status=status, headers=headers)
 
     def post(self, request, *args, **kwargs):
         status = 201
@@ -204,14 +215,42 @@ class ThirdPartyRegistrationView(APIView):
         return Response(resp, status=status)
 
 
+class ThirdPartyRegistrationImportViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint that shows the progress of third party registration pulls,
+    with a summary of the errors for each one.
+    """
+    permission_classes = (IsAuthenticated,)
+    queryset = ThirdPartyRegistrationImport.objects.all()
+    serializer_class = ThirdPartyRegistrationImportSerializer
+    pagination_class = CreatedAtCursorPagination
+
+    def get_queryset(self):
+        queryset = super(
+            ThirdPartyRegistrationImportViewSet, self).get_queryset()
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(source__user=self.request.user)
+        return queryset
+
+
 class AddRegistrationView(APIView):
 
     """ ThirdPartyRegistrationView Interaction
-        POST - Validates and Saves the registration
+        POST - Validates and Saves the registration, or queues it for a
+               worker if ADD_REGISTRATION_ASYNC is set
     """
     permission_classes = (IsAuthenticated,)
 
+    required_fields = (
+        'mothers_phone_number', 'health_worker_personnel_code',
+        'pregnancy_week', 'gravida', 'preferred_msg_language',
+        'type_of_registration', 'preferred_msg_type', 'message_receiver',
+        'gatekeeper_phone_number')
+
     def post(self, request, *args, **kwargs):
+        if settings.ADD_REGISTRATION_ASYNC:
+            return self.queue_registration(request)
+
         status = 201
         resp = {"registration_added": True}
 
@@ -245,6 +284,50 @@ class AddRegistrationView(APIView):
 
         return Response(resp, status=status)
 
+    def queue_registration(self, request):
+        try:
+            source = Source.objects.get(user=self.request.user.id)
+        except Source.DoesNotExist as error:
+            return Response({"registration_accepted": False,
+                             "error": str(error)}, status=400)
+
+        data = request.data
+        # See the failsafe in post
+        if('health_worker_phone_number' in data and
+                'health_worker_personnel_code' not in data):
+            data['health_worker_personnel_code'] = \
+                data['health_worker_phone_number']
+
+        for field in self.required_fields:
+            if field not in data:
+                return Response({
+                    "registration_accepted": False,
+                    "error": "Missing field: %r" % str(field)}, status=400)
+
+        intake = RegistrationIntake.objects.create(source=source, data=data)
+        transaction.on_commit(lambda: process_registration_intake.apply_async(
+            kwargs={"intake_id": str(intake.id)}))
+
+        return Response({"registration_accepted": True,
+                         "intake_id": str(intake.id),
+                         "status": intake.status}, status=202)
+
+
+class AddRegistrationStatusView(generics.RetrieveAPIView):
+    """ AddRegistrationStatusView Interaction
+        GET - returns how far processing of a queued registration has got
+    """
+    permission_classes = (IsAuthenticated,)
+    queryset = RegistrationIntake.objects.all()
+    serializer_class = RegistrationIntakeSerializer
+    lookup_field = 'id'
+
+    def get_queryset(self):
+        queryset = super(AddRegistrationStatusView, self).get_queryset()
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(source__user=self.request.user)
+        return queryset
+
 
 class PersonnelCodeView(APIView):
 
@@ -293,12 +376,9 @@ class MissedCallNotification(APIView):
             raise ValidationError('"data" must be supplied')
 
         if data.get('identity', None) is not None and data['identity'] != "":
-            registrations = Registration.objects.filter(
-                Q(mother_id=data['identity']) |
-                Q(data__receiver_id=data['identity'])).order_by('-created_at')
-            if len(registrations) > 0:
-                registration = registrations[0]
-            else:
+            registration = RegistrationParticipant.get_latest_registration(
+                data['identity'])
+            if registration is None:
                 raise ValidationError('No registration found for identity')
         else:
             raise ValidationError(
@@ -333,6 +413,30 @@ class MissedCallNotification(APIView):
         return Response(status=status.HTTP_200_OK)
 
 
+class SubscriptionMirrorWebhook(APIView):
+    """ SubscriptionMirrorWebhook Interaction
+        POST - updates the local copy of a subscription when the SBM's
+               webhooks report it as created or changed
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            # The hooks send the request data as {"hook":{}, "data":{}}
+            data = request.data['data']
+        except KeyError:
+            raise ValidationError('"data" must be supplied')
+
+        if not isinstance(data, dict) or \
+                not data.get('id') or not data.get('messageset'):
+            raise ValidationError(
+                '"data" must contain "id" and "messageset" keys')
+
+        utils.mirror_subscription(data)
+
+        return Response(status=status.HTTP_200_OK)
+
+
 class UserDetailList(APIView):
     """ UserDetailList Interaction
         GET - returns a detailed list of system users